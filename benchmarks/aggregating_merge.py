@@ -0,0 +1,109 @@
+"""Compares how AggregatingDataSource.data used to merge the results of the
+data servers it aggregates with merging them as columns
+(firefly.series.merge).
+
+    python -m benchmarks.aggregating_merge [--sources 50] [--points 10000]
+        [--upstreams 3]
+
+The sources are spread over the upstream data servers round-robin, and each
+upstream answers with random-walk series at one point per minute. Both ways
+start from the upstreams' response bodies and end with what the data server
+encodes for the client:
+
+* rows: each body parsed into rows, exploded into a dict of position ->
+  value per timestamp, flattened back into rows and serialized, which the
+  data server then parsed back into a Series
+* columns: each body decoded into a Series, the Series merged column by
+  column, handed to the data server as they are
+
+Each is timed with upstreams sharing their timestamps (the usual case) and
+with upstreams whose timestamps are offset from one another, along with
+encoding the merged Series in each of the data server's wire formats.
+"""
+from collections import defaultdict
+import json
+import optparse
+import random
+import time
+
+from firefly import series
+
+END = 1391047920
+STEP = 60
+REPEAT = 3
+
+
+def upstream_bodies(sources, points, upstreams, ragged):
+    """Returns [(positions, body)] for each upstream"""
+    rng = random.Random(0)
+    bodies = []
+    for upstream in xrange(upstreams):
+        positions = range(upstream, sources, upstreams)
+        offset = upstream * STEP // 2 if ragged else 0
+        timestamps = range(END - points * STEP + offset, END + offset, STEP)
+        columns = []
+        for _ in positions:
+            value = rng.uniform(10, 1000)
+            column = []
+            for _ in timestamps:
+                value = max(0.0, value + rng.gauss(0, value * 0.02))
+                column.append(value)
+            columns.append(column)
+        bodies.append((positions, series.Series(timestamps, columns).to_json()))
+    return bodies
+
+
+def merge_rows(sources, bodies):
+    """What AggregatingDataSource.data used to do"""
+    result_data = defaultdict(lambda: dict((i, None) for i in xrange(sources)))
+    for pos_list, body in bodies:
+        for data_pt in json.loads(body):
+            for idx, data_val in enumerate(data_pt['v']):
+                result_data[data_pt['t']][pos_list[idx]] = data_val
+
+    def int_dict_to_list(d):
+        return [item[1] for item in sorted(d.iteritems(), key=lambda x: x[0])]
+
+    result_data = [{'t': t, 'v': int_dict_to_list(val_dict)}
+        for t, val_dict in sorted(result_data.iteritems(), key=lambda x: x[0])]
+    return series.Series.from_json(json.dumps(result_data), sources)
+
+
+def merge_columns(sources, bodies):
+    return series.merge(sources,
+        [(pos_list, series.Series.from_json(body, len(pos_list))) for pos_list, body in bodies])
+
+
+def measure(func, *args):
+    started = time.time()
+    for _ in xrange(REPEAT):
+        result = func(*args)
+    return result, (time.time() - started) / REPEAT
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--sources', type='int', default=50)
+    parser.add_option('--points', type='int', default=10000)
+    parser.add_option('--upstreams', type='int', default=3)
+    options, _ = parser.parse_args()
+
+    print "%d sources x %d points from %d upstreams" % (options.sources, options.points, options.upstreams)
+    print "%-8s %10s %12s %9s  %s" % ('times', 'rows ms', 'columns ms', 'speedup', 'encode ms')
+    for name, ragged in [('aligned', False), ('offset', True)]:
+        bodies = upstream_bodies(options.sources, options.points, options.upstreams, ragged)
+        old, rows_time = measure(merge_rows, options.sources, bodies)
+        new, columns_time = measure(merge_columns, options.sources, bodies)
+        assert old == new
+
+        encode_times = []
+        for fmt in sorted(series.FORMATS):
+            started = time.time()
+            series.FORMATS[fmt][1](new)
+            encode_times.append('%s %.0f' % (fmt, (time.time() - started) * 1000))
+        print "%-8s %10.0f %12.0f %8.1fx  %s" % (name, rows_time * 1000, columns_time * 1000,
+            rows_time / columns_time, ', '.join(encode_times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Compares answering /annotations from SQLite with answering it from the
+in-memory firefly.annotations.AnnotationIndex.
+
+    python -m benchmarks.annotations [--annotations 1000000] [--queries 2000]
+
+Builds a temporary database of random annotations spread over a year, then
+times the windows dashboards typically ask for (an hour, a day, a week, a
+quarter) with the query AnnotationsHandler used to run and with the index,
+clustering the window into a 1000 pixel wide graph as /annotations now does,
+along with how long the index takes to load.
+"""
+import optparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from firefly import annotations
+
+YEAR = 365 * 86400
+END = 1391047920
+WINDOWS = [('hour', 3600), ('day', 86400), ('week', 7 * 86400), ('quarter', 91 * 86400)]
+TYPES = ['deploy', 'push', 'outage', 'config', 'restart']
+# what /annotations used to truncate its results to
+ANNOTATIONS_CUT_OFF = 300
+WIDTH = 1000
+
+
+def build_db(db_file, count):
+    rng = random.Random(0)
+    db_conn = annotations.connect(db_file)
+    db_conn.execute("BEGIN")
+    db_conn.executemany("INSERT INTO annotations (type, description, time) VALUES (?,?,?)",
+        ((rng.choice(TYPES), 'event %d' % idx, END - rng.uniform(0, YEAR)) for idx in xrange(count)))
+    db_conn.execute("COMMIT")
+    return db_conn
+
+
+def sqlite_query(db_conn, start, end):
+    cursor = db_conn.cursor()
+    cursor.execute('SELECT type, description, time, id FROM annotations WHERE time >= ? and time <= ? ORDER BY time DESC LIMIT ?',
+        (start, end, ANNOTATIONS_CUT_OFF))
+    keys = [desc[0] for desc in cursor.description]
+    rows = [dict((key, value) for key, value in zip(keys, row)) for row in cursor]
+    cursor.close()
+    return rows
+
+
+def measure(query, windows):
+    started = time.time()
+    for start, end in windows:
+        query(start, end)
+    return (time.time() - started) / len(windows)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--annotations', type='int', default=1000000)
+    parser.add_option('--queries', type='int', default=2000)
+    options, _ = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        db_conn = build_db(os.path.join(directory, 'annotations.sqlite'), options.annotations)
+
+        started = time.time()
+        index = annotations.AnnotationIndex(db_conn)
+        print "index of %d annotations loaded in %.2fs" % (len(index), time.time() - started)
+
+        rng = random.Random(1)
+        print "%-8s %12s %12s %9s" % ('window', 'sqlite ms', 'index ms', 'speedup')
+        for name, length in WINDOWS:
+            windows = []
+            for _ in xrange(options.queries):
+                end = END - rng.uniform(0, YEAR - length)
+                windows.append((end - length, end))
+            sqlite_time = measure(lambda start, end: sqlite_query(db_conn, start, end), windows)
+            index_time = measure(lambda start, end: index.cluster(start, end, WIDTH), windows)
+            print "%-8s %12.3f %12.3f %8.1fx" % (name, sqlite_time * 1000, index_time * 1000,
+                sqlite_time / index_time)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
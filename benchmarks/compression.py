@@ -0,0 +1,98 @@
+"""Measures bytes saved and CPU spent by response compression on a typical
+dashboard load.
+
+    python -m benchmarks.compression [--graphs 12] [--width 800]
+
+A dashboard load is modelled as the static assets index.html pulls in, one
+/sources listing and a day of /data for each graph, with two random-walk
+series per graph at one point per pixel. Every payload is compressed the way
+firefly.compression would compress it at a few levels, reporting the
+compressed size and the CPU time per dashboard load.
+"""
+import json
+import optparse
+import os
+import random
+import time
+import zlib
+
+from firefly import compression
+from firefly import series
+
+STATIC_PATH = os.path.join(os.path.dirname(compression.__file__), 'static')
+
+LEVELS = [1, 6, 9]
+REPEAT = 5
+
+
+def static_payloads():
+    payloads = []
+    for dirpath, _, filenames in os.walk(STATIC_PATH):
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[1] in ('.js', '.css'):
+                with open(os.path.join(dirpath, filename), 'rb') as f:
+                    payloads.append(f.read())
+    return payloads
+
+
+def data_payloads(graphs, width, fmt):
+    rng = random.Random(0)
+    end = 1391047920
+    step = 86400 // width
+    timestamps = range(end - width * step, end, step)
+    payloads = []
+    for _ in xrange(graphs):
+        columns = []
+        for _ in xrange(2):
+            value = rng.uniform(10, 1000)
+            column = []
+            for _ in timestamps:
+                value = max(0.0, value + rng.gauss(0, value * 0.02))
+                column.append(value)
+            columns.append(column)
+        payloads.append(series.Series(timestamps, columns).encode(fmt))
+    return payloads
+
+
+def sources_payload(entries=2000):
+    return json.dumps([{'type': 'file', 'name': 'metric_%04d.rrd' % idx} for idx in xrange(entries)])
+
+
+def measure(payloads, encoding, level):
+    """Returns (compressed bytes, CPU seconds) for compressing all payloads"""
+    compressed = 0
+    started = time.clock()
+    for _ in xrange(REPEAT):
+        compressed = 0
+        for payload in payloads:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, compression._WBITS[encoding])
+            compressed += len(compressor.compress(payload) + compressor.flush())
+    return compressed, (time.clock() - started) / REPEAT
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--graphs', type='int', default=12)
+    parser.add_option('--width', type='int', default=800)
+    options, _ = parser.parse_args()
+
+    loads = [
+        ('static assets', static_payloads()),
+        ('/sources', [sources_payload()]),
+        ('/data json', data_payloads(options.graphs, options.width, 'json')),
+        ('/data columnar', data_payloads(options.graphs, options.width, 'columnar')),
+        ('/data binary', data_payloads(options.graphs, options.width, 'binary')),
+    ]
+
+    print "%-16s %10s  %-10s %10s %7s %9s" % ('payload', 'raw bytes', 'coding', 'bytes', 'saved', 'cpu ms')
+    for name, payloads in loads:
+        raw = sum(len(payload) for payload in payloads)
+        for encoding, level in [('gzip', level) for level in LEVELS] + [('deflate', 6)]:
+            compressed, cpu = measure(payloads, encoding, level)
+            print "%-16s %10d  %-10s %10d %6.1f%% %9.2f" % (
+                name, raw, '%s-%d' % (encoding, level), compressed,
+                100.0 * (raw - compressed) / raw, cpu * 1000)
+
+
+if __name__ == '__main__':
+    main()
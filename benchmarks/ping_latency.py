@@ -0,0 +1,113 @@
+"""Measures /ping latency on a data server whose /data requests are saturated.
+
+    python -m benchmarks.ping_latency [--executor thread|process|inline]
+
+Starts a data server in-process backed by a data source whose data() call
+blocks for --data-delay seconds (standing in for a slow rrdtool xport), keeps
+--data-clients concurrent /data requests in flight and reports /ping latency
+percentiles while they run. Running it with `--executor inline` shows how the
+data server behaved when data source calls ran on the IOLoop.
+"""
+import json
+import optparse
+import socket
+import threading
+import time
+import urllib2
+from urllib import urlencode
+
+import tornado.httpserver
+import tornado.ioloop
+
+from firefly import data_server
+from firefly import util
+import firefly.data_source
+
+SECRET_KEY = "BENCHMARK"
+
+
+class SlowDataSource(firefly.data_source.DataSource):
+    DESC = "Slow"
+
+    def __init__(self, *args, **kwargs):
+        super(SlowDataSource, self).__init__(*args, **kwargs)
+        self.delay = kwargs['delay']
+
+    def data(self, sources, start, end, width):
+        time.sleep(self.delay)
+        return json.dumps([{'t': start, 'v': [1] * len(sources)}])
+
+
+def start_server(options):
+    ds = SlowDataSource(delay=options.data_delay, executor=options.executor,
+        executor_workers=options.workers)
+    ds._FF_KEY = 'slow'
+    config = {
+        'data_sources': [ds],
+        'data_sources_by_key': {'slow': ds},
+        'secret_key': SECRET_KEY,
+    }
+    application = data_server.make_application(config)
+    application.settings['executors'] = data_server.start_executors(config['data_sources_by_key'])
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    http_server = tornado.httpserver.HTTPServer(application)
+    http_server.listen(port, '127.0.0.1')
+
+    thread = threading.Thread(target=tornado.ioloop.IOLoop.instance().start)
+    thread.daemon = True
+    thread.start()
+    return port
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--executor', default='thread')
+    parser.add_option('--workers', type=int, default=4)
+    parser.add_option('--data-delay', type=float, default=0.2)
+    parser.add_option('--data-clients', type=int, default=8)
+    parser.add_option('--pings', type=int, default=200)
+    options, _ = parser.parse_args()
+
+    port = start_server(options)
+    base = 'http://127.0.0.1:%d' % port
+    stop = threading.Event()
+
+    def hammer_data():
+        while not stop.is_set():
+            params = urlencode({
+                'sources': json.dumps([['slow', 'a']]),
+                'start': 0, 'end': 60, 'width': 60,
+                'token': util.generate_access_token(SECRET_KEY)})
+            urllib2.urlopen('%s/data?%s' % (base, params)).read()
+
+    clients = [threading.Thread(target=hammer_data) for _ in xrange(options.data_clients)]
+    for client in clients:
+        client.daemon = True
+        client.start()
+    time.sleep(options.data_delay)
+
+    latencies = []
+    for _ in xrange(options.pings):
+        start = time.time()
+        urllib2.urlopen('%s/ping' % base).read()
+        latencies.append((time.time() - start) * 1000)
+        time.sleep(0.005)
+    stop.set()
+
+    print "executor=%s workers=%d data_delay=%.0fms data_clients=%d" % (
+        options.executor, options.workers, options.data_delay * 1000, options.data_clients)
+    for pct in (50, 90, 99):
+        print "  /ping p%d: %8.2f ms" % (pct, percentile(latencies, pct))
+
+
+if __name__ == '__main__':
+    main()
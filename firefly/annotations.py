@@ -0,0 +1,293 @@
+"""In-memory index of the annotations database.
+
+Every graph with annotations turned on asks /annotations for its window on
+every refresh, and almost all of those queries return the same rows. Rather
+than running each of them against SQLite, every data server worker answers
+them from an AnnotationIndex: the annotations of each type sorted by time in
+flat arrays, searched by bisection. Rather than every annotation in the
+window, /annotations gets one cluster per pixel of the graph with any (see
+AnnotationIndex.cluster), optionally only of some types.
+
+The index is loaded once, before the workers are forked, so they share its
+pages until they diverge. Workers write annotations straight to SQLite and
+then bump a generation counter in memory shared by all of them; a worker
+which finds the generation moved on since it last looked reads the rows
+added since the newest one it has (ids only ever grow) before answering.
+
+Bulk writes (/add_annotations) go through an AnnotationWriter, which buffers
+the rows of concurrent requests and inserts them in a single transaction
+once `annotations_flush_rows` are waiting or `annotations_flush_interval`
+seconds after the first, answering each request once its rows are committed.
+The database runs in WAL mode, so those transactions don't block readers.
+"""
+from __future__ import with_statement
+
+import bisect
+import functools
+import multiprocessing
+import sqlite3
+import sys
+import time
+from array import array
+
+import tornado.ioloop
+from tornado import stack_context
+
+DEFAULT_FLUSH_ROWS = 1000
+DEFAULT_FLUSH_INTERVAL = 0.5
+
+SCHEMA = """
+    create table if not exists annotations (
+        id integer primary key autoincrement,
+        type integer not null,
+        description text not null,
+        time float not null
+    )"""
+
+
+def connect(db_file):
+    """Opens the annotations database, creating it if needed."""
+    db_conn = sqlite3.connect(db_file, isolation_level=None)
+    db_conn.execute("PRAGMA journal_mode=WAL")
+    # with WAL, commits are only synced at checkpoints, which is plenty for
+    # annotations
+    db_conn.execute("PRAGMA synchronous=NORMAL")
+    db_conn.execute(SCHEMA)
+    db_conn.execute("create index if not exists time on annotations(time)")
+    return db_conn
+
+
+class _TypeIndex(object):
+    """The annotations of one type, in parallel arrays sorted by time (then
+    id)."""
+
+    def __init__(self, an_type):
+        self.type = an_type
+        self.times = array('d')
+        self.ids = array('l')
+        self.descriptions = []
+
+    def __len__(self):
+        return len(self.times)
+
+    def add(self, an_id, description, an_time):
+        if not len(self.times) or an_time >= self.times[-1]:
+            # the usual case: loading everything, or annotations of events
+            # which just happened
+            self.times.append(an_time)
+            self.ids.append(an_id)
+            self.descriptions.append(description)
+        else:
+            idx = bisect.bisect_right(self.times, an_time)
+            self.times.insert(idx, an_time)
+            self.ids.insert(idx, an_id)
+            self.descriptions.insert(idx, description)
+
+    def bounds(self, start, end):
+        """Returns the slice bounds of the annotations from start to end
+        inclusive."""
+        return bisect.bisect_left(self.times, start), bisect.bisect_right(self.times, end)
+
+    def row(self, idx):
+        return {
+            'type': self.type,
+            'description': self.descriptions[idx],
+            'time': self.times[idx],
+            'id': self.ids[idx],
+        }
+
+
+class AnnotationIndex(object):
+    """The annotations of a database, indexed by type and time."""
+
+    def __init__(self, db_conn):
+        self.db_conn = db_conn
+        # type -> _TypeIndex
+        self.types = {}
+        self._max_id = 0
+        # shared with the workers forked after this
+        self._generation = multiprocessing.Value('l', 0)
+        self._seen_generation = 0
+        self._load("SELECT id, type, description, time FROM annotations ORDER BY time, id", ())
+
+    def __len__(self):
+        return sum(len(type_index) for type_index in self.types.itervalues())
+
+    def added(self):
+        """Tells every worker that annotations were written to the
+        database; call this once they are committed."""
+        with self._generation.get_lock():
+            self._generation.value += 1
+
+    def cluster(self, start, end, bins, types=None):
+        """Groups the annotations from start to end inclusive (of the given
+        types, or all of them) into `bins` equal spans of time, returning a
+        dict for each span with any, latest first.
+
+        A span with a single annotation gets that annotation's type,
+        description, time and id, with a `count` of 1. Otherwise the dict has the `count` of
+        annotations in the span and their `counts` by type, the time of the
+        earliest of them as `start`, and the `time`, `id` and `type` of the
+        latest.
+
+        Where a type has more annotations in the window than there are bins,
+        they are counted by bisecting for the start of each bin rather than
+        visited, so the cost of a window is bounded by the number of bins
+        however many annotations it holds.
+        """
+        self.refresh()
+        bins = max(1, int(bins))
+        span = float(end - start) / bins
+        # bin -> [(type index, lo, hi)], for the types with annotations in it
+        binned = {}
+        for type_index in self._type_indexes(types):
+            lo, hi = type_index.bounds(start, end)
+            if lo == hi:
+                continue
+            times = type_index.times
+            if hi - lo < bins:
+                # fewer annotations than bins: walk them
+                run_start, run_bin = lo, None
+                for idx in xrange(lo, hi):
+                    bin_idx = min(bins - 1, int((times[idx] - start) / span))
+                    if bin_idx != run_bin:
+                        if run_bin is not None:
+                            binned.setdefault(run_bin, []).append((type_index, run_start, idx))
+                        run_start, run_bin = idx, bin_idx
+                binned.setdefault(run_bin, []).append((type_index, run_start, hi))
+            else:
+                # more: find where each bin starts
+                edges = [bisect.bisect_left(times, start + bin_idx * span, lo, hi)
+                    for bin_idx in xrange(1, bins)]
+                edges = [lo] + edges + [hi]
+                for bin_idx in xrange(bins):
+                    if edges[bin_idx] != edges[bin_idx + 1]:
+                        binned.setdefault(bin_idx, []).append((type_index, edges[bin_idx], edges[bin_idx + 1]))
+
+        return [self._cluster(binned[idx]) for idx in sorted(binned, reverse=True)]
+
+    def _cluster(self, members):
+        if len(members) == 1 and members[0][2] - members[0][1] == 1:
+            type_index, lo, _ = members[0]
+            row = type_index.row(lo)
+            row['count'] = 1
+            return row
+
+        count = 0
+        counts = {}
+        earliest = latest = None
+        for type_index, lo, hi in members:
+            counts[type_index.type] = hi - lo
+            count += hi - lo
+            if earliest is None or type_index.times[lo] < earliest:
+                earliest = type_index.times[lo]
+            last = (type_index.times[hi - 1], type_index.ids[hi - 1], type_index.type)
+            if latest is None or last > latest:
+                latest = last
+        return {
+            'type': latest[2],
+            'time': latest[0],
+            'id': latest[1],
+            'start': earliest,
+            'count': count,
+            'counts': counts,
+        }
+
+    def refresh(self):
+        """Reads in the annotations added since the index last looked, if
+        any worker added some."""
+        generation = self._generation.value
+        if generation == self._seen_generation:
+            return
+        self._load("SELECT id, type, description, time FROM annotations WHERE id > ? ORDER BY time, id",
+            (self._max_id,))
+        self._seen_generation = generation
+
+    def _type_indexes(self, types):
+        if types is None:
+            return self.types.values()
+        return [self.types[an_type] for an_type in types if an_type in self.types]
+
+    def _load(self, query, args):
+        for an_id, an_type, description, an_time in self.db_conn.execute(query, args):
+            type_index = self.types.get(an_type)
+            if type_index is None:
+                type_index = self.types[an_type] = _TypeIndex(an_type)
+            type_index.add(an_id, description, an_time)
+            self._max_id = max(self._max_id, an_id)
+
+
+class AnnotationWriter(object):
+    """Inserts annotations in batches, on the IOLoop of the worker."""
+
+    def __init__(self, db_conn, index, flush_rows=DEFAULT_FLUSH_ROWS,
+            flush_interval=DEFAULT_FLUSH_INTERVAL, io_loop=None):
+        self.db_conn = db_conn
+        self.index = index
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self._io_loop = io_loop
+        self._rows = []
+        self._waiters = []
+        self._timeout = None
+
+    @property
+    def io_loop(self):
+        return self._io_loop or tornado.ioloop.IOLoop.instance()
+
+    @io_loop.setter
+    def io_loop(self, io_loop):
+        self._io_loop = io_loop
+
+    def add(self, rows, callback, errback=None):
+        """Queues (type, description, time) rows for insertion, calling
+        callback once they are committed.
+
+        If the transaction fails, errback is called with the exc_info;
+        without one it is re-raised in the stack context add was called in.
+        """
+        self._rows.extend(rows)
+        self._waiters.append((stack_context.wrap(callback),
+            stack_context.wrap(errback) if errback is not None else None,
+            stack_context.wrap(_reraise)))
+        if len(self._rows) >= self.flush_rows:
+            self.flush()
+        elif self._timeout is None:
+            with stack_context.NullContext():
+                self._timeout = self.io_loop.add_timeout(time.time() + self.flush_interval, self._on_timeout)
+
+    def _on_timeout(self):
+        self._timeout = None
+        self.flush()
+
+    def flush(self):
+        """Inserts every queued row in one transaction."""
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        rows, self._rows = self._rows, []
+        waiters, self._waiters = self._waiters, []
+        if not waiters:
+            return
+
+        try:
+            self.db_conn.execute("BEGIN")
+            try:
+                self.db_conn.executemany("INSERT INTO annotations (type, description, time) VALUES (?,?,?)", rows)
+                self.db_conn.execute("COMMIT")
+            except Exception:
+                self.db_conn.execute("ROLLBACK")
+                raise
+        except Exception:
+            exc_info = sys.exc_info()
+            for _, errback, reraise in waiters:
+                self.io_loop.add_callback(functools.partial(errback or reraise, exc_info))
+            return
+
+        self.index.added()
+        for callback, _, _ in waiters:
+            self.io_loop.add_callback(callback)
+
+
+def _reraise(exc_info):
+    raise exc_info[0], exc_info[1], exc_info[2]
@@ -0,0 +1,388 @@
+"""In-memory caching of data source results for the data server.
+
+Results are cached under keys built from the data source, the sources and
+the requested window snapped to the step of the series, so that requests for
+the "same" graph made a few seconds apart (or by different users) share an
+entry. Windows that reach up to now are still changing and only live for a
+short time; fully historical windows can be kept for much longer.
+
+Each worker keeps its own ResultCache in memory, in front of a SharedCache
+all of the workers of a data server read and write: files in a directory
+(on tmpfs where there is one) which the workers forked from the same parent
+share. Unless configured, the directory is named after the server's port,
+so that a restarted server empties and reuses the one it had rather than
+leaving it behind. A result fetched by one worker is then a hit for all of the others,
+so hit rates go with the traffic of the whole server rather than that of a
+worker. Besides /data results, /sources listings and legends and titles are
+cached in both tiers.
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+
+from tornado import stack_context
+
+from firefly import series
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_LIVE_TTL = 10
+DEFAULT_HISTORICAL_TTL = 60 * 60
+DEFAULT_SHARED_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_SOURCES_TTL = 60
+DEFAULT_META_TTL = 60 * 60
+
+# Shared cache files are a header of the expiry time and the kind of value,
+# followed by the value: a series.Series in the binary format, or JSON
+_SHARED_HEADER = struct.Struct('<dc')
+_SHARED_SUFFIX = '.entry'
+
+
+class ResultCache(object):
+    """An LRU cache bounded by the total size of its values, with a TTL on
+    each entry.
+
+    Keeps hit/miss/eviction counters so that the cache can be sized from
+    production traffic; see stats().
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, clock=time.time):
+        self.max_bytes = max_bytes
+        self.clock = clock
+        # key -> (value, nbytes, expiry); ordered least to most recently used
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """Returns the value cached under key, or None"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        value, nbytes, expiry = entry
+        if expiry <= self.clock():
+            self.bytes -= nbytes
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries[key] = entry
+        self.hits += 1
+        return value
+
+    def put(self, key, value, nbytes, ttl):
+        """Caches value under key for ttl seconds.
+
+        nbytes is the size charged against max_bytes for this value. Values
+        bigger than the whole cache aren't cached at all.
+        """
+        if nbytes > self.max_bytes or ttl <= 0:
+            return
+
+        old_entry = self._entries.pop(key, None)
+        if old_entry is not None:
+            self.bytes -= old_entry[1]
+
+        self._entries[key] = (value, nbytes, self.clock() + ttl)
+        self.bytes += nbytes
+
+        while self.bytes > self.max_bytes:
+            _, (_, evicted_nbytes, _) = self._entries.popitem(last=False)
+            self.bytes -= evicted_nbytes
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+def default_shared_directory(port=None):
+    """Returns the directory the shared cache of the data server on port is
+    kept in unless configured, on /dev/shm if there is one."""
+    name = 'firefly-cache' if port is None else 'firefly-cache-%d' % port
+    return os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), name)
+
+
+class SharedCache(object):
+    """A cache of Series and JSON-able values shared by processes through a
+    directory, each entry a file named after the hash of its key.
+
+    Entries are written to a temporary file and renamed into place, so
+    readers only ever see whole entries. Every `sweep_every` puts, the
+    process which made the put removes expired entries, then the least
+    recently used ones (by mtime, which hits bump) until the directory is
+    back under max_bytes.
+    """
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_SHARED_MAX_BYTES, sweep_every=100, clock=time.time):
+        if directory is None:
+            directory = default_shared_directory()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.sweep_every = sweep_every
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._puts = 0
+
+    def clear(self):
+        """Removes every entry, e.g. those left by a previous server, and any
+        half-written ones; other files in the directory are left alone."""
+        for filename in os.listdir(self.directory):
+            if filename.endswith(_SHARED_SUFFIX) or (
+                    filename.endswith('.tmp') and _SHARED_SUFFIX + '.' in filename):
+                _unlink(os.path.join(self.directory, filename))
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(json.dumps(key)).hexdigest() + _SHARED_SUFFIX)
+
+    def get(self, key):
+        """Returns the value cached under key by any process, or None"""
+        return self.get_with_ttl(key)[0]
+
+    def get_with_ttl(self, key):
+        """Returns the value cached under key by any process and the number
+        of seconds it has left, or (None, None)"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            expiry, kind = _SHARED_HEADER.unpack_from(data, 0)
+        except (IOError, struct.error):
+            self.misses += 1
+            return None, None
+
+        now = self.clock()
+        if expiry <= now:
+            _unlink(path)
+            self.misses += 1
+            return None, None
+
+        self.hits += 1
+        _touch(path)
+        body = buffer(data, _SHARED_HEADER.size)
+        if kind == 'S':
+            return series.Series.from_binary(body), expiry - now
+        return json.loads(str(body)), expiry - now
+
+    def put(self, key, value, ttl):
+        """Caches a series.Series or JSON-able value under key for ttl
+        seconds."""
+        if ttl <= 0:
+            return
+        if isinstance(value, series.Series):
+            kind, body = 'S', value.encode('binary')
+        else:
+            kind, body = 'J', json.dumps(value)
+        if _SHARED_HEADER.size + len(body) > self.max_bytes:
+            return
+
+        path = self._path(key)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(_SHARED_HEADER.pack(self.clock() + ttl, kind))
+                f.write(body)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            # e.g. the tmpfs is full; the cache is only an optimisation
+            _unlink(tmp_path)
+            return
+
+        self._puts += 1
+        if self._puts % self.sweep_every == 0:
+            self.sweep()
+
+    def _entries(self):
+        """Returns (path, size, mtime) of every entry"""
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(_SHARED_SUFFIX):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def sweep(self):
+        """Removes expired entries, then least recently used ones until the
+        entries fit in max_bytes."""
+        now = self.clock()
+        entries = []
+        for path, size, mtime in self._entries():
+            try:
+                with open(path, 'rb') as f:
+                    expiry, _ = _SHARED_HEADER.unpack(f.read(_SHARED_HEADER.size))
+            except (IOError, struct.error):
+                continue
+            if expiry <= now:
+                _unlink(path)
+            else:
+                entries.append((mtime, size, path))
+
+        total = sum(size for _, size, _ in entries)
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            _unlink(path)
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        entries = self._entries()
+        return {
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _touch(path):
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+class SingleFlight(object):
+    """Coalesces concurrent requests for the same key into a single fetch.
+
+    When identical requests arrive while a fetch for their key is still in
+    flight, they wait for that fetch instead of starting their own, and all
+    of them get the same result (or the same error). Must only be used from
+    the IOLoop thread.
+    """
+
+    def __init__(self):
+        # key -> list of (callback, errback) waiting on the in-flight fetch
+        self._waiters = {}
+        self.fetches = 0
+        self.coalesced = 0
+
+    def run(self, key, fetch, callback):
+        """Passes the result for key to callback, calling
+        fetch(on_result, on_error) unless a fetch for key is in flight.
+
+        Callbacks run in the stack context they were registered from, so an
+        error in the fetch is raised in the context of every waiting request.
+        """
+        waiter = (stack_context.wrap(callback), stack_context.wrap(_reraise))
+        if key in self._waiters:
+            self._waiters[key].append(waiter)
+            self.coalesced += 1
+            return
+
+        self._waiters[key] = [waiter]
+        self.fetches += 1
+
+        def on_result(result):
+            _call_all([waiter_callback for waiter_callback, _ in self._waiters.pop(key)], result)
+
+        def on_error(exc_info):
+            _call_all([waiter_errback for _, waiter_errback in self._waiters.pop(key)], exc_info)
+
+        fetch(on_result, on_error)
+
+    def __len__(self):
+        return len(self._waiters)
+
+
+def _reraise(exc_info):
+    raise exc_info[0], exc_info[1], exc_info[2]
+
+
+def _call_all(callbacks, arg):
+    """Calls every callback with arg, even if some of them raise.
+
+    Callbacks wrapped in another request's stack context have their
+    exceptions handled there; anything raised in the current context is
+    re-raised once everyone has been called.
+    """
+    exc_info = None
+    for callback in callbacks:
+        try:
+            callback(arg)
+        except Exception:
+            exc_info = exc_info or sys.exc_info()
+    if exc_info is not None:
+        _reraise(exc_info)
+
+
+def align_window(start, end, step):
+    """Widens [start, end] to the enclosing multiples of step"""
+    if step <= 1:
+        return start, end
+    return start - start % step, end + (-end % step)
+
+
+def data_key(data_source, sources, start, end, width, algorithm=None):
+    """Builds the cache key for a data request.
+
+    start and end should already be aligned with align_window; algorithm is
+    the downsampling algorithm applied to the result.
+    """
+    normalized_sources = tuple(tuple(source) for source in sources)
+    return ('data', data_source._FF_KEY, normalized_sources, start, end, width, algorithm)
+
+
+def meta_key(kind, data_source, sources):
+    """Builds the cache key for the legend or title (`kind`) of sources, or
+    the listing of a path for 'sources'."""
+    normalized_sources = tuple(tuple(source) if isinstance(source, list) else source for source in sources)
+    return (kind, data_source._FF_KEY, normalized_sources)
+
+
+def nbytes(value):
+    """The size to charge a ResultCache for a cached value"""
+    if isinstance(value, series.Series):
+        return value.nbytes()
+    return len(json.dumps(value))
+
+
+def window_ttl(end, step, live_ttl, historical_ttl, now=None):
+    """How long the result for a window ending at `end` can be cached.
+
+    Windows within a step of now may still get new points and are only kept
+    for live_ttl seconds.
+    """
+    if now is None:
+        now = time.time()
+    if end + step >= now:
+        return live_ttl
+    return historical_ttl
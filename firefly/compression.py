@@ -0,0 +1,219 @@
+"""Compression of data server and UI server responses.
+
+Dynamic responses are compressed on the fly with gzip or deflate, whichever
+the client prefers, as long as they are big enough for it to be worth the
+CPU. Static assets are compressed once ahead of time by running
+
+    python -m firefly.compression firefly/static
+
+(`make production` does this) and served from the .gz files next to them.
+
+Both servers take the same options in their section of the config:
+
+    compression_level: 6        # zlib level 1-9; 0 turns compression off
+    compression_min_bytes: 1024 # smaller responses are sent as they are
+"""
+import datetime
+import email.utils
+import functools
+import gzip
+import logging
+import mimetypes
+import os
+import stat
+import sys
+import time
+import zlib
+
+import tornado.web
+
+log = logging.getLogger(__name__)
+
+DEFAULT_LEVEL = 6
+DEFAULT_MIN_BYTES = 1024
+
+COMPRESSIBLE_CONTENT_TYPES = frozenset([
+    'application/json',
+    'application/javascript',
+    'application/x-javascript',
+    'application/x-firefly-series',
+    'text/css',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+    'image/svg+xml',
+])
+
+PRECOMPRESSED_SUFFIX = '.gz'
+PRECOMPRESSED_EXTENSIONS = frozenset(['.js', '.css', '.html', '.svg', '.ttf', '.ico'])
+
+# zlib wbits for each content coding: gzip wraps the deflate stream in a gzip
+# header and trailer, HTTP's "deflate" means the zlib format.
+_WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+def accepted_encoding(accept_encoding):
+    """Picks the content coding to use for a request's Accept-Encoding
+    header: gzip or deflate, in order of the client's q-values, or None."""
+    best, best_q = None, 0.0
+    for part in accept_encoding.split(','):
+        fields = part.strip().split(';')
+        coding = fields[0].strip().lower()
+        if coding not in _WBITS:
+            continue
+        q = 1.0
+        for param in fields[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        # prefer gzip when the client doesn't care, it's the better supported
+        if q > best_q or (q > 0 and q == best_q and coding == 'gzip'):
+            best, best_q = coding, q
+    return best
+
+
+class CompressionTransform(tornado.web.OutputTransform):
+    """Compresses responses with gzip or deflate.
+
+    Like tornado's own GZipContentEncoding, but also speaks deflate, has a
+    configurable level and leaves responses smaller than min_bytes alone.
+    Use transforms() to build the list to hand to tornado.web.Application.
+    """
+
+    def __init__(self, request, level=DEFAULT_LEVEL, min_bytes=DEFAULT_MIN_BYTES):
+        self.level = level
+        self.min_bytes = min_bytes
+        self._encoding = None
+        if request.supports_http_1_1():
+            self._encoding = accepted_encoding(request.headers.get('Accept-Encoding', ''))
+
+    def transform_first_chunk(self, headers, chunk, finishing):
+        ctype = headers.get('Content-Type', '').split(';')[0].strip()
+        if ctype in COMPRESSIBLE_CONTENT_TYPES:
+            _add_vary(headers, 'Accept-Encoding')
+
+        if (self._encoding is None or
+                ctype not in COMPRESSIBLE_CONTENT_TYPES or
+                'Content-Encoding' in headers or
+                (finishing and len(chunk) < self.min_bytes) or
+                (not finishing and 'Content-Length' in headers)):
+            self._encoding = None
+            return headers, chunk
+
+        headers['Content-Encoding'] = self._encoding
+        self._compressor = zlib.compressobj(self.level, zlib.DEFLATED, _WBITS[self._encoding])
+        chunk = self.transform_chunk(chunk, finishing)
+        if 'Content-Length' in headers:
+            headers['Content-Length'] = str(len(chunk))
+        return headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        if self._encoding is None:
+            return chunk
+        if finishing:
+            return self._compressor.compress(chunk) + self._compressor.flush()
+        # sync flush so that clients see streamed chunks as they are written
+        return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def transforms(config):
+    """Builds the output transforms for an Application from the compression
+    options in a server's config."""
+    level = int(config.get('compression_level', DEFAULT_LEVEL))
+    min_bytes = int(config.get('compression_min_bytes', DEFAULT_MIN_BYTES))
+    if level <= 0:
+        return [tornado.web.ChunkedTransferEncoding]
+    return [
+        functools.partial(CompressionTransform, level=level, min_bytes=min_bytes),
+        tornado.web.ChunkedTransferEncoding,
+    ]
+
+
+class PrecompressedStaticFileHandler(tornado.web.StaticFileHandler):
+    """Serves static files, using the gzipped copy next to a file when the
+    client accepts gzip and that copy is at least as new as the file."""
+
+    def get(self, path, include_body=True):
+        abspath = os.path.abspath(os.path.join(self.root, path.replace('/', os.path.sep)))
+        gzpath = abspath + PRECOMPRESSED_SUFFIX
+        if (not abspath.startswith(self.root) or
+                accepted_encoding(self.request.headers.get('Accept-Encoding', '')) != 'gzip' or
+                not os.path.isfile(abspath) or
+                not os.path.isfile(gzpath) or
+                os.stat(gzpath)[stat.ST_MTIME] < os.stat(abspath)[stat.ST_MTIME]):
+            super(PrecompressedStaticFileHandler, self).get(path, include_body)
+            return
+
+        modified = datetime.datetime.fromtimestamp(os.stat(abspath)[stat.ST_MTIME])
+        self.set_header("Last-Modified", modified)
+        if "v" in self.request.arguments:
+            self.set_header("Expires", datetime.datetime.utcnow() +
+                                       datetime.timedelta(days=365*10))
+            self.set_header("Cache-Control", "max-age=" + str(86400*365*10))
+        else:
+            self.set_header("Cache-Control", "public")
+        mime_type, _ = mimetypes.guess_type(abspath)
+        if mime_type:
+            self.set_header("Content-Type", mime_type)
+        self.set_header("Content-Encoding", "gzip")
+        self.set_header("Vary", "Accept-Encoding")
+        self.set_extra_headers(path)
+
+        ims_value = self.request.headers.get("If-Modified-Since")
+        if ims_value is not None:
+            date_tuple = email.utils.parsedate(ims_value)
+            if_since = datetime.datetime.fromtimestamp(time.mktime(date_tuple))
+            if if_since >= modified:
+                self.set_status(304)
+                return
+
+        if not include_body:
+            return
+        with open(gzpath, 'rb') as f:
+            self.write(f.read())
+
+
+def precompress_static(static_path, level=9):
+    """Writes a .gz copy of every compressible file under static_path whose
+    copy is missing or out of date. Returns the number of files written."""
+    written = 0
+    for dirpath, dirnames, filenames in os.walk(static_path):
+        # don't descend into submodule checkouts' metadata
+        dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+        for filename in filenames:
+            if os.path.splitext(filename)[1] not in PRECOMPRESSED_EXTENSIONS:
+                continue
+            path = os.path.join(dirpath, filename)
+            gzpath = path + PRECOMPRESSED_SUFFIX
+            if os.path.exists(gzpath) and os.stat(gzpath)[stat.ST_MTIME] >= os.stat(path)[stat.ST_MTIME]:
+                continue
+            with open(path, 'rb') as f:
+                content = f.read()
+            with open(gzpath, 'wb') as out:
+                # mtime=0 so that rebuilding unchanged assets gives identical files
+                gz_file = gzip.GzipFile(filename='', mode='wb', compresslevel=level,
+                    fileobj=out, mtime=0)
+                gz_file.write(content)
+                gz_file.close()
+            written += 1
+    return written
+
+
+def _add_vary(headers, header):
+    vary = headers.get('Vary')
+    if not vary:
+        headers['Vary'] = header
+    elif header.lower() not in [value.strip().lower() for value in vary.split(',')]:
+        headers['Vary'] = vary + ', ' + header
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    for static_path in sys.argv[1:] or [os.path.join(os.path.dirname(__file__), 'static')]:
+        log.info("Precompressed %d files in %s", precompress_static(static_path), static_path)
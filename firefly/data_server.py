@@ -6,10 +6,10 @@ import sys
 import time
 import signal
 import socket
-import sqlite3
 import hashlib
 import logging
 import datetime
+import functools
 
 try:
     import json
@@ -24,38 +24,123 @@ import tornado.httpclient
 import tornado.httpserver
 
 import util
+from firefly import annotations
+from firefly import cache
+from firefly import compression
+from firefly import deadlines
+from firefly import downsample
+from firefly import executor
+from firefly import metrics
+from firefly import series
+from firefly import streaming
+from firefly import timing
 
 log = logging.getLogger('firefly_data_server')
 
 DEFAULT_DATA_SERVER_PORT = 8890
 
-# The number of annotations to draw before we stop
-# This cut-off exists because browsers are unhappy with a lot of these
-ANNOTATIONS_CUT_OFF = 300
+# How many clusters annotations are grouped into for clients which don't
+# say how wide their graph is; browsers are unhappy with a lot of these
+ANNOTATION_BINS = 300
+
+# How many steps before a client's `since` an incremental /data response
+# starts, to pick up revisions of the most recent points (e.g. a partially
+# consolidated RRD row)
+REVISED_STEPS = 2
+
+# How long before a request's deadline its data source calls are asked to
+# return by, leaving time to send what they got
+DEADLINE_MARGIN = 0.1
 
 def token_authed(method):
     def new_method(self):
-        token = self.get_argument('token')
-        if not util.verify_access_token(token, self.application.settings['secret_key']):
-            raise tornado.web.HTTPError(403)
+        with timing.of(self.request).phase('auth'):
+            token = self.get_argument('token')
+            if not util.verify_access_token(token, self.application.settings['secret_key']):
+                raise tornado.web.HTTPError(403)
         method(self)
     return new_method
 
-class SourcesHandler(tornado.web.RequestHandler):
+class DataSourceHandler(tornado.web.RequestHandler):
+    """Base class for handlers which call into data sources"""
+
+    def run_data_source(self, data_source, method, args, callback, errback=None, deadline=None,
+            transform=None):
+        """Calls data_source.`method`(*args) on the data source's executor,
+        passing the result to callback back on the IOLoop.
+
+        Handlers using this must be @tornado.web.asynchronous and finish the
+        request from the callback. See DataSourceExecutor.submit for errback,
+        deadline and transform.
+        """
+        data_source_executor = self.application.settings['executors'][data_source._FF_KEY]
+        data_source_executor.submit(method, args, callback, errback,
+            request_timing=timing.of(self.request), deadline=deadline, transform=transform)
+
+    def get_error_html(self, status_code, **kwargs):
+        # send_error has just cleared the headers
+        exception = kwargs.get('exception')
+        if isinstance(exception, executor.Saturated):
+            self.set_header("Retry-After", str(exception.retry_after))
+        return super(DataSourceHandler, self).get_error_html(status_code, **kwargs)
+
+    def run_cached(self, data_source, method, args, key, ttl, callback):
+        """Like run_data_source, but answers from the caches under key when
+        it can, caching the result for ttl seconds otherwise.
+
+        Identical calls that miss the cache while one is in flight share it.
+        """
+        cached = self.get_cached(key)
+        if cached is not None:
+            callback(cached)
+            return
+
+        def fetch(on_result, on_error):
+            def on_value(value):
+                self.put_cached(key, value, ttl)
+                on_result(value)
+            self.run_data_source(data_source, method, args, on_value, on_error)
+
+        self.application.settings['data_in_flight'].run(key, fetch, callback)
+
+    def get_cached(self, key):
+        """Returns the value cached under key by this worker or, failing
+        that, by any worker (see firefly.cache), or None."""
+        settings = self.application.settings
+        value = settings['data_cache'].get(key)
+        if value is None and settings.get('shared_cache') is not None:
+            value, ttl = settings['shared_cache'].get_with_ttl(key)
+            if value is not None:
+                settings['data_cache'].put(key, value, cache.nbytes(value), ttl)
+        return value
+
+    def put_cached(self, key, value, ttl):
+        """Caches value under key for ttl seconds, for every worker."""
+        settings = self.application.settings
+        settings['data_cache'].put(key, value, cache.nbytes(value), ttl)
+        if settings.get('shared_cache') is not None:
+            settings['shared_cache'].put(key, value, ttl)
+
+
+class SourcesHandler(DataSourceHandler):
+    @tornado.web.asynchronous
     @token_authed
     def get(self):
         path = json.loads(self.get_argument('path'))
 
         if not path:
-            contents = self._list_sourcelists()
+            self._on_contents(self._list_sourcelists())
         else:
             ds = self.application.settings['data_sources_by_key'][path[0]]
-            contents = ds.list_path(path[1:])
+            self.run_cached(ds, 'list_path', (path[1:],), cache.meta_key('sources', ds, path[1:]),
+                self.application.settings.get('cache_sources_ttl', cache.DEFAULT_SOURCES_TTL),
+                self._on_contents)
 
+    def _on_contents(self, contents):
         self.set_header("Content-Type", "application/json")
         self.set_header("Cache-Control", "no-cache, must-revalidate")
         self.set_header("Access-Control-Allow-Origin", "*")
-        self.write(json.dumps(contents))
+        self.finish(json.dumps(contents))
 
     def _list_sourcelists(self):
         data_sources = self.application.settings['data_sources']
@@ -68,10 +153,17 @@ class SourcesHandler(tornado.web.RequestHandler):
         return sourcelists
 
 
-class GraphBaseHandler(tornado.web.RequestHandler):
+class GraphBaseHandler(DataSourceHandler):
     """Base class implementing common ops"""
 
     def get_params(self):
+        """Parses the arguments describing a graph, which are also kept in
+        self.params for the slow request log."""
+        with timing.of(self.request).phase('parse'):
+            self.params = self._parse_params()
+        return self.params
+
+    def _parse_params(self):
         sources = self.get_argument('sources', '')
         if sources != '':
             sources = json.loads(sources)
@@ -85,6 +177,12 @@ class GraphBaseHandler(tornado.web.RequestHandler):
         overlay_previous_period = self.get_argument('overlay_previous_period', False)
         stacked_graph = self.get_argument('stacked_graph', False)
         area_graph = self.get_argument('area_graph', False)
+        since = self.get_argument('since', None) or self.get_argument('cursor', None)
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                raise tornado.web.HTTPError(400, "Invalid since or cursor %s" % since)
         if sources:
             data_source, sources = parse_sources(sources, self.application.settings['data_sources_by_key'])
         else:
@@ -97,6 +195,8 @@ class GraphBaseHandler(tornado.web.RequestHandler):
             'end': end,
             'width': width,
             'height': height,
+            'since': since,
+            'downsample': self.get_argument('downsample', None),
             'options': {
                 'zoom': zoom,
                 'y_axis_log_scale': y_axis_log_scale,
@@ -105,77 +205,552 @@ class GraphBaseHandler(tornado.web.RequestHandler):
                 'stacked_graph': stacked_graph,
                 'area_graph': area_graph}}
 
+    def plan_data_query(self, data_source, sources, start, end, width, since=None, algorithm=None):
+        """Describes how to fetch the data for the given graph.
+
+        The window is widened to the step of the series, so that requests
+        for the same graph made a few seconds apart share a data cache entry;
+        the returned dict holds the aligned window to fetch, the `window`
+        that was asked for, to trim results to, and the cache key and TTL.
+
+        With since, only the points from since onwards are wanted (see
+        DataHandler), so only the end of the window is fetched, at the
+        resolution the whole window would have had.
+
+        algorithm names the firefly.downsample algorithm to apply to the
+        result, defaulting to the `downsample` setting.
+        """
+        settings = self.application.settings
+        if algorithm is None:
+            algorithm = settings.get('downsample', downsample.DEFAULT_ALGORITHM)
+        if algorithm not in downsample.ALGORITHMS:
+            raise tornado.web.HTTPError(400, "Unknown downsampling algorithm %s" % algorithm)
+
+        step = data_source.step(sources, start, end, width)
+        if since is not None:
+            since -= REVISED_STEPS * step
+            if since > start and end > start:
+                if width > 0:
+                    width = max(1, width * (end - since) // (end - start))
+                start = since
+            else:
+                since = None
+        aligned_start, aligned_end = cache.align_window(start, end, step)
+
+        return {
+            'data_source': data_source,
+            'sources': sources,
+            'start': aligned_start,
+            'end': aligned_end,
+            'window': (start, end),
+            'width': width,
+            'downsample': algorithm,
+            'key': cache.data_key(data_source, sources, aligned_start, aligned_end, width, algorithm),
+            'ttl': cache.window_ttl(aligned_end, step,
+                settings.get('cache_live_ttl', cache.DEFAULT_LIVE_TTL),
+                settings.get('cache_historical_ttl', cache.DEFAULT_HISTORICAL_TTL))}
+
+    def run_meta(self, params, method, callback):
+        """Gets the legend, title or both (`method`: legend, title or meta)
+        of the graph described by params through the caches, passing it to
+        callback."""
+        data_source = params['data_source']
+        self.run_cached(data_source, method, (params['sources'],),
+            cache.meta_key(method, data_source, params['sources']),
+            self.application.settings.get('cache_meta_ttl', cache.DEFAULT_META_TTL),
+            callback)
+
+    def get_annotations(self, params):
+        """Returns the annotations for the graph described by params,
+        clustered to its width and of the types given by the `type`
+        arguments, if any."""
+        bins = params['width'] if params['width'] > 0 else ANNOTATION_BINS
+        types = self.get_arguments('type') or None
+
+        # answered from the worker's index; see firefly.annotations
+        with timing.of(self.request).phase('annotations'):
+            return self.settings['annotations'].cluster(params['start'], params['end'], bins, types)
+
+    def get_data_format(self):
+        """Works out which of the wire formats in series.FORMATS the client
+        wants, from the `format` argument or else the Accept header."""
+        fmt = self.get_argument('format', None)
+        if fmt is None:
+            if series.BINARY_CONTENT_TYPE in self.request.headers.get('Accept', ''):
+                fmt = 'binary'
+            else:
+                fmt = 'json'
+        if fmt not in series.FORMATS:
+            raise tornado.web.HTTPError(400, "Unknown data format %s" % fmt)
+        return fmt
+
+    def get_deadline(self):
+        """Returns the time by which this request should be answered, from
+        its `deadline` argument (in seconds) or else the `request_deadline`
+        setting, or None if it has none."""
+        seconds = self.get_argument('deadline', None)
+        if seconds is None:
+            seconds = self.application.settings.get('request_deadline')
+        try:
+            seconds = float(seconds or 0)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "Invalid deadline %s" % seconds)
+        if seconds <= 0:
+            return None
+        return self.request._start_time + seconds
+
+    def fetch_data(self, params, callback):
+        """Gets data for the graph described by params, passing a
+        series.Series of the data source's result to callback.
+
+        If the request has a deadline (see get_deadline), the data source
+        call runs with it (see firefly.deadlines) and callback gets whatever
+        has arrived by then, with the sources which are missing their data
+        in the Series' `missing`.
+        """
+        query = self.plan_data_query(params['data_source'], params['sources'],
+            params['start'], params['end'], params['width'], params.get('since'),
+            params.get('downsample'))
+        # the window asked for starts at since, if there is one
+        on_result = lambda result: callback(result.between(*query['window']))
+
+        at = self.get_deadline()
+        if at is None:
+            self.fetch_query(query, on_result)
+            return
+
+        data_source_executor = self.application.settings['executors'][query['data_source']._FF_KEY]
+        state = {'answered': False}
+
+        def on_data(result):
+            if state['answered']:
+                return
+            state['answered'] = True
+            data_source_executor.io_loop.remove_timeout(timeout)
+            on_result(result)
+
+        def on_deadline():
+            # the data source call is still running
+            if state['answered']:
+                return
+            state['answered'] = True
+            width = len(query['sources'])
+            on_result(series.Series([], [[]] * width, missing=range(width)))
+
+        timeout = data_source_executor.io_loop.add_timeout(at, on_deadline)
+        self.fetch_query(query, on_data, deadline=deadlines.Deadline(at - DEADLINE_MARGIN))
+
+    def fetch_query(self, query, callback, deadline=None):
+        """Gets the data for a query from plan_data_query, passing a
+        series.Series of the data source's result to callback.
+
+        Identical queries that miss the cache while a fetch is in flight
+        share that fetch. With a firefly.deadlines.Deadline, a fetch started
+        here runs with it; its partial results only go to this caller and
+        aren't cached, and the others sharing the fetch try again by their
+        own deadlines (see fetch_data).
+        """
+        settings = self.application.settings
+        with timing.of(self.request).phase('cache'):
+            cached = self.get_cached(query['key'])
+        if cached is not None:
+            callback(cached)
+            return
+
+        def fetch(on_result, on_error):
+            def on_data(result):
+                # anything raised here has to reach every waiter, or the
+                # ones after us would wait on this fetch forever
+                try:
+                    missing = sorted(deadline.missing) if deadline is not None else []
+                    if not missing:
+                        self.put_cached(query['key'], result, query['ttl'])
+                except Exception:
+                    on_error(sys.exc_info())
+                    return
+                on_result((result, missing, deadline))
+            # decoded and downsampled on the executor
+            self.run_data_source(query['data_source'], 'data',
+                (query['sources'], query['start'], query['end'], query['width']),
+                on_data, on_error, deadline, transform=functools.partial(downsample.from_result,
+                    sources=len(query['sources']), width=query['width'],
+                    algorithm=query['downsample']))
+
+        def on_fetched(fetched):
+            result, missing, fetch_deadline = fetched
+            if not missing:
+                callback(result)
+            elif fetch_deadline is deadline:
+                callback(result.with_missing(missing))
+            elif deadline is None or not deadline.expired():
+                # cut short by the deadline of whoever started the fetch
+                self.fetch_query(query, callback, deadline)
+            # otherwise fetch_data is answering at our own deadline
+
+        settings['data_in_flight'].run(query['key'], fetch, on_fetched)
+
 
 class DataHandler(GraphBaseHandler):
-    """Handler for json graph data"""
+    """Handler for json graph data
+
+    Clients refreshing a graph can pass the X-Firefly-Cursor of their last
+    response as `cursor` (or a timestamp as `since`) to only get the points
+    from there on, which replace any points they have at or after the first
+    timestamp in the response. The last couple of points they already have
+    are sent again, since they may have been revised by the data source.
+
+    With a `deadline` (in seconds), or the `request_deadline` setting, the
+    response is sent by then with whatever data has arrived; the positions
+    of the sources missing their data are listed in X-Firefly-Missing.
+    """
 
+    @tornado.web.asynchronous
     @token_authed
     def get(self):
-        params = self.get_params()
-        data = params['data_source'].data(
-            params['sources'],
-            params['start'],
-            params['end'],
-            params['width'])
+        self.data_format = self.get_data_format()
+        self.get_params()
+        self.fetch_data(self.params, self._on_data)
+
+    def _on_data(self, data):
+        if len(data):
+            cursor = data.timestamps[-1]
+        else:
+            cursor = self.params['since']
+        if cursor is not None:
+            self.set_header("X-Firefly-Cursor", str(cursor))
+        if data.missing:
+            # the positions of the sources which didn't make the deadline
+            self.set_header("X-Firefly-Missing", ','.join(str(pos) for pos in data.missing))
+        self.set_header("Content-Type", series.FORMATS[self.data_format][0])
+        self.set_header("Cache-Control", "no-cache, must-revalidate")
+        self.set_header("Access-Control-Allow-Origin", "*")
+        self.set_header("Access-Control-Expose-Headers", "X-Firefly-Cursor, X-Firefly-Missing")
+        self.set_header("Vary", "Accept")
+        with timing.of(self.request).phase('encode'):
+            body = data.encode(self.data_format)
+        self.finish(body)
 
+
+class StreamHandler(DataHandler):
+    """Long-polling handler for live graphs; see firefly.streaming.
+
+    Takes the same arguments as /data, with `zoom` (the length of the
+    window in seconds) in place of start and end. Answers as soon as there
+    are points after `cursor`, which is left out on the first request.
+    """
+
+    @tornado.web.asynchronous
+    @token_authed
+    def get(self):
+        self.data_format = self.get_data_format()
+        self.get_params()
+        zoom = self.params['options']['zoom']
+        if self.params['data_source'] is None or zoom <= 0:
+            raise tornado.web.HTTPError(400, "Streaming needs sources and a zoom")
+        algorithm = self.params['downsample'] or self.application.settings.get(
+            'downsample', downsample.DEFAULT_ALGORITHM)
+        if algorithm not in downsample.ALGORITHMS:
+            raise tornado.web.HTTPError(400, "Unknown downsampling algorithm %s" % algorithm)
+
+        group = self.application.settings['streams'].group(self.params['data_source'],
+            self.params['sources'], zoom, self.params['width'], algorithm)
+        try:
+            self._cancel = group.wait(self.params['since'], self._on_data)
+        except streaming.TooManySubscribers:
+            self.set_status(503)
+            self.set_header("Retry-After", str(group.interval))
+            self.finish()
+
+    def on_connection_close(self):
+        if getattr(self, '_cancel', None) is not None:
+            self._cancel()
+
+
+class DataBatchHandler(GraphBaseHandler):
+    """Handler for the data of many graphs in a single request.
+
+    Takes a POSTed JSON list of queries, each an object with the `sources`,
+    `start`, `end` and `width` (and optionally the `downsample` and `cursor`)
+    that /data takes, and returns a JSON list of the data for each query, in
+    order. Queries which hit the same data source and window are fetched
+    together in a single data source call.
+
+    A query with `graph` set gets the object /graph would send for it
+    instead of just its data, so that a dashboard can refresh all of its
+    graphs with one request per data server. The data for each query can be
+    sent in any of the JSON wire formats, chosen with the `format` argument
+    as for /data.
+    """
+
+    @tornado.web.asynchronous
+    @token_authed
+    def post(self):
+        self.data_format = self.get_argument('format', 'json')
+        if series.FORMATS.get(self.data_format, (None,))[0] != 'application/json':
+            raise tornado.web.HTTPError(400, "Unsupported batch data format %s" % self.data_format)
+
+        with timing.of(self.request).phase('parse'):
+            self._graphs = self._parse_batch()
+        queries = [self.plan_data_query(graph['data_source'], graph['sources'], graph['start'],
+            graph['end'], graph['width'], graph['since'], graph['downsample'])
+            for graph in self._graphs]
+
+        self._queries = queries
+        self._results = [None] * len(queries)
+        self._extras = [{} for _ in queries]
+        self._pending = len(queries) + sum(1 for graph in self._graphs if graph['graph'])
+
+        for idx, graph in enumerate(self._graphs):
+            if graph['graph']:
+                self.run_meta(graph, 'meta', functools.partial(self._on_query_meta, idx))
+                if 'annotations' in self.settings:
+                    self._extras[idx]['annotations'] = self.get_annotations(graph)
+
+        # Group the queries we can't answer from the cache by what the data
+        # source will be asked for, apart from the sources
+        groups = {}
+        group_order = []
+        for idx, query in enumerate(queries):
+            data = self.get_cached(query['key'])
+            if data is not None:
+                self._on_query_data(idx, data)
+                continue
+            group_key = (query['data_source']._FF_KEY, query['start'], query['end'], query['width'])
+            if group_key not in groups:
+                groups[group_key] = []
+                group_order.append(group_key)
+            groups[group_key].append(idx)
+
+        for group_key in group_order:
+            self._fetch_group([queries[idx] for idx in groups[group_key]], groups[group_key])
+
+        if not queries:
+            self._finish_batch()
+
+    def options(self):
+        # CORS preflight, since browsers won't POST JSON cross-origin without
+        self.set_header("Access-Control-Allow-Origin", "*")
+        self.set_header("Access-Control-Allow-Methods", "POST")
+        self.set_header("Access-Control-Allow-Headers", "Content-Type")
+
+    def _parse_batch(self):
+        """Parses the POSTed queries into the params of each graph (see
+        get_params), answering 400 if they are malformed."""
+        data_sources_by_key = self.application.settings['data_sources_by_key']
+        graphs = []
+        try:
+            raw_queries = json.loads(self.request.body)
+            if not isinstance(raw_queries, list):
+                raise TypeError("Not a list of queries")
+            for raw_query in raw_queries:
+                data_source, sources = parse_sources(raw_query['sources'], data_sources_by_key)
+                since = raw_query.get('cursor')
+                algorithm = raw_query.get('downsample')
+                if algorithm is not None and not isinstance(algorithm, basestring):
+                    raise TypeError("downsample must be a string")
+                graphs.append({
+                    'data_source': data_source,
+                    'sources': sources,
+                    'start': int(raw_query.get('start', 0)),
+                    'end': int(raw_query.get('end', 0)),
+                    'width': int(raw_query.get('width', 0)),
+                    'since': int(since) if since is not None else None,
+                    'downsample': algorithm,
+                    'graph': bool(raw_query.get('graph')),
+                })
+        except (ValueError, TypeError, KeyError, IndexError, AttributeError):
+            raise tornado.web.HTTPError(400, "Invalid batch query")
+        return graphs
+
+    def _fetch_group(self, group_queries, idxs):
+        """Fetches the data for queries sharing a data source and window with
+        a single call for all of their sources."""
+        if len(group_queries) == 1:
+            self.fetch_query(group_queries[0], functools.partial(self._on_query_data, idxs[0]))
+            return
+
+        all_sources = []
+        positions = {}
+        for query in group_queries:
+            for source in query['sources']:
+                if tuple(source) not in positions:
+                    positions[tuple(source)] = len(all_sources)
+                    all_sources.append(source)
+
+        def on_group_data(results):
+            for idx, query, result in zip(idxs, group_queries, results):
+                self.put_cached(query['key'], result, query['ttl'])
+                self._on_query_data(idx, result)
+
+        first = group_queries[0]
+        # split up and downsampled per query on the executor, since lttb
+        # depends on all of a query's series
+        self.run_data_source(first['data_source'], 'data',
+            (all_sources, first['start'], first['end'], first['width']), on_group_data,
+            transform=functools.partial(_split_batch_result, sources=len(all_sources),
+                splits=[([positions[tuple(source)] for source in query['sources']],
+                    query['width'], query['downsample']) for query in group_queries]))
+
+    def _on_query_data(self, idx, data):
+        data = data.between(*self._queries[idx]['window'])
+        self._results[idx] = data
+        if self._graphs[idx]['graph']:
+            self._extras[idx]['cursor'] = (data.timestamps[-1] if len(data)
+                else self._graphs[idx]['since'])
+            self._extras[idx]['missing'] = list(data.missing)
+        self._on_part()
+
+    def _on_query_meta(self, idx, meta):
+        self._extras[idx].update(meta)
+        self._on_part()
+
+    def _on_part(self):
+        self._pending -= 1
+        if not self._pending:
+            self._finish_batch()
+
+    def _finish_batch(self):
+        if self._finished:
+            # one of the fetches failed, and answered the request
+            return
         self.set_header("Content-Type", 'application/json')
         self.set_header("Cache-Control", "no-cache, must-revalidate")
         self.set_header("Access-Control-Allow-Origin", "*")
-        self.write(data)
+        with timing.of(self.request).phase('encode'):
+            parts = []
+            for graph, data, extras in zip(self._graphs, self._results, self._extras):
+                encoded = data.encode(self.data_format)
+                if graph['graph']:
+                    # the data is encoded already, as for /graph
+                    encoded = '{"data": %s, %s' % (encoded, json.dumps(extras)[1:])
+                parts.append(encoded)
+            body = "[%s]" % ",".join(parts)
+        self.finish(body)
 
 
 class GraphLegendHandler(GraphBaseHandler):
     """Handler for the legend data for a given graph"""
 
+    @tornado.web.asynchronous
     @token_authed
     def get(self):
         params = self.get_params()
-        svc = params['data_source'].legend(params['sources'])
+        self.run_meta(params, 'legend', self._on_legend)
 
+    def _on_legend(self, svc):
         self.set_header('Content-Type', 'application/json')
         self.set_header("Cache-Control", "no-cache, must-revalidate")
         self.set_header("Access-Control-Allow-Origin", "*")
-        self.write(json.dumps({'legend': svc}))
+        self.finish(json.dumps({'legend': svc}))
 
 
 class GraphTitleHandler(GraphBaseHandler):
     """Handler for the title data for a given graph"""
 
+    @tornado.web.asynchronous
     @token_authed
     def get(self):
         params = self.get_params()
-        title = params['data_source'].title(params['sources'])
+        self.run_meta(params, 'title', self._on_title)
 
+    def _on_title(self, title):
         self.set_header('Content-Type', 'application/json')
         self.set_header("Cache-Control", "no-cache, must-revalidate")
         self.set_header("Access-Control-Allow-Origin", "*")
-        self.write(json.dumps({'title': title}))
+        self.finish(json.dumps({'title': title}))
 
-class AnnotationsHandler(GraphBaseHandler):
-    """Handler to provide annotations data for a graph"""
 
+class GraphMetaHandler(GraphBaseHandler):
+    """Handler for the legend and title of a given graph together.
+
+    Both only depend on the sources, so they are computed once per set of
+    sources (see DataSource.meta) and then served from the caches. Responses
+    carry an ETag, so a client refreshing a graph which still has the same
+    legend and title gets a 304 without a body.
+    """
+
+    @tornado.web.asynchronous
     @token_authed
     def get(self):
         params = self.get_params()
+        self.run_meta(params, 'meta', self._on_meta)
 
-        cursor = self.settings["db"].cursor()
-
-        annotations_rows = cursor.execute('SELECT type, description, time, id FROM annotations WHERE time >= ? and time <= ? ORDER BY time DESC LIMIT ?',
-                                          (params['start'], params['end'], ANNOTATIONS_CUT_OFF))
-
+    def _on_meta(self, meta):
+        self.set_header('Content-Type', 'application/json')
+        self.set_header("Cache-Control", "no-cache, must-revalidate")
+        self.set_header("Access-Control-Allow-Origin", "*")
+        self.set_header("Access-Control-Expose-Headers", "Etag")
+        # sorted, so that the ETag tornado computes from the body is the
+        # same in every worker
+        self.finish(json.dumps(meta, sort_keys=True))
+
+class GraphHandler(GraphBaseHandler):
+    """Handler for everything needed to draw a graph in one request.
+
+    Takes the arguments of /data (and the `type` arguments of /annotations)
+    and returns a JSON object of the `data` in the JSON `format` asked for,
+    its `cursor` and the positions of the sources `missing` their data (see
+    DataHandler), the `legend` and `title` and, if the
+    server keeps annotations, the `annotations`. The data and the legend and
+    title are fetched concurrently.
+    """
+
+    @tornado.web.asynchronous
+    @token_authed
+    def get(self):
+        self.data_format = self.get_argument('format', 'json')
+        if series.FORMATS.get(self.data_format, (None,))[0] != 'application/json':
+            raise tornado.web.HTTPError(400, "Unsupported graph data format %s" % self.data_format)
+        params = self.get_params()
+        if params['data_source'] is None:
+            raise tornado.web.HTTPError(400, "No sources given")
+
+        self._graph = {}
+        self._pending = 2
+        self.fetch_data(params, self._on_data)
+        self.run_meta(params, 'meta', self._on_meta)
+        if 'annotations' in self.settings:
+            self._graph['annotations'] = self.get_annotations(params)
+
+    def _on_data(self, data):
+        with timing.of(self.request).phase('encode'):
+            self._data = data.encode(self.data_format)
+        self._graph['cursor'] = data.timestamps[-1] if len(data) else self.params['since']
+        self._graph['missing'] = list(data.missing)
+        self._on_part()
+
+    def _on_meta(self, meta):
+        self._graph.update(meta)
+        self._on_part()
+
+    def _on_part(self):
+        self._pending -= 1
+        if self._pending:
+            return
         self.set_header('Content-Type', 'application/json')
         self.set_header("Cache-Control", "no-cache, must-revalidate")
         self.set_header("Access-Control-Allow-Origin", "*")
+        # the data is already encoded
+        self.finish('{"data": %s, %s' % (self._data, json.dumps(self._graph)[1:]))
 
-        keys = [desc[0] for desc in cursor.description]
-        # This funky comprehension(s) associates a key with each value in each row
-        # giving us a nice list of dicts instead of just a list of tuples
-        # should help debugging and clarity on the javascript side
-        annotations = [dict((key, value) for key, value in zip(keys, row)) for row in cursor]
 
-        cursor.close()
+class AnnotationsHandler(GraphBaseHandler):
+    """Handler to provide annotations data for a graph
 
-        self.write(json.dumps(annotations))
+    Annotations are clustered into one per pixel of the graph's `width`
+    (see AnnotationIndex.cluster), and can be limited to some types by
+    passing one or more `type` arguments.
+    """
+
+    @token_authed
+    def get(self):
+        rows = self.get_annotations(self.get_params())
+
+        self.set_header('Content-Type', 'application/json')
+        self.set_header("Cache-Control", "no-cache, must-revalidate")
+        self.set_header("Access-Control-Allow-Origin", "*")
+
+        self.write(json.dumps(rows))
 
 class AddAnnotationHandler(tornado.web.RequestHandler):
     """Handler to take POSTs to add annotations to the database."""
@@ -192,20 +767,74 @@ class AddAnnotationHandler(tornado.web.RequestHandler):
             description: A string with additional details about the event that this annotation represents
             time: An floating-point number of seconds representing the time at which the event occurred.
         """
-        an_type, an_desc, an_time = ((self.get_argument(param) for param in ('type', 'description', 'time')))
-        an_time = float(an_time)
-        if not self.TYPE_RE.match(an_type):
-            raise tornado.httpclient.HTTPError(400, "Invalid annotation type specified.")
-        if not self.DESCRIPTION_RE.match(an_desc):
-            raise tornado.httpclient.HTTPError(400, "Invalid annotation description specified.")
+        an_type, an_desc, an_time = self.validate(*(self.get_argument(param) for param in ('type', 'description', 'time')))
 
         # Insert this annotation into the DB
         # Note that SQLite takes care of the sanitation here for us, so this isn't quite as scary as it looks
         self.settings['db'].execute("INSERT INTO annotations (type, description, time) VALUES (?,?,?)", (an_type, an_desc, an_time))
+        self.settings['annotations'].added()
 
         # It's comforting to know things went alright
         self.write(json.dumps({"status": "ok"}))
 
+    def validate(self, an_type, an_desc, an_time):
+        """Checks the parts of an annotation, returning them as a row to
+        insert or raising a 400."""
+        try:
+            an_time = float(an_time)
+        except (TypeError, ValueError):
+            raise tornado.web.HTTPError(400, "Invalid annotation time specified.")
+        if not isinstance(an_type, basestring) or not self.TYPE_RE.match(an_type):
+            raise tornado.web.HTTPError(400, "Invalid annotation type specified.")
+        if not isinstance(an_desc, basestring) or not self.DESCRIPTION_RE.match(an_desc):
+            raise tornado.web.HTTPError(400, "Invalid annotation description specified.")
+        return an_type, an_desc, an_time
+
+
+class AddAnnotationsHandler(AddAnnotationHandler):
+    """Handler to take POSTs of many annotations at once.
+
+    The body is either a JSON list or newline-delimited JSON (NDJSON) of
+    objects with the `type`, `description` and `time` /add_annotation takes.
+    Either all of the annotations are valid and added, or none are. Rows are
+    committed in batches with those of other requests (see
+    firefly.annotations.AnnotationWriter), and the response is sent once
+    they are in.
+    """
+
+    @tornado.web.asynchronous
+    @token_authed
+    def post(self):
+        rows = []
+        for idx, annotation in enumerate(self._parse_body()):
+            if not isinstance(annotation, dict):
+                raise tornado.web.HTTPError(400, "Annotation %d is not an object" % idx)
+            try:
+                rows.append(self.validate(*(annotation.get(param) for param in ('type', 'description', 'time'))))
+            except tornado.web.HTTPError, e:
+                raise tornado.web.HTTPError(400, "Annotation %d: %s" % (idx, e.log_message))
+
+        if not rows:
+            self._on_added(rows)
+            return
+        self.settings['annotation_writer'].add(rows, functools.partial(self._on_added, rows))
+
+    def _parse_body(self):
+        body = self.request.body.strip()
+        try:
+            if body.startswith('[') and 'ndjson' not in self.request.headers.get('Content-Type', ''):
+                annotations = json.loads(body)
+                if not isinstance(annotations, list):
+                    raise ValueError("Not a list")
+                return annotations
+            return [json.loads(line) for line in body.splitlines() if line.strip()]
+        except ValueError:
+            raise tornado.web.HTTPError(400, "Invalid JSON or NDJSON list of annotations")
+
+    def _on_added(self, rows):
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps({"status": "ok", "added": len(rows)}))
+
 class PingHandler(GraphBaseHandler):
     """Handler for monitoring"""
 
@@ -213,6 +842,23 @@ class PingHandler(GraphBaseHandler):
         self.write('pong\n')
 
 
+class CacheStatsHandler(tornado.web.RequestHandler):
+    """Reports the counters of this worker's data cache, and of the cache
+    shared by every worker under `shared`, for sizing them"""
+
+    def get(self):
+        stats = self.application.settings['data_cache'].stats()
+        if self.application.settings.get('shared_cache') is not None:
+            stats['shared'] = self.application.settings['shared_cache'].stats()
+        in_flight = self.application.settings['data_in_flight']
+        stats['fetches'] = in_flight.fetches
+        stats['coalesced'] = in_flight.coalesced
+        stats['streams'] = self.application.settings['streams'].stats()
+
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(stats))
+
+
 def parse_sources(sources, data_sources_by_key):
     data_source_name = sources[0][0]
     ds = data_sources_by_key[data_source_name]
@@ -220,39 +866,101 @@ def parse_sources(sources, data_sources_by_key):
     return ds, srcs
 
 
-def initialize_data_server(config_global, secret_key=None):
-    config = config_global["data_server"]
-
-    # connect to the database to store annotation in
-    # I kind of hate having the schema for this DB here, but I'm going to leave it for to retain parity with ui_server.py
-    db_conn = sqlite3.connect(config['db_file'], isolation_level=None)
-    db_conn.execute("""
-        create table if not exists annotations (
-            id integer primary key autoincrement,
-            type integer not null,
-            description text not null,
-            time float not null
-        )""")
-    db_conn.execute("create index if not exists time on annotations(time)")
-
-    config['db'] = db_conn
-    config["secret_key"] = secret_key
+def _split_batch_result(data, sources, splits):
+    """Decodes what a data call made for several queries of a batch returned
+    for its `sources` sources, returning the Series of each query: one for
+    each (positions of its sources in the call, width, downsampling
+    algorithm) of splits. The transform of batched data calls (see
+    DataBatchHandler)."""
+    with timing.phase('decode'):
+        result = series.Series.from_result(data, sources)
+    with timing.phase('downsample'):
+        return [downsample.downsample(result.select(positions), width, algorithm)
+            for positions, width, algorithm in splits]
+
+
+def log_request(handler):
+    """Records the metrics of a finished request and logs it, to the slow
+    request log too if it took longer than `slow_request_threshold`."""
+    metrics.log_request(handler)
+    timing.log_slow_request(handler, handler.settings.get(
+        'slow_request_threshold', timing.DEFAULT_SLOW_REQUEST_THRESHOLD))
+
+
+def make_application(config):
+    """Builds the data server application for the given data server config"""
+    config['data_cache'] = cache.ResultCache(config.get('cache_max_bytes', cache.DEFAULT_MAX_BYTES))
+    config['data_in_flight'] = cache.SingleFlight()
+    shared_max_bytes = config.get('shared_cache_max_bytes', cache.DEFAULT_SHARED_MAX_BYTES)
+    if shared_max_bytes:
+        # the directory is shared by the workers forked from this process
+        config['shared_cache'] = cache.SharedCache(
+            config.get('shared_cache_dir') or cache.default_shared_directory(config.get('port')),
+            shared_max_bytes)
+        config['shared_cache'].clear()
+    if 'db' in config:
+        # loaded before forking, so the workers share it
+        config['annotations'] = annotations.AnnotationIndex(config['db'])
+        config['annotation_writer'] = annotations.AnnotationWriter(config['db'], config['annotations'],
+            int(config.get('annotations_flush_rows', annotations.DEFAULT_FLUSH_ROWS)),
+            float(config.get('annotations_flush_interval', annotations.DEFAULT_FLUSH_INTERVAL)))
+    transforms = compression.transforms(config)
+    # counts the bytes sent, after compression but before chunking
+    config['transforms'] = ([timing.ServerTimingTransform] + transforms[:-1] +
+        [metrics.ResponseSizeTransform] + transforms[-1:])
+    config['log_function'] = log_request
+    # the directory is shared by the workers forked from this process
+    metrics.registry.set_directory(config.get('metrics_dir') or metrics.default_directory(config.get('port')))
 
-    # init the application instance
     application = tornado.web.Application([
         (r"/data", DataHandler),
+        (r"/stream", StreamHandler),
+        (r"/data/batch", DataBatchHandler),
         (r"/legend", GraphLegendHandler),
         (r"/title", GraphTitleHandler),
+        (r"/meta", GraphMetaHandler),
+        (r"/graph", GraphHandler),
         (r"/ping", PingHandler),
+        (r"/cache_stats", CacheStatsHandler),
+        (r"/metrics", metrics.MetricsHandler),
         (r"/annotations", AnnotationsHandler),
         (r"/add_annotation", AddAnnotationHandler),
+        (r"/add_annotations", AddAnnotationsHandler),
         (r"/sources", SourcesHandler)], **config)
+    application.settings['streams'] = streaming.StreamHub(application.settings, REVISED_STEPS)
+    return application
+
+
+def start_executors(data_sources_by_key, io_loop=None):
+    """Starts an executor for each data source, keyed like data_sources_by_key"""
+    return dict((key, executor.executor_for_data_source(ds, io_loop=io_loop))
+        for key, ds in data_sources_by_key.iteritems())
+
+
+def initialize_data_server(config_global, secret_key=None):
+    config = config_global["data_server"]
+
+    # connect to the database to store annotation in
+    config['db'] = annotations.connect(config['db_file'])
+    config["secret_key"] = secret_key
+
+    # init the application instance
+    application = make_application(config)
 
     # start the main server
     http_server = tornado.httpserver.HTTPServer(application)
     http_server.bind(config["port"])
     http_server.start(0)
 
+    # Executor threads and processes don't survive a fork, so they have to
+    # be started by each worker after http_server.start forked it
+    application.settings['executors'] = start_executors(config['data_sources_by_key'])
+    # ...and neither do SQLite connections
+    db_conn = annotations.connect(config['db_file'])
+    application.settings['db'] = db_conn
+    application.settings['annotations'].db_conn = db_conn
+    application.settings['annotation_writer'].db_conn = db_conn
+
     # setup logging
     util.setup_logging(config_global)
 
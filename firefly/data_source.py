@@ -1,6 +1,9 @@
 import colorsys
 import logging
 
+from firefly import executor
+from firefly import metrics
+
 
 class DataSource(object):
     """Base class for Firefly Data Sources"""
@@ -15,6 +18,15 @@ class DataSource(object):
     def __init__(self, *args, **kwargs):
         self.logger = logging.getLogger(__name__)
         self.ui_exclude = bool(kwargs.get('ui_exclude', False))
+        # How the data server runs calls into this data source; see
+        # firefly.executor for the available options.
+        self.executor_type = kwargs.get('executor', executor.DEFAULT_EXECUTOR)
+        self.executor_workers = int(kwargs.get('executor_workers', executor.DEFAULT_EXECUTOR_WORKERS))
+        # calls which may wait for a worker; null for no limit
+        self.executor_queue = kwargs.get('executor_queue', executor.DEFAULT_EXECUTOR_QUEUE)
+        if self.executor_queue is not None:
+            self.executor_queue = int(self.executor_queue)
+        self.executor_retry_after = int(kwargs.get('executor_retry_after', executor.DEFAULT_EXECUTOR_RETRY_AFTER))
 
     def list_path(self, path):
         """given an array of path components, list the (presumable) directory"""
@@ -26,6 +38,26 @@ class DataSource(object):
     def data(self):
         raise NotImplemented
 
+    def count_backend_call(self, kind):
+        """Counts a call out to a backend ('subprocess' or 'http') in the
+        data server's metrics."""
+        metrics.BACKEND_CALLS.inc(data_source=type(self).__name__, kind=kind)
+
+    def step(self, sources, start, end, width):
+        """Returns the spacing, in seconds, of the points data() returns for
+        the given request.
+
+        The data server aligns the windows of its cache keys to this step, so
+        that requests a few seconds apart share cached results, and sends
+        clients refreshing a graph the last couple of steps again. The
+        default assumes the data source returns about `width` points; data
+        sources which know the real resolution of their series can override
+        this.
+        """
+        if width <= 0:
+            return 1
+        return max(1, (end - start) // width)
+
     def _svc(self, sources):
         """Given a set of sources, generates legend information for the sources.
 
@@ -78,6 +110,11 @@ class DataSource(object):
             thing = common_source_prefix(sources, splitter=self.path_splitter)
             return thing
 
+    def meta(self, sources):
+        """Provides the legend and title for a set of sources in one call, as
+        a dict of the two."""
+        return {'legend': self.legend(sources), 'title': self.title(sources)}
+
 
 def common_source_prefix(sources, splitter="."):
     """Given a list of sources (where each source is a list itself),
@@ -5,16 +5,50 @@ This data source is essentially a wrapper data source that allows one to run
 several Firefly data servers in a given environment to form a single 'logical'
 data server. This data source just speaks the Firefly data protocol to the
 other data servers to collect data.
+
+The data servers are called concurrently, each on a thread of its own, so a
+request spanning several of them takes as long as the slowest rather than
+all of them in turn, and over keep-alive connections (see
+firefly.http_pool) so that only the first call to a data server pays for
+connecting to it.
+
+Which data servers serve a stat key (the first item of a source) is looked
+up in a RoutingTable built from the root listings of all of them. A data
+server can be given replicas serving the same data, in which case each
+request goes to the best of them and is hedged to another if it is slow (see
+firefly.replicas).
+
+Responses are decoded as they are read, a row at a time, straight into the
+columns of a Series, and the results of the data servers merged column by
+column; neither their bodies nor their parsed rows are ever held whole.
 """
-from collections import defaultdict
+from __future__ import with_statement
+
+import contextlib
 import json
+import os
+import Queue
+import socket
+import sys
+import threading
+import time
 from urllib import urlencode
-from urllib2 import urlopen
 from urllib2 import URLError
 
+from firefly import deadlines
+from firefly import http_pool
+from firefly.http_pool import urlopen
+from firefly import metrics
+from firefly import replicas
+from firefly import series
+from firefly import timing
 from firefly import util
 import firefly.data_source
 
+DEFAULT_ROUTING_REFRESH_INTERVAL = 300
+# bytes of a data server's response to read at a time
+READ_SIZE = 64 * 1024
+
 
 class AggregatingDataSource(firefly.data_source.DataSource):
     """Aggregates one or more other data servers into a single logical data
@@ -42,6 +76,21 @@ class AggregatingDataSource(firefly.data_source.DataSource):
         * name_is_hash (optional): Whether or not the string in
             `data_source_name` is an internal hash of the data source name.
             Defaults to False.
+        * replicas (optional): The URLs of other data servers serving the
+            same data as `data_server_url`, with the same data source and
+            secret key.
+    * max_connections_per_host (optional) - How many connections to keep
+        open to each data server at most; calls beyond that wait for one.
+        Defaults to 4.
+    * routing_refresh_interval (optional) - How often (in seconds) to list
+        the root paths of the data sources again to find out which of them
+        serve which stat keys. Defaults to 300.
+    * hedge_percentile (optional) - Which percentile of a data server's
+        recent response times to wait for before asking one of its replicas
+        too; 0 never does. Defaults to 95.
+    * hedge_delay (optional) - How long (in seconds) to wait before asking
+        a replica while a data server hasn't answered enough requests for
+        the percentile. Defaults to 1.
     """
 
     DESC = "Aggregates other data sources"
@@ -56,9 +105,13 @@ class AggregatingDataSource(firefly.data_source.DataSource):
 
         self.DESC = kwargs.get('desc', self.DESC)
 
-        # Keeps track of the first entry in a key, mapping it to a specific data
-        # source. The first instance of a key is always authoritative.
-        self.key_mapping_cache = {}
+        self.http_pool = http_pool.HTTPPool(
+            int(kwargs.get('max_connections_per_host', http_pool.DEFAULT_MAX_PER_HOST)))
+
+        hedge_percentile = float(kwargs.get('hedge_percentile', replicas.DEFAULT_HEDGE_PERCENTILE))
+        hedge_delay = float(kwargs.get('hedge_delay', replicas.DEFAULT_HEDGE_DELAY))
+        # data_server_url -> the replicas.ReplicaGroup of it and its replicas
+        self.replica_groups = {}
 
         data_sources = kwargs['data_sources']
         for data_source in data_sources:
@@ -77,30 +130,34 @@ class AggregatingDataSource(firefly.data_source.DataSource):
                 "data_source_hash": data_source_hash,
                 "secret_key": secret_key
             })
+            self.replica_groups[data_server_url] = replicas.ReplicaGroup(
+                [data_server_url] + list(data_source.get('replicas', [])),
+                hedge_percentile=hedge_percentile, hedge_delay=hedge_delay)
+
+        self.routing_table = RoutingTable(self.data_sources, self._list_roots,
+            float(kwargs.get('routing_refresh_interval', DEFAULT_ROUTING_REFRESH_INTERVAL)))
 
     def list_path(self, path):
         """Provides a list of paths available for this data source.
 
-        If no path is provided, list all the root paths from all data sources.
+        If no path is provided, list all the root paths from all data sources
+        (asking them all at once), and update the routing table with them.
         If a path is provided, we'll list the sub-paths available only from
-        the pertinent data source. Fills out self._key_mapping_cache as it
-        goes.
+        the pertinent data source.
         """
         contents = []
 
         if not path:
-            for data_source in self.data_sources:
-                paths = self._request_paths_from_ds(data_source, path)
+            listings = self._list_roots()
+            for paths in listings:
                 contents.extend([result_path for result_path in paths
                     if result_path not in contents])
-
-                for result_path in paths:
-                    stat_key = result_path['name']
-                    if stat_key not in self.key_mapping_cache:
-                        self.key_mapping_cache[stat_key] = data_source
+            self.routing_table.update(listings)
         else:
             stat_key = path[0]
             data_source = self._data_source_for_stat_key(stat_key)
+            if data_source is None:
+                return contents
             paths = self._request_paths_from_ds(data_source, path)
             contents.extend(paths)
 
@@ -110,45 +167,34 @@ class AggregatingDataSource(firefly.data_source.DataSource):
         """Provides data from the appropriate data sources for the given
         sources.
 
-        The way this method works is a little bit convoluted, since it
-        attempts to batch requests so that each data source is only contacted
-        once. Result information is kept in a dictionary that looks like:
-        {
-            'timestamp': {
-                0: 'value',
-                1: 'value',
-                ...
-                len(sources): 'value'
-            },
-            'timestamp': ...
-            ...
-        }
-
         Sources are grouped by the data source from which their data can be
-        retrieved. After the batched request for data from the data source,
-        the retrieved data is exploded back into this result dictionary by
-        placing each value retrieved into the sub-dictionary for the timestamp
-        under the key corresponding to that source's position in the original
-        `sources` argument. This results dictionary is then collapsed down
-        into a format that the firefly data server can speak.
+        retrieved, so that each data source is only contacted once, and the
+        data sources are all asked for their group at once. Each answers
+        with a firefly.series.Series of its group, and those are merged
+        column by column (see firefly.series.merge) into a Series of all the
+        sources, with each source's column at its position in the `sources`
+        argument. The data server takes the Series as it is, so it never goes
+        through the row-oriented JSON format on the way to the client.
+
+        Under a deadline (see firefly.deadlines), data sources are only
+        contacted if there is time left, and are passed what is left as
+        their own deadline. The sources of data sources which weren't heard
+        from in time, or which reported them missing, are marked missing.
         """
         src_count = len(sources)
-        # Create a dictionary which has keys as timestamps and values which
-        # are dictionaries of integers representing the position of the source
-        # in `sources` mapping to a single value, which is the value of the
-        # source in that position at that timestamp.
-        result_data = defaultdict(lambda: dict((i, None) for i in xrange(src_count)))
         # Find the appropriate data source for each source. Each data source
         # in this list corresponds to the data source for the source in the
         # same position in `sources`.
         ds_list = [self._data_source_for_stat_key(source[0]) for source in sources]
-        # Tracks data sources that have already been contacted.
-        complete_ds = []  # list because we can't hash dicts
+        # Tracks data sources that have already been grouped, along with
+        # the positions and sources of their group.
+        requests = []  # list because we can't hash dicts
 
-        # Walk the data source list, keeping track of ones we've already hit
-        # so that we only hit each data source once
+        # Walk the data source list, keeping track of ones we've already
+        # seen so that we only hit each data source once. Sources which no
+        # data source serves are left without data.
         for ds in ds_list:
-            if ds not in complete_ds:
+            if ds is not None and ds not in [request[0] for request in requests]:
                 # Build up a list of positions in `sources` that can be
                 # serviced by this data source.
                 pos_list = [idx for idx, _ in enumerate(sources) if ds_list[idx] == ds]
@@ -156,52 +202,31 @@ class AggregatingDataSource(firefly.data_source.DataSource):
                 # in this list maps to an entry in pos_list, which is this
                 # sources position in the `sources` argument
                 source_list = [source for idx, source in enumerate(sources) if ds_list[idx] == ds]
+                requests.append((ds, pos_list, source_list))
 
-                # Ask for data from this data source for these sources
-                this_data = self._request_data_from_ds(ds, source_list, start, end, width)
-                # Once we get data back, explode the values retrieved back into
-                # result_data for the position each source corresponds to.
-                for data_pt in this_data:
-                    for idx, data_val in enumerate(data_pt['v']):
-                        pos = pos_list[idx]
-                        result_data[data_pt['t']][pos] = data_val
-
-                complete_ds.append(ds)
-
-        # Now create a cogent result which speaks the data_server protocol.
-        # This just basically flattens our result_data dictionary into a list
-        # of dictionaries and flattens the dictionaries of source position->value
-        # into lists of values in the correct order.
-        result_data = [{'t': t, 'v': self._int_dict_to_list(val_dict)}
-            for t, val_dict in sorted(result_data.iteritems(), key=lambda x: x[0])]
-
-        return json.dumps(result_data)
-
-    def _int_dict_to_list(self, d):
-        """Given a dictionary with keys that are integers, 'flattens' the dict
-        into a list with the order specified by the keys of the dict.
-
-        For example, if given:
-            {
-                1: 'a',
-                2: 'b',
-                3: 'c'
-            }
-        this method will return:
-            ['a', 'b', 'c']
-        """
-        # Sort by keys in the dict
-        sorted_items = sorted(d.iteritems(), key=lambda x: x[0])
-        # and flatten into a single list in the sorted order
-        return [item[1] for item in sorted_items]
+        if deadlines.expired():
+            deadlines.mark_missing(xrange(src_count))
+            requests = []
 
-    def _request_paths_from_ds(self, data_source, path):
+        def request_data(ds, pos_list, source_list):
+            # Ask for data from this data source for these sources
+            with deadlines.subset(pos_list):
+                return self._request_data_from_ds(ds, source_list, start, end, width)
+
+        results = _in_parallel(request_data, requests)
+        with timing.phase('merge'):
+            return series.merge(src_count,
+                [(pos_list, this_data) for (_, pos_list, _), this_data in zip(requests, results)])
+
+    def _request_paths_from_ds(self, data_source, path, tried=()):
         """Does the work of retrieving the available paths from the specified
         data source.
 
         If path is falsey, all of the top-level paths that the data source
         can serve are returned. If a path is provided, a regular list_sources
-        request is sent to the underlying data server.
+        request is sent to the underlying data server, and if it fails the
+        next data source serving the path's stat key (other than those in
+        `tried`) is asked instead.
         """
         token = util.generate_access_token(data_source['secret_key'])
         request_path = [data_source['data_source_hash']]
@@ -209,57 +234,54 @@ class AggregatingDataSource(firefly.data_source.DataSource):
         if path:
             request_path.extend(path)
 
-        base_url = '/'.join((data_source['data_server_url'].rstrip('/'), 'sources'))
-
         request_params = urlencode({
             'path': json.dumps(request_path),
             'token': token
         })
 
-        request_path = '?'.join((base_url,
-            request_params))
+        def fetch(data_server_url):
+            base_url = '/'.join((data_server_url.rstrip('/'), 'sources'))
+            self.count_backend_call('http')
+            with timing.phase('http'):
+                response = urlopen('?'.join((base_url, request_params)), pool=self.http_pool)
+                body = response.read()
+            return json.loads(body)
 
         try:
-            response = urlopen(request_path)
-            return json.loads(response.read())
+            return self._call_replicas(data_source, fetch)
         except URLError:
             self.logger.exception("Failed to fetch paths for %s from %s" % (
                 path, data_source['data_server_url']))
-            return []
         except ValueError:
             self.logger.exception("Invalid response received from %s" % data_source['data_server_url'])
-            return []
 
-    def _request_data_from_ds(self, data_source, sources, start, end, width):
+        if path:
+            tried = tuple(tried) + (data_source,)
+            fallback = self._fallback_data_source([path[0]], tried)
+            if fallback is not None:
+                return self._request_paths_from_ds(fallback, path, tried)
+        return []
+
+    def _request_data_from_ds(self, data_source, sources, start, end, width, tried=()):
         """Does the work of retrieving stats data from a given data source.
 
         Sources is a list of sources (which are lists of strings) to retrieve
         stats for; this allows callers to batch requests for data from the same
-        data source into a single request. Data is returned in the same format
-        that the data server returns it in, which is a list of dicts containing
-        two keys: 't' and 'v'. 't' is always the timestamp of the data points,
-        and 'v' is a list of values for time 't'. The values in 'v' are always
-        in the order that they were requested; if sources was ['a', 'b'], 'v'
-        will always be data for 'a', then data for 'b'. Overall, the returned
-        structure looks like so:
-
-        [
-            {
-                't': 10000000,
-                'v': [500, 400, ...]
-            },
-            {
-                't': 10000001,
-                'v': [505, 391, ...]
-            },
-            ...
-        ]
+        data source into a single request. Data is returned as a
+        firefly.series.Series with a column for each source, in the order
+        that they were requested; if sources was ['a', 'b'], the first column
+        will always be data for 'a', then data for 'b'. If the data server
+        (or any of its replicas) can't be reached, the next data source
+        serving all of the sources' stat keys (other than those in `tried`)
+        is asked instead, if there's time left; failing that, the Series has
+        no points.
 
         `start`, `end`, and `width` are all passed along unmodified to the
-        data source.
+        data source, along with the time left before the deadline, if any.
+        Sources the data server reports missing, or all of them if it isn't
+        heard from by the deadline, are marked missing.
         """
         token = util.generate_access_token(data_source['secret_key'])
-        base_url = '/'.join((data_source['data_server_url'].rstrip('/'), 'data'))
 
         ds_hash = data_source['data_source_hash']
         # Sprinkle in the hash of the data source we're talking to so complete
@@ -273,43 +295,266 @@ class AggregatingDataSource(firefly.data_source.DataSource):
             'width': width,
             'token': token
         }
+        deadline = deadlines.current()
+        if deadline is not None:
+            data_params['deadline'] = '%.3f' % max(deadline.remaining(), 0.001)
         encoded_data_params = urlencode(data_params)
 
-        url = '?'.join((base_url, encoded_data_params))
+        def fetch(data_server_url):
+            base_url = '/'.join((data_server_url.rstrip('/'), 'data'))
+            self.count_backend_call('http')
+            with timing.phase('http'):
+                response = urlopen('?'.join((base_url, encoded_data_params)), pool=self.http_pool,
+                    **deadlines.timeout_kwargs())
+                # decoded as it arrives, rather than holding the whole body
+                # and its parsed rows in memory
+                try:
+                    data = series.Series.from_json_chunks(iter(lambda: response.read(READ_SIZE), ''),
+                        len(sources))
+                except Exception:
+                    # don't leave the connection half read
+                    response.close()
+                    raise
+            missing = None
+            if deadline is not None:
+                missing = response.info().getheader('X-Firefly-Missing')
+            return data, missing
 
         try:
-            response = urlopen(url)
-            return json.loads(response.read())
-        except URLError:
+            data, missing = self._call_replicas(data_source, fetch)
+        except (URLError, socket.timeout):
             self.logger.exception("Failed to fetch data for %s from %s" % (
-                source, data_source['data_server_url']))
-            return []
-
+                sources, data_source['data_server_url']))
+            if deadlines.expired():
+                deadlines.mark_missing(xrange(len(sources)))
+                return series.Series([], [[]] * len(sources))
+            tried = tuple(tried) + (data_source,)
+            fallback = self._fallback_data_source(set(source[0] for source in sources), tried)
+            if fallback is not None:
+                return self._request_data_from_ds(fallback, sources, start, end, width, tried)
+            return series.Series([], [[]] * len(sources))
+
+        if missing:
+            deadlines.mark_missing(int(pos) for pos in missing.split(','))
+        return data
+
+    def _call_replicas(self, data_source, fetch):
+        """Returns fetch(url) for the URL of the best replica of the data
+        server of data_source, also calling it for the next best one if the
+        first is slow to return (see firefly.replicas), and falling back on
+        the others in turn for as long as they raise. Once every replica has
+        raised, the exception of the last one is raised.
+        """
+        group = self.replica_groups[data_source['data_server_url']]
+        if len(group) == 1:
+            return fetch(group.replicas[0].url)
+
+        ranked = group.ranked()
+        results = Queue.Queue()
+
+        def attempt(replica):
+            started = time.time()
+            try:
+                result = fetch(replica.url)
+            except Exception:
+                group.failed(replica)
+                results.put((None, sys.exc_info()))
+            else:
+                group.succeeded(replica, time.time() - started)
+                results.put((result, None))
+
+        _start_thread(attempt, ranked[0])
+        tried, pending = 1, 1
+        hedge_after = group.hedge_after(ranked[0])
+        while pending:
+            try:
+                result, exc_info = results.get(timeout=hedge_after)
+            except Queue.Empty:
+                # the first replica is taking a while; ask the next one too
+                metrics.HEDGED_REQUESTS.inc(data_source=type(self).__name__)
+                _start_thread(attempt, ranked[tried])
+                tried, pending, hedge_after = tried + 1, pending + 1, None
+                continue
+
+            pending -= 1
+            if exc_info is None:
+                return result
+            if not pending and tried < len(ranked):
+                _start_thread(attempt, ranked[tried])
+                tried, pending, hedge_after = tried + 1, pending + 1, None
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _list_roots(self):
+        """Lists the root paths of every data source at once, returning the
+        listings in the order of self.data_sources."""
+        return _in_parallel(self._request_paths_from_ds,
+            [(data_source, None) for data_source in self.data_sources])
 
     def _data_source_for_stat_key(self, stat_key):
         """Given a 'top-level' source item (i.e. the first item in a source),
-        returns a data source which can serve data and paths for that key.
+        returns a data source which can serve data and paths for that key,
+        or None if none of them can.
 
-        Checks self.key_mapping_cache first. If there's no entry in that dict,
-        a data source is determined according to _find_data_source_for_stat_key.
-        """
-        if stat_key in self.key_mapping_cache:
-            data_source = self.key_mapping_cache[stat_key]
-        else:
-            data_source = self._find_data_source_for_stat_key(stat_key)
-        return data_source
-
-    def _find_data_source_for_stat_key(self, stat_key):
-        """Given a top-level source item that we don't know an appropriate
-        data source for, checks all the data sources we know about until
-        it finds a data source that can provide source lists and data for
-        that stat key.
+        Of the data sources the routing table has for the key, the first one
+        configured is asked first; the others are only asked when it fails
+        (see _fallback_data_source).
         """
-        for data_source in self.data_sources:
-            top_level_stats = self._request_paths_from_ds(data_source, None)
+        data_sources = self.routing_table.lookup(stat_key)
+        return data_sources[0] if data_sources else None
 
-            if stat_key in [stat['name'] for stat in top_level_stats]:
-                self.key_mapping_cache[stat_key] = data_source
+    def _fallback_data_source(self, stat_keys, tried):
+        """Returns the first data source, other than those in tried, which
+        serves every one of stat_keys, or None if there's none left."""
+        serving = [self.routing_table.lookup(stat_key) for stat_key in stat_keys]
+        for data_source in self.data_sources:
+            if data_source not in tried and all(data_source in ds_list for ds_list in serving):
                 return data_source
-        else:
-            return None
+        return None
+
+
+class RoutingTable(object):
+    """Maps stat keys to the data sources (of an AggregatingDataSource)
+    which serve them, going by the root listing of each data source.
+
+    The table is built the first time it's needed and rebuilt every
+    `refresh_interval` seconds after that, in the background: lookups keep
+    being answered from the old table while a thread lists the data sources
+    again. A lookup of a key which isn't in the table waits for a rebuild,
+    unless the table is less than `miss_refresh_interval` seconds old; all
+    the lookups which come up empty while a rebuild is running wait for that
+    same one. A data source whose listing comes back empty (most likely
+    because it couldn't be reached) keeps the keys it had.
+    """
+
+    miss_refresh_interval = 5
+
+    def __init__(self, data_sources, list_roots, refresh_interval=DEFAULT_ROUTING_REFRESH_INTERVAL,
+            clock=time.time):
+        """list_roots returns the root listing of each of data_sources, in
+        order."""
+        self.data_sources = data_sources
+        self.refresh_interval = refresh_interval
+        self._list_roots = list_roots
+        self._clock = clock
+        # stat key -> the data sources serving it, in configuration order
+        self._routes = {}
+        # the names in the last non-empty listing of each data source
+        self._names = [[] for _ in data_sources]
+        self._refreshed_at = None
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        # set once the rebuild in progress, if any, is done
+        self._refreshing = None
+
+    def lookup(self, stat_key):
+        """Returns the data sources serving stat_key, in configuration
+        order."""
+        if os.getpid() != self._pid:
+            # a rebuild running when this process was forked never finishes
+            # here
+            self._reset()
+
+        if self._refreshed_at is None:
+            self.refresh()
+        elif self._clock() - self._refreshed_at >= self.refresh_interval:
+            self.refresh(wait=False)
+
+        data_sources = self._routes.get(stat_key)
+        if data_sources is None and self._clock() - self._refreshed_at >= self.miss_refresh_interval:
+            self.refresh()
+            data_sources = self._routes.get(stat_key)
+        return data_sources or []
+
+    def refresh(self, wait=True):
+        """Rebuilds the table, unless a rebuild is already running, and
+        waits for it if wait is set."""
+        with self._lock:
+            done = self._refreshing
+            started = done is None
+            if started:
+                done = self._refreshing = threading.Event()
+
+        if started:
+            if wait:
+                self._refresh(done)
+            else:
+                thread = threading.Thread(target=self._refresh, args=(done,))
+                thread.daemon = True
+                thread.start()
+        elif wait:
+            done.wait()
+
+    def _refresh(self, done):
+        try:
+            self.update(self._list_roots())
+        finally:
+            with self._lock:
+                self._refreshing = None
+            done.set()
+
+    def update(self, listings):
+        """Rebuilds the table from the root listing of each data source, in
+        the order of data_sources."""
+        with self._lock:
+            for idx, listing in enumerate(listings):
+                if listing:
+                    self._names[idx] = [path['name'] for path in listing]
+            routes = {}
+            for data_source, names in zip(self.data_sources, self._names):
+                for name in names:
+                    serving = routes.setdefault(name, [])
+                    if data_source not in serving:
+                        serving.append(data_source)
+            self._routes = routes
+            self._refreshed_at = self._clock()
+
+
+def _in_parallel(func, args_list):
+    """Calls func with each of the argument tuples in args_list, each call on
+    a thread of its own, and returns their results in order once all of them
+    have returned. If any of them raised, the first of those exceptions is
+    raised instead.
+
+    The calls run with the deadline and timing of the calling thread (see
+    _start_thread).
+    """
+    if len(args_list) < 2:
+        return [func(*args) for args in args_list]
+
+    results = [None] * len(args_list)
+    errors = [None] * len(args_list)
+
+    def run(idx, args):
+        try:
+            results[idx] = func(*args)
+        except Exception:
+            errors[idx] = sys.exc_info()
+
+    threads = [_start_thread(run, idx, args) for idx, args in enumerate(args_list)]
+    for thread in threads:
+        thread.join()
+
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+    return results
+
+
+def _start_thread(func, *args):
+    """Starts a thread calling func(*args) with the deadline of the calling
+    thread, collecting the phases it times with the calling thread's own
+    (see firefly.deadlines and firefly.timing), and returns it."""
+    deadline = deadlines.current()
+    phases = timing.current()
+
+    def run():
+        with contextlib.nested(timing.collect(phases), deadlines.running(deadline)):
+            func(*args)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
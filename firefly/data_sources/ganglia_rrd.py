@@ -6,6 +6,7 @@ import tornado.web
 import xml.etree.cElementTree as ET
 
 import firefly.data_source
+from firefly import timing
 
 
 class GangliaRRD(firefly.data_source.DataSource):
@@ -66,21 +67,24 @@ class GangliaRRD(firefly.data_source.DataSource):
             defs.append(self._form_def(idx, source))
             lines.append("XPORT:ds%d" % idx)
 
-        pipe = subprocess.Popen(opts + defs + lines, stdout=subprocess.PIPE)
-        xport_stdout, xport_stderr = pipe.communicate()
+        self.count_backend_call('subprocess')
+        with timing.phase('rrdtool'):
+            pipe = subprocess.Popen(opts + defs + lines, stdout=subprocess.PIPE)
+            xport_stdout, xport_stderr = pipe.communicate()
         if pipe.returncode != 0:
             raise tornado.web.HTTPError(500, log_message=xport_stderr)
 
         data = []
         try:
-            for row in ET.fromstring(xport_stdout).findall("data/row"):
-                time = int(row.findtext("t"))
-                values = []
-                for v in row.findall("v"):
-                    value = float(v.text)
-                    values.append("%g" % value if not math.isnan(value) else None)
-                values_string = ",".join(v if v else "null" for v in values)
-                data.append('{"t":%d,"v":[%s]}' % (time, values_string))
+            with timing.phase('parse_xml'):
+                for row in ET.fromstring(xport_stdout).findall("data/row"):
+                    time = int(row.findtext("t"))
+                    values = []
+                    for v in row.findall("v"):
+                        value = float(v.text)
+                        values.append("%g" % value if not math.isnan(value) else None)
+                    values_string = ",".join(v if v else "null" for v in values)
+                    data.append('{"t":%d,"v":[%s]}' % (time, values_string))
         except Exception, e:
             raise tornado.web.HTTPError(500, log_message=str(e))
 
@@ -1,6 +1,8 @@
 from datetime import datetime
 from itertools import izip
+import socket
 from urllib2 import urlopen
+from urllib2 import URLError
 from urlparse import urljoin
 
 try:
@@ -9,6 +11,8 @@ except ImportError:
     import simplejson as json
 
 import firefly.data_source
+from firefly import deadlines
+from firefly import timing
 
 
 class GraphiteHTTP(firefly.data_source.DataSource):
@@ -53,7 +57,9 @@ class GraphiteHTTP(firefly.data_source.DataSource):
             'format': 'treejson',
         }
         find_url = urljoin(self.graphite_url, 'metrics/find/?%s' % '&'.join(['%s=%s' % (k,v) for k,v in params.items()]))
-        find_json = urlopen(find_url).read()
+        self.count_backend_call('http')
+        with timing.phase('http'):
+            find_json = urlopen(find_url).read()
         find_results = json.loads(find_json)
 
         contents = list()
@@ -79,6 +85,10 @@ class GraphiteHTTP(firefly.data_source.DataSource):
         :param end: timestamp like 1391048200
         :param width: ignored
         :return: json string
+
+        Metrics are fetched one at a time; those not fetched by the request's
+        deadline (see firefly.deadlines) are marked missing and come back
+        null.
         """
         # Unfortunately, the most granular unit of time that graphite supports via this API is minute.
         fmt = '%H:%M_%Y%m%d'
@@ -89,7 +99,11 @@ class GraphiteHTTP(firefly.data_source.DataSource):
         step = None
 
         # TODO: Minimize the number of http calls -- handle multiple sources in a single call
-        for metric_segments in sources:
+        for idx, metric_segments in enumerate(sources):
+            if deadlines.expired():
+                deadlines.mark_missing([idx])
+                serieses.append(None)
+                continue
             metric_name = '.'.join(metric_segments)
             params = {
                 'target': metric_name,
@@ -98,7 +112,16 @@ class GraphiteHTTP(firefly.data_source.DataSource):
                 'until': until_str,
             }
             render_url = urljoin(self.graphite_url, 'render/?%s' % '&'.join(['%s=%s' % (k,v) for k,v in params.items()]))
-            render_json = urlopen(render_url).read()
+            self.count_backend_call('http')
+            try:
+                with timing.phase('http'):
+                    render_json = urlopen(render_url, **deadlines.timeout_kwargs()).read()
+            except (URLError, socket.timeout):
+                if not deadlines.expired():
+                    raise
+                deadlines.mark_missing([idx])
+                serieses.append(None)
+                continue
             render_results = json.loads(render_json)
 
             values = []
@@ -114,6 +137,12 @@ class GraphiteHTTP(firefly.data_source.DataSource):
                 self.logger.error('Number of values from two different serieses does not match! %s != %s' % (step, current_step))
             serieses.append(values)
 
+        if step is None:
+            # nothing arrived in time
+            return json.dumps([])
+        length = max(len(values) for values in serieses if values is not None)
+        serieses = [values if values is not None else [None] * length for values in serieses]
+
         out = []
         for timestamp, values in izip(xrange(start, end+step, step), izip(*serieses)):
             out.append({'t': timestamp, 'v': [v for v in values]})
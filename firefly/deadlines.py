@@ -0,0 +1,105 @@
+"""Deadlines for the data source calls of a request.
+
+Dashboards with many sources would rather draw what arrived within a couple
+of seconds than wait for the slowest backend. A /data request can pass a
+`deadline` (in seconds from when it arrived), or get the data server's
+`request_deadline` setting; its data source call then runs with a Deadline,
+which data sources fetching their series one backend request at a time check
+between requests and use to time those requests out:
+
+    for idx, source in enumerate(sources):
+        if deadlines.expired():
+            deadlines.mark_missing([idx])
+            continue
+        urlopen(url_for(source), **deadlines.timeout_kwargs())
+
+The series a data source marks missing are sent with null values and listed
+in the X-Firefly-Missing header of the response. Should the call itself
+still be running at the deadline, the request is answered without it, with
+every series missing.
+
+Like firefly.timing.phase, the functions here work on the deadline of the
+data source call running in the current thread, and do nothing (or report
+no deadline) outside of one.
+"""
+from __future__ import with_statement
+
+import contextlib
+import threading
+import time
+
+_local = threading.local()
+
+
+class Deadline(object):
+    """The time by which a data source call should return, and the
+    positions of the sources it gave up on."""
+
+    def __init__(self, at):
+        self.at = at
+        self.missing = set()
+
+    def remaining(self):
+        return max(0.0, self.at - time.time())
+
+    def expired(self):
+        return time.time() >= self.at
+
+
+@contextlib.contextmanager
+def running(deadline):
+    """Makes deadline (a Deadline or None) the deadline of the data source
+    call running in this thread."""
+    outer = getattr(_local, 'deadline', None)
+    _local.deadline = deadline
+    try:
+        yield deadline
+    finally:
+        _local.deadline = outer
+
+
+@contextlib.contextmanager
+def subset(positions):
+    """Runs the block, which works on the subset of the call's sources at
+    the given positions, with a deadline of its own: sources it marks
+    missing by their position in the subset are marked missing at their
+    position in the call's sources."""
+    outer = current()
+    if outer is None:
+        yield
+        return
+    inner = Deadline(outer.at)
+    try:
+        with running(inner):
+            yield
+    finally:
+        outer.missing.update(positions[idx] for idx in inner.missing)
+
+
+def current():
+    """Returns the Deadline of the call running in this thread, or None"""
+    return getattr(_local, 'deadline', None)
+
+
+def expired():
+    deadline = current()
+    return deadline is not None and deadline.expired()
+
+
+def timeout_kwargs():
+    """Returns the keyword arguments for urlopen to give up on a backend
+    request at the deadline: a `timeout` of the seconds left, if there is
+    a deadline."""
+    deadline = current()
+    if deadline is None:
+        return {}
+    # a timeout of 0 would make the socket non-blocking
+    return {'timeout': max(deadline.remaining(), 0.001)}
+
+
+def mark_missing(positions):
+    """Flags the sources at the given positions of the call's sources as
+    missing their data."""
+    deadline = current()
+    if deadline is not None:
+        deadline.missing.update(positions)
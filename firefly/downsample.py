@@ -0,0 +1,153 @@
+"""Downsampling of data source results to the width of the graph.
+
+Some data sources return every raw point in the window whatever width they
+are asked for (a month of 10 second whisper data is 260k points per series),
+so the data server downsamples every result to about `width` points before
+caching and sending it. The algorithm can be picked per request with the
+`downsample` argument, defaulting to the data server's `downsample` option:
+
+    none        send the points as the data source returned them
+    average     the mean of each of `width` buckets (the default)
+    minmax      the min and max of each of `width / 2` buckets, in the order
+                they occurred, which keeps spikes visible (the average for
+                a width of 1)
+    lttb        largest-triangle-three-buckets: the point of each bucket
+                which best preserves the shape of the series
+
+Buckets hold consecutive runs of points, and all the series of a result keep
+sharing their timestamps: lttb picks the point of each bucket with the
+largest total triangle area across the series. Null (NaN) values are left
+out of averages and extremes, and a bucket with only nulls stays null.
+"""
+from array import array
+
+from firefly import timing
+from firefly.series import Series
+
+NAN = float('nan')
+
+DEFAULT_ALGORITHM = 'average'
+
+
+def downsample(series, width, algorithm=DEFAULT_ALGORITHM):
+    """Returns series downsampled to about width points with the named
+    algorithm, or series itself if it's no longer than that."""
+    if width <= 0 or len(series) <= width:
+        return series
+    return ALGORITHMS[algorithm](series, width)
+
+
+def from_result(data, sources, width, algorithm=DEFAULT_ALGORITHM):
+    """Decodes what a data source's data() returned for `sources` sources
+    (see Series.from_result) and downsamples it to width.
+
+    This is the transform data source executors run data calls through
+    (see firefly.executor), which keeps both off of the IOLoop.
+    """
+    with timing.phase('decode'):
+        series = Series.from_result(data, sources)
+    with timing.phase('downsample'):
+        return downsample(series, width, algorithm)
+
+
+def none(series, width):
+    return series
+
+
+def average(series, width):
+    bounds = _bucket_bounds(len(series), width)
+    timestamps = [series.timestamps[lo] for lo, _ in bounds]
+    columns = []
+    for column in series.columns:
+        values = array('d')
+        for lo, hi in bounds:
+            bucket = [v for v in column[lo:hi] if v == v]
+            values.append(sum(bucket) / len(bucket) if bucket else NAN)
+        columns.append(values)
+    return Series(timestamps, columns)
+
+
+def min_max(series, width):
+    if width < 2:
+        # there's no room for both extremes of even one bucket
+        return average(series, width)
+
+    # every bucket has at least two points, since len(series) > width
+    bounds = _bucket_bounds(len(series), width // 2)
+    timestamps = []
+    for lo, hi in bounds:
+        timestamps.append(series.timestamps[lo])
+        timestamps.append(series.timestamps[hi - 1])
+
+    columns = []
+    for column in series.columns:
+        values = array('d')
+        for lo, hi in bounds:
+            bucket = column[lo:hi]
+            present = [v for v in bucket if v == v]
+            if not present:
+                values.extend((NAN, NAN))
+                continue
+            low, high = min(present), max(present)
+            if bucket.index(low) <= bucket.index(high):
+                values.extend((low, high))
+            else:
+                values.extend((high, low))
+        columns.append(values)
+    return Series(timestamps, columns)
+
+
+def lttb(series, width):
+    n = len(series)
+    if width < 3:
+        return average(series, width)
+
+    timestamps = series.timestamps
+    columns = series.columns
+    every = float(n - 2) / (width - 2)
+    picked = [0]
+    a = 0
+    for bucket in xrange(width - 2):
+        # the average point of the next bucket is the third corner
+        next_lo = int((bucket + 1) * every) + 1
+        next_hi = min(int((bucket + 2) * every) + 1, n)
+        avg_t = float(sum(timestamps[next_lo:next_hi])) / (next_hi - next_lo)
+        avg_values = []
+        for column in columns:
+            present = [v for v in column[next_lo:next_hi] if v == v]
+            avg_values.append(sum(present) / len(present) if present else NAN)
+
+        a_t = timestamps[a]
+        best, best_area = None, -1.0
+        for j in xrange(int(bucket * every) + 1, int((bucket + 1) * every) + 1):
+            dt_avg = a_t - avg_t
+            dt_j = a_t - timestamps[j]
+            area = 0.0
+            for column, avg_value in zip(columns, avg_values):
+                a_value, value = column[a], column[j]
+                # NaNs drop out of the comparison by making area NaN; skip them
+                term = abs(dt_avg * (value - a_value) - dt_j * (avg_value - a_value))
+                if term == term:
+                    area += term
+            if area > best_area:
+                best, best_area = j, area
+        picked.append(best)
+        a = best
+    picked.append(n - 1)
+
+    return Series([timestamps[idx] for idx in picked],
+        [array('d', (column[idx] for idx in picked)) for column in columns])
+
+
+ALGORITHMS = {
+    'none': none,
+    'average': average,
+    'minmax': min_max,
+    'lttb': lttb,
+}
+
+
+def _bucket_bounds(n, buckets):
+    """Splits range(n) into `buckets` consecutive runs as evenly as possible,
+    returning (lo, hi) slice bounds for each."""
+    return [(idx * n // buckets, (idx + 1) * n // buckets) for idx in xrange(buckets)]
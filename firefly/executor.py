@@ -0,0 +1,310 @@
+"""Runs data source calls off of the Tornado IOLoop.
+
+Data source methods like `data` and `list_path` can block for a long time:
+they shell out to rrdtool, read whisper files or talk to other data servers.
+The data server hands those calls to a per-data source executor which runs
+them on a bounded pool of worker threads (or processes) and hands the result
+back to a callback on the IOLoop thread, so that cheap requests like /ping
+keep being answered while heavy fetches are in flight.
+
+Which executor a data source gets is controlled by its entry in
+`data_source_config`:
+
+    data_source_config:
+        data_sources.ganglia_rrd.GangliaRRD:
+            executor: process       # thread (default), process or inline
+            executor_workers: 8     # size of the pool, defaults to 4
+            executor_queue: 32      # calls which may wait for the pool
+            executor_retry_after: 5
+
+Each executor is a bulkhead: a data source can only have `executor_workers`
+calls running and `executor_queue` more waiting for a worker. Calls beyond
+that fail straight away with a 503 (Saturated) telling clients to retry
+after `executor_retry_after` seconds, so a hung backend ties up its own
+pool, not the data server; requests for other data sources, which have
+pools of their own, keep flowing.
+"""
+from __future__ import with_statement
+
+from contextlib import nested
+import functools
+import multiprocessing
+import Queue
+import sys
+import threading
+import time
+import traceback
+
+import tornado.ioloop
+import tornado.web
+from tornado import stack_context
+
+from firefly import deadlines
+from firefly import metrics
+from firefly import timing
+
+DEFAULT_EXECUTOR = 'thread'
+DEFAULT_EXECUTOR_WORKERS = 4
+DEFAULT_EXECUTOR_QUEUE = 64
+DEFAULT_EXECUTOR_RETRY_AFTER = 5
+
+
+class Saturated(tornado.web.HTTPError):
+    """The error calls to a data source get when its executor already has
+    as many calls running and waiting as it takes."""
+
+    def __init__(self, data_source, retry_after):
+        super(Saturated, self).__init__(503, "Too many calls to %s waiting" % type(data_source).__name__)
+        # in seconds, for the Retry-After header of the response
+        self.retry_after = retry_after
+
+
+class DataSourceExecutor(object):
+    """Base class for executors that run methods of a single data source.
+
+    Subclasses implement _dispatch, which must eventually call `done` with
+    either (result, None, phases) or (None, exc_info, phases) from any
+    thread, phases being the timings _call collects.
+    """
+
+    def __init__(self, data_source, workers=DEFAULT_EXECUTOR_WORKERS, io_loop=None,
+            queue=DEFAULT_EXECUTOR_QUEUE, retry_after=DEFAULT_EXECUTOR_RETRY_AFTER):
+        self.data_source = data_source
+        self.workers = workers
+        self.queue = queue
+        self.retry_after = retry_after
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        # calls submitted and not yet delivered; only touched on the IOLoop
+        self.pending = 0
+
+    def submit(self, method, args, callback, errback=None, request_timing=None, deadline=None,
+            transform=None):
+        """Calls data_source.`method`(*args) and passes its return value to
+        callback on the IOLoop thread.
+
+        With a transform, callback gets transform(return value) instead,
+        which is worked out by the executor as part of the call, so heavy
+        lifting like decoding results stays off of the IOLoop. Transforms
+        of process executors have to be picklable.
+
+        If the data source raises, errback is called with the exc_info
+        instead. Without an errback the exception is re-raised on the IOLoop
+        in the stack context that was active when submit was called, so it
+        surfaces as an error of the request handler that asked for the call.
+
+        With a firefly.timing.RequestTiming, the time the call spent queued,
+        the duration of the call and the phases the data source timed are
+        added to it.
+
+        With a firefly.deadlines.Deadline, the call runs with that deadline,
+        and sources it marks missing are added to the Deadline's.
+
+        If the executor is saturated (see the module docstring), the call
+        fails with a Saturated error without being made. Must be called from
+        the IOLoop thread.
+        """
+        submitted = time.time()
+
+        def deliver(result, exc_info, phases):
+            if request_timing is not None and phases:
+                call_duration = phases[0][1]
+                request_timing.add('queue', max(0.0, time.time() - submitted - call_duration))
+                for name, duration in phases:
+                    request_timing.add(name, duration)
+            if exc_info is not None:
+                if errback is not None:
+                    errback(exc_info)
+                    return
+                raise exc_info[0], exc_info[1], exc_info[2]
+            callback(result)
+        deliver = stack_context.wrap(deliver)
+
+        if self.queue is not None and self.pending >= self.workers + self.queue:
+            metrics.DATA_SOURCE_REJECTED.inc(data_source=type(self.data_source).__name__)
+            try:
+                raise Saturated(self.data_source, self.retry_after)
+            except Saturated:
+                # delivered later, as callers expect
+                self.io_loop.add_callback(functools.partial(deliver, None, sys.exc_info(), []))
+            return
+
+        def done(result, exc_info, phases):
+            self.io_loop.add_callback(functools.partial(finish, result, exc_info, phases))
+
+        def finish(result, exc_info, phases):
+            self.pending -= 1
+            deliver(result, exc_info, phases)
+
+        self.pending += 1
+        self._dispatch(method, args, done, deadline, transform)
+
+    def _dispatch(self, method, args, done, deadline=None, transform=None):
+        raise NotImplementedError
+
+    def shutdown(self):
+        pass
+
+
+class InlineExecutor(DataSourceExecutor):
+    """Runs data source calls directly on the IOLoop thread.
+
+    This is how the data server behaved before executors existed; it is
+    mostly useful for debugging and as a baseline when benchmarking.
+    """
+
+    def _dispatch(self, method, args, done, deadline=None, transform=None):
+        done(*_call(self.data_source, method, args, deadline, transform))
+
+
+class ThreadPoolExecutor(DataSourceExecutor):
+    """Runs data source calls on a fixed-size pool of daemon threads."""
+
+    def __init__(self, *args, **kwargs):
+        super(ThreadPoolExecutor, self).__init__(*args, **kwargs)
+        self._queue = Queue.Queue()
+        self._threads = []
+        for _ in xrange(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _dispatch(self, method, args, done, deadline=None, transform=None):
+        self._queue.put((method, args, done, deadline, transform))
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            method, args, done, deadline, transform = item
+            done(*_call(self.data_source, method, args, deadline, transform))
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._queue.put(None)
+
+
+class ProcessPoolExecutor(DataSourceExecutor):
+    """Runs data source calls on a pool of forked worker processes.
+
+    Useful for data sources which spend a lot of time in Python code (e.g.
+    parsing) and would otherwise contend for the GIL. The data source
+    instance is inherited by the workers when they are forked, so only the
+    method name, arguments and results have to be pickled.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(ProcessPoolExecutor, self).__init__(*args, **kwargs)
+        self._pool = multiprocessing.Pool(
+            self.workers, _init_process_worker, (self.data_source,))
+
+    def _dispatch(self, method, args, done, deadline=None, transform=None):
+        def on_result(outcome):
+            result, error, phases, missing = outcome
+            if deadline is not None:
+                deadline.missing.update(missing)
+            if error is not None:
+                try:
+                    raise tornado.web.HTTPError(*error)
+                except tornado.web.HTTPError:
+                    done(None, sys.exc_info(), phases)
+            else:
+                done(result, None, phases)
+        self._pool.apply_async(_call_in_process, (method, args, deadline and deadline.at, transform),
+            callback=on_result)
+
+    def shutdown(self):
+        self._pool.terminate()
+
+
+EXECUTOR_TYPES = {
+    'inline': InlineExecutor,
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor,
+}
+
+
+def executor_for_data_source(data_source, io_loop=None):
+    """Builds the executor configured for the given data source."""
+    try:
+        executor_class = EXECUTOR_TYPES[data_source.executor_type]
+    except KeyError:
+        raise ValueError("Unknown executor %r for data source %s" % (
+            data_source.executor_type, type(data_source).__name__))
+    return executor_class(data_source, workers=data_source.executor_workers, io_loop=io_loop,
+        queue=data_source.executor_queue, retry_after=data_source.executor_retry_after)
+
+
+def _call(data_source, method, args, deadline=None, transform=None):
+    """Calls the method on the data source with the given deadline,
+    returning (result, exc_info, phases), result having been through
+    transform if there is one.
+
+    phases are the (name, duration) of the call itself, transform
+    included, named after the method, followed by those the data source
+    and transform timed with firefly.timing.phase.
+    """
+    started = time.time()
+    with nested(timing.collect(), deadlines.running(deadline)) as (phases, _):
+        try:
+            result = _transformed(getattr(data_source, method)(*args), transform)
+            return result, None, _observe_call(data_source, method, started, phases)
+        except Exception:
+            _count_error(data_source, method)
+            return None, sys.exc_info(), _observe_call(data_source, method, started, phases)
+
+
+def _transformed(result, transform):
+    return transform(result) if transform is not None else result
+
+
+def _observe_call(data_source, method, started, phases):
+    """Records the duration of a call in the metrics, returning the call's
+    phases."""
+    duration = time.time() - started
+    metrics.DATA_SOURCE_DURATION.observe(duration,
+        data_source=type(data_source).__name__, method=method)
+    return [(method, duration)] + phases
+
+
+def _count_error(data_source, method):
+    metrics.DATA_SOURCE_ERRORS.inc(data_source=type(data_source).__name__, method=method)
+
+
+# The data source served by this process, when running in a process pool.
+_process_data_source = None
+
+
+def _init_process_worker(data_source):
+    global _process_data_source
+    _process_data_source = data_source
+
+
+def _call_in_process(method, args, deadline_at=None, transform=None):
+    """Runs in a pool process; returns (result, error, phases, missing),
+    missing being the positions of the sources the call marked missing
+    before the deadline at deadline_at, if any.
+
+    Neither tracebacks nor HTTPErrors survive pickling, so errors are sent
+    back as the (status_code, log_message) arguments for an HTTPError, with
+    unexpected exceptions becoming a 500 carrying the formatted traceback.
+    """
+    started = time.time()
+    deadline = deadlines.Deadline(deadline_at) if deadline_at is not None else None
+    with nested(timing.collect(), deadlines.running(deadline)) as (phases, _):
+        try:
+            result = _transformed(getattr(_process_data_source, method)(*args), transform)
+        except tornado.web.HTTPError, e:
+            _count_error(_process_data_source, method)
+            return None, (e.status_code, e.log_message), _observe_call(
+                _process_data_source, method, started, phases), _missing(deadline)
+        except Exception:
+            _count_error(_process_data_source, method)
+            return None, (500, traceback.format_exc().replace('%', '%%')), _observe_call(
+                _process_data_source, method, started, phases), _missing(deadline)
+    return result, None, _observe_call(_process_data_source, method, started, phases), _missing(deadline)
+
+
+def _missing(deadline):
+    return sorted(deadline.missing) if deadline is not None else []
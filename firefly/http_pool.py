@@ -0,0 +1,213 @@
+"""Keep-alive HTTP connections for data sources which call other servers.
+
+urllib2.urlopen opens a new TCP connection for every request, which for a
+data source fanning out to data servers in other datacenters means paying
+for a handshake (or several, over a long link) on every graph. An HTTPPool
+keeps the connections it has opened to each host and reuses them for later
+requests, opening at most `max_per_host` connections to a host at once;
+requests beyond that wait for one of them to be free.
+
+HTTPPool.urlopen mimics urllib2.urlopen closely enough to stand in for it:
+it raises URLError when the server can't be reached and HTTPError for error
+statuses, and returns a file-like response with read(), info() and
+getcode(). A connection goes back to the pool once its response has been
+read to the end (or closed).
+
+Pools are safe to use from several threads. Connections don't survive a
+fork: a pool used in a forked process starts over with no connections.
+"""
+from __future__ import with_statement
+
+from collections import defaultdict
+import errno
+import httplib
+import os
+import socket
+import threading
+import time
+from urllib2 import HTTPError
+from urllib2 import URLError
+import urlparse
+
+DEFAULT_MAX_PER_HOST = 4
+
+
+class HTTPPool(object):
+    """A pool of keep-alive connections to any number of hosts."""
+
+    def __init__(self, max_per_host=DEFAULT_MAX_PER_HOST):
+        self.max_per_host = max_per_host
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Condition()
+        # (scheme, host, port) -> idle connections, most recently used last
+        self._idle = defaultdict(list)
+        # (scheme, host, port) -> number of connections handed out
+        self._busy = defaultdict(int)
+        self.connections_opened = 0
+
+    def urlopen(self, url, timeout=None):
+        """GETs url, returning the response; see the module docstring.
+
+        timeout (in seconds) bounds waiting for a free connection as well as
+        each socket operation, including those of a retry.
+        """
+        if os.getpid() != self._pid:
+            self._reset()
+
+        parsed = urlparse.urlsplit(url)
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+
+        give_up = time.time() + timeout if timeout is not None else None
+        conn, reused = self._acquire(key, timeout)
+        try:
+            response = self._request(conn, path, timeout)
+        except (httplib.HTTPException, socket.error), e:
+            conn.close()
+            if not (reused and _closed_by_server(e)):
+                self._release(key, None)
+                raise URLError(e)
+            # the server closed the idle connection; retry once on a new
+            # one, in whatever time is left
+            if give_up is not None:
+                timeout = give_up - time.time()
+                if timeout <= 0:
+                    self._release(key, None)
+                    raise URLError(socket.timeout("timed out"))
+            conn = self._connect(key, timeout)
+            try:
+                response = self._request(conn, path, timeout)
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                self._release(key, None)
+                raise URLError(e)
+
+        pooled = _PooledResponse(self, key, conn, response)
+        if response.status >= 400:
+            body = pooled.read()
+            raise HTTPError(url, response.status, response.reason, response.msg, _Body(body))
+        return pooled
+
+    def _request(self, conn, path, timeout):
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        conn.request('GET', path)
+        return conn.getresponse()
+
+    def _acquire(self, key, timeout):
+        """Returns a connection to key and whether it was used before, waiting
+        up to timeout seconds for one if max_per_host are in use."""
+        give_up = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            while self._busy[key] >= self.max_per_host:
+                if give_up is None:
+                    self._lock.wait()
+                else:
+                    remaining = give_up - time.time()
+                    if remaining <= 0:
+                        raise URLError(socket.timeout("timed out waiting for a connection to %s" % key[1]))
+                    self._lock.wait(remaining)
+            self._busy[key] += 1
+            if self._idle[key]:
+                return self._idle[key].pop(), True
+        return self._connect(key, timeout), False
+
+    def _connect(self, key, timeout):
+        scheme, host, port = key
+        connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        with self._lock:
+            self.connections_opened += 1
+        return connection_class(host, port, timeout=timeout)
+
+    def _release(self, key, conn):
+        """Hands back a connection to key, which is kept for reuse unless it
+        is None."""
+        with self._lock:
+            self._busy[key] -= 1
+            if conn is not None:
+                self._idle[key].append(conn)
+            self._lock.notify()
+
+
+def _closed_by_server(error):
+    """Whether error is what a request on a connection the server has since
+    closed fails with, rather than e.g. a timeout."""
+    if isinstance(error, httplib.BadStatusLine):
+        return True
+    return (isinstance(error, socket.error) and not isinstance(error, socket.timeout) and
+        error.errno in (errno.ECONNRESET, errno.EPIPE))
+
+
+class _PooledResponse(object):
+    """A response which returns its connection to the pool once read."""
+
+    def __init__(self, pool, key, conn, response):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._pid = pool._pid
+
+    def read(self, amt=None):
+        if self._conn is None:
+            return ''
+        data = self._response.read(amt)
+        if amt is None or not data:
+            self._done()
+        return data
+
+    def info(self):
+        return self._response.msg
+
+    def getcode(self):
+        return self._response.status
+
+    def close(self):
+        if self._conn is not None:
+            # the rest of the body would be left in the connection
+            self._conn.close()
+            self._conn = None
+            self._release(None)
+
+    def _done(self):
+        conn, self._conn = self._conn, None
+        if self._response.will_close:
+            conn.close()
+            conn = None
+        self._release(conn)
+
+    def _release(self, conn):
+        if self._pool._pid == self._pid:
+            self._pool._release(self._key, conn)
+
+
+class _Body(object):
+    """The already read body of an error response, for HTTPError"""
+
+    def __init__(self, body):
+        self._body = body
+
+    def read(self, amt=None):
+        body, self._body = self._body, ''
+        return body
+
+    def readline(self):
+        return self.read()
+
+    def close(self):
+        pass
+
+
+default_pool = HTTPPool()
+
+
+def urlopen(url, timeout=None, pool=None):
+    """Like urllib2.urlopen, but over a keep-alive connection from pool (by
+    default, one shared by the process)."""
+    return (pool or default_pool).urlopen(url, timeout)
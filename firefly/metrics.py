@@ -0,0 +1,390 @@
+"""Prometheus-style metrics for the data server, served from /metrics.
+
+The data server forks a worker per core (and data sources may run in forked
+process pools of their own), so metrics can't just live in each process'
+memory: a scrape of /metrics lands on one arbitrary worker. Instead every
+process keeps its values in a memory-mapped file of its own, named after its
+pid, in a directory shared by the whole server (`metrics_dir`, by default
+firefly-metrics-<port> in the temporary directory, which a restarted server
+empties and reuses). Recording a
+value is a write to the process' own mapping; /metrics reads every file in
+the directory and adds up the values, so counts and histograms cover all
+processes, including ones which have since exited.
+
+Metrics are declared once at module level (see the bottom of this module)
+and recorded with keyword labels:
+
+    metrics.BACKEND_CALLS.inc(data_source='GangliaRRD', kind='subprocess')
+    metrics.REQUEST_DURATION.observe(0.05, handler='DataHandler')
+
+Only counters and histograms are supported, as those are the metrics whose
+values from different processes can be summed.
+"""
+from __future__ import with_statement
+
+import json
+import logging
+import mmap
+import multiprocessing.util
+import os
+import struct
+import tempfile
+import threading
+
+import tornado.web
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+DEFAULT_BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+_FILE_SUFFIX = '.db'
+_INITIAL_FILE_SIZE = 1 << 16
+_HEADER = struct.Struct('<Q')
+_KEY_LENGTH = struct.Struct('<I')
+_VALUE = struct.Struct('<d')
+
+
+def _padded(length):
+    return (length + 7) & ~7
+
+
+class _ValueFile(object):
+    """The values of a single process, in a memory-mapped file.
+
+    The file starts with the number of bytes in use, followed by entries of
+    a key (a length-prefixed JSON string, padded to 8 bytes) and a double.
+    Entries are only ever appended, and the number of bytes in use is only
+    bumped once an entry is complete, so readers in other processes always
+    see whole entries.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'a+b')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < _INITIAL_FILE_SIZE:
+            self._file.truncate(_INITIAL_FILE_SIZE)
+            size = _INITIAL_FILE_SIZE
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+        self._positions = {}
+        self._used = _HEADER.unpack_from(self._mmap, 0)[0]
+        if not self._used:
+            self._used = _HEADER.size
+            _HEADER.pack_into(self._mmap, 0, self._used)
+        else:
+            # left behind by an earlier process with the same pid
+            for key, pos in _read_entries(self._mmap):
+                self._positions[key] = pos
+
+    def add(self, key, amount):
+        pos = self._positions.get(key)
+        if pos is None:
+            pos = self._append(key)
+        _VALUE.pack_into(self._mmap, pos, _VALUE.unpack_from(self._mmap, pos)[0] + amount)
+
+    def _append(self, key):
+        encoded = key.encode('utf-8')
+        key_size = _padded(_KEY_LENGTH.size + len(encoded))
+        if self._used + key_size + _VALUE.size > len(self._mmap):
+            self._grow(self._used + key_size + _VALUE.size)
+        _KEY_LENGTH.pack_into(self._mmap, self._used, len(encoded))
+        start = self._used + _KEY_LENGTH.size
+        self._mmap[start:start + len(encoded)] = encoded
+        pos = self._used + key_size
+        _VALUE.pack_into(self._mmap, pos, 0.0)
+        self._used = pos + _VALUE.size
+        _HEADER.pack_into(self._mmap, 0, self._used)
+        self._positions[key] = pos
+        return pos
+
+    def _grow(self, needed):
+        size = len(self._mmap)
+        while size < needed:
+            size *= 2
+        self._mmap.close()
+        self._file.truncate(size)
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+def _read_entries(data):
+    """Yields the (key, value position) of each entry in a value file."""
+    used = _HEADER.unpack_from(data, 0)[0]
+    pos = _HEADER.size
+    while pos < used:
+        length = _KEY_LENGTH.unpack_from(data, pos)[0]
+        start = pos + _KEY_LENGTH.size
+        key = data[start:start + length].decode('utf-8')
+        pos += _padded(_KEY_LENGTH.size + length)
+        yield key, pos
+        pos += _VALUE.size
+
+
+def default_directory(port=None):
+    """Returns the directory the metrics of the data server on port are kept
+    in unless configured."""
+    name = 'firefly-metrics' if port is None else 'firefly-metrics-%d' % port
+    return os.path.join(tempfile.gettempdir(), name)
+
+
+class Registry(object):
+    """The declared metrics, and the directory their values are kept in."""
+
+    def __init__(self):
+        self.metrics = []
+        self.directory = None
+        self._lock = threading.Lock()
+        self._pid = None
+        self._file = None
+        # a pool process may be forked while another thread holds the lock
+        multiprocessing.util.register_after_fork(self, Registry._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._file = None
+
+    def set_directory(self, directory=None):
+        """Keeps values in directory from now on, removing any values left
+        there by an earlier run. Without a directory default_directory() is
+        used.
+
+        This must be called before forking, so that the processes of a server
+        share the directory.
+        """
+        if directory is None:
+            directory = default_directory()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for filename in os.listdir(directory):
+            if filename.endswith(_FILE_SUFFIX):
+                os.unlink(os.path.join(directory, filename))
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            self.directory = directory
+            self._pid = None
+            self._file = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add(self, key, amount):
+        if self.directory is None:
+            self.set_directory()
+        with self._lock:
+            if self._pid != os.getpid():
+                # freshly forked; the parent's file isn't ours
+                self._pid = os.getpid()
+                self._file = None
+            if self._file is None:
+                self._file = _ValueFile(os.path.join(self.directory, '%d%s' % (self._pid, _FILE_SUFFIX)))
+            self._file.add(key, amount)
+
+    def collect(self):
+        """Returns the values of all processes, summed by key."""
+        totals = {}
+        if self.directory is None:
+            return totals
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(_FILE_SUFFIX):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename), 'rb') as f:
+                    data = f.read()
+            except IOError:
+                continue
+            if len(data) < _HEADER.size:
+                continue
+            for key, pos in _read_entries(data):
+                totals[key] = totals.get(key, 0.0) + _VALUE.unpack_from(data, pos)[0]
+        return totals
+
+    def exposition(self):
+        """Renders the values of every declared metric in the Prometheus text
+        exposition format."""
+        totals = self.collect()
+        samples_by_name = {}
+        for key, value in totals.iteritems():
+            name, suffix, labels = json.loads(key)
+            samples_by_name.setdefault(name, []).append((suffix, tuple(map(tuple, labels)), value))
+
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.TYPE))
+            lines.extend(metric.render(samples_by_name.get(metric.name, [])))
+        return '\n'.join(lines) + '\n'
+
+
+class _Metric(object):
+
+    TYPE = None
+
+    def __init__(self, registry, name, help, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        registry.register(self)
+
+    def _labels(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("%s takes labels %s, not %s" % (
+                self.name, ', '.join(self.labelnames), ', '.join(sorted(labels))))
+        return [[name, unicode(labels[name])] for name in self.labelnames]
+
+    def _add(self, suffix, labels, amount):
+        self.registry.add(json.dumps([self.name, suffix, labels]), amount)
+
+
+class Counter(_Metric):
+    """A count which only goes up."""
+
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        self._add('', self._labels(labels), amount)
+
+    def render(self, samples):
+        return ['%s%s %s' % (self.name, _format_labels(labels), _format_value(value))
+            for _, labels, value in sorted(samples)]
+
+
+class Histogram(_Metric):
+    """Counts observations by the smallest bucket bound they don't exceed,
+    along with their count and sum."""
+
+    TYPE = 'histogram'
+
+    def __init__(self, registry, name, help, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        super(Histogram, self).__init__(registry, name, help, labelnames)
+        self.buckets = tuple(sorted(float(bound) for bound in buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        labels = self._labels(labels)
+        for bound in self.buckets:
+            if value <= bound:
+                break
+        # buckets are kept non-cumulative, so an observation is three writes;
+        # render adds them up
+        self._add('bucket', labels + [['le', _format_value(bound)]], 1)
+        self._add('count', labels, 1)
+        self._add('sum', labels, value)
+
+    def render(self, samples):
+        series = {}
+        for suffix, labels, value in samples:
+            if suffix == 'bucket':
+                le = labels[-1][1]
+                series.setdefault(labels[:-1], {}).setdefault('buckets', {})[le] = value
+            else:
+                series.setdefault(labels, {})[suffix] = value
+
+        lines = []
+        for labels, values in sorted(series.iteritems()):
+            cumulative = 0.0
+            for bound in self.buckets:
+                le = _format_value(bound)
+                cumulative += values.get('buckets', {}).get(le, 0.0)
+                lines.append('%s_bucket%s %s' % (self.name,
+                    _format_labels(labels + (('le', le),)), _format_value(cumulative)))
+            lines.append('%s_count%s %s' % (self.name, _format_labels(labels),
+                _format_value(values.get('count', 0.0))))
+            lines.append('%s_sum%s %s' % (self.name, _format_labels(labels),
+                _format_value(values.get('sum', 0.0))))
+        return lines
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+        for name, value in labels)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value == int(value) and abs(value) < 1e15:
+        return '%d' % value
+    return repr(value)
+
+
+class ResponseSizeTransform(object):
+    """Output transform which counts the bytes of the response body as sent
+    (i.e. after compression) in request.response_bytes; it must come after
+    any compressing transform."""
+
+    def __init__(self, request):
+        self.request = request
+        self.request.response_bytes = 0
+
+    def transform_first_chunk(self, headers, chunk, finishing):
+        self.request.response_bytes += len(chunk)
+        return headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        self.request.response_bytes += len(chunk)
+        return chunk
+
+
+def log_request(handler):
+    """Application log_function which records the request's metrics before
+    logging it the way Tornado does by default."""
+    name = type(handler).__name__
+    status = handler.get_status()
+    request_time = handler.request.request_time()
+    REQUESTS.inc(handler=name, method=handler.request.method, code=status)
+    REQUEST_DURATION.observe(request_time, handler=name)
+    RESPONSE_BYTES.observe(getattr(handler.request, 'response_bytes', 0), handler=name)
+
+    if status < 400:
+        log_method = logging.info
+    elif status < 500:
+        log_method = logging.warning
+    else:
+        log_method = logging.error
+    log_method("%d %s %.2fms", status, handler._request_summary(), 1000.0 * request_time)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Serves the metrics of every process of the server"""
+
+    def get(self):
+        self.set_header('Content-Type', CONTENT_TYPE)
+        self.write(registry.exposition())
+
+
+registry = Registry()
+
+REQUESTS = Counter(registry, 'firefly_http_requests_total',
+    'HTTP requests served, by handler, method and status code.',
+    ('handler', 'method', 'code'))
+REQUEST_DURATION = Histogram(registry, 'firefly_http_request_duration_seconds',
+    'Time taken to answer HTTP requests, by handler.',
+    ('handler',))
+RESPONSE_BYTES = Histogram(registry, 'firefly_http_response_bytes',
+    'Size of HTTP response bodies as sent, by handler.',
+    ('handler',), buckets=DEFAULT_BYTE_BUCKETS)
+DATA_SOURCE_DURATION = Histogram(registry, 'firefly_data_source_call_duration_seconds',
+    'Time taken by calls into data sources, by data source class and method.',
+    ('data_source', 'method'))
+DATA_SOURCE_ERRORS = Counter(registry, 'firefly_data_source_call_errors_total',
+    'Calls into data sources which raised, by data source class and method.',
+    ('data_source', 'method'))
+DATA_SOURCE_REJECTED = Counter(registry, 'firefly_data_source_calls_rejected_total',
+    'Calls into data sources turned away because their executor was saturated, by data source class.',
+    ('data_source',))
+HEDGED_REQUESTS = Counter(registry, 'firefly_hedged_requests_total',
+    'Requests to a data server also sent to one of its replicas because the first was slow, by data source class.',
+    ('data_source',))
+BACKEND_CALLS = Counter(registry, 'firefly_backend_calls_total',
+    'Subprocesses run and HTTP requests made by data sources, by data source class.',
+    ('data_source', 'kind'))
@@ -0,0 +1,120 @@
+"""Picking between data servers which serve the same data.
+
+Data servers are often run in pairs (or more) serving the same tree, so that
+one can be taken down without losing graphs. A ReplicaGroup keeps track of
+how each of them has been doing lately:
+
+* an exponentially weighted moving average of the time it takes to answer,
+* the same kind of average of how often it fails, and
+* its last few response times, to know what a slow answer is.
+
+Requests go to the fastest replica which is healthy, i.e. which hasn't
+failed at least `max_error_rate` of the time lately. A replica which went
+unhealthy gets another chance `retry_interval` seconds after its last
+failure, and goes back to being healthy as soon as it starts answering
+again.
+
+A request which the replica it went to hasn't answered after the
+`hedge_percentile`th percentile of its recent response times is sent to the
+next best replica too (a hedged request), and the first answer wins. This
+costs a few percent more requests, and saves the graphs waiting on a replica
+having a bad moment (an rrdcached flush, a GC pause, a saturated link) from
+waiting on it.
+"""
+from __future__ import with_statement
+
+from collections import deque
+import threading
+import time
+
+DEFAULT_HEDGE_PERCENTILE = 95
+# how long to wait before hedging, until a replica has answered enough
+# requests to go by its response times
+DEFAULT_HEDGE_DELAY = 1.0
+DEFAULT_MAX_ERROR_RATE = 0.5
+DEFAULT_RETRY_INTERVAL = 10
+
+# weight of the latest request in the averages
+SMOOTHING = 0.2
+# response times kept per replica, for the percentile
+WINDOW = 100
+# response times needed before going by them
+MIN_SAMPLES = 10
+
+
+class Replica(object):
+    """One of the data servers of a ReplicaGroup, and how it's been
+    doing."""
+
+    def __init__(self, url):
+        self.url = url
+        # seconds, or None until it has answered
+        self.latency = None
+        self.error_rate = 0.0
+        self.failed_at = None
+        self.latencies = deque(maxlen=WINDOW)
+
+    def __repr__(self):
+        return 'Replica(%r)' % self.url
+
+
+class ReplicaGroup(object):
+    """Data servers serving the same data, in the order they're configured
+    in."""
+
+    def __init__(self, urls, hedge_percentile=DEFAULT_HEDGE_PERCENTILE, hedge_delay=DEFAULT_HEDGE_DELAY,
+            max_error_rate=DEFAULT_MAX_ERROR_RATE, retry_interval=DEFAULT_RETRY_INTERVAL, clock=time.time):
+        self.replicas = [Replica(url) for url in urls]
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.max_error_rate = max_error_rate
+        self.retry_interval = retry_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def healthy(self, replica):
+        return (replica.error_rate < self.max_error_rate or
+            self._clock() - replica.failed_at >= self.retry_interval)
+
+    def ranked(self):
+        """Returns the replicas best first: the healthy ones, fastest first
+        (those which haven't answered yet count as the fastest, so that they
+        get tried), then the others, the ones which failed longest ago
+        first."""
+        with self._lock:
+            healthy = [replica for replica in self.replicas if self.healthy(replica)]
+            unhealthy = [replica for replica in self.replicas if not self.healthy(replica)]
+            healthy.sort(key=lambda replica: replica.latency or 0.0)
+            unhealthy.sort(key=lambda replica: replica.failed_at)
+        return healthy + unhealthy
+
+    def succeeded(self, replica, latency):
+        """Records a request to replica answered in latency seconds."""
+        with self._lock:
+            if replica.latency is None:
+                replica.latency = latency
+            else:
+                replica.latency += SMOOTHING * (latency - replica.latency)
+            replica.error_rate -= SMOOTHING * replica.error_rate
+            replica.latencies.append(latency)
+
+    def failed(self, replica):
+        """Records a request to replica which failed."""
+        with self._lock:
+            replica.error_rate += SMOOTHING * (1.0 - replica.error_rate)
+            replica.failed_at = self._clock()
+
+    def hedge_after(self, replica):
+        """Returns how many seconds to give replica before hedging a request
+        to it, or None not to hedge."""
+        if not self.hedge_percentile or len(self.replicas) < 2:
+            return None
+        with self._lock:
+            latencies = sorted(replica.latencies)
+        if len(latencies) < MIN_SAMPLES:
+            return self.hedge_delay
+        idx = min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile / 100.0))
+        return latencies[idx]
@@ -0,0 +1,447 @@
+"""Columnar representation of the time series data served by the data server.
+
+Data sources return their data serialized in the data server's row-oriented
+JSON format:
+
+    [{"t": 1391047920, "v": [2.0, 1.0]}, {"t": 1391047980, "v": [6.0, null]}]
+
+or, when they put their result together from other series (see merge), as a
+Series.
+
+Series holds the same data as one timestamp column plus one value column per
+source, which is what the data server needs whenever it has to take results
+apart or put them back together, and can encode itself in any of the data
+server's wire formats.
+
+Binary format
+-------------
+
+The binary format (content type application/x-firefly-series) is laid out so
+that a browser can wrap every column in a typed array without copying. All
+fields are little-endian and every column starts on an 8-byte boundary:
+
+    offset  size  field
+    0       4     magic, "FFTS"
+    4       1     format version (1)
+    5       1     size of each value in bytes: 4 (float32) or 8 (float64)
+    6       2     flags (reserved, 0)
+    8       4     number of points, n
+    12      4     number of series, m
+    16      8     first timestamp (int64)
+    24      4*n   timestamp deltas (int32): t[i] - t[i - 1], with t[-1] = first
+    ...           m value columns of n floats, each padded to 8 bytes
+
+Null values are encoded as NaN.
+
+Columnar JSON format
+--------------------
+
+For clients that need JSON, the columnar format sends each column as a plain
+list instead of repeating {"t": ..., "v": [...]} objects for every point:
+
+    {"start": 1391047920, "step": 60, "series": [[2.0, 6.0], [1.0, null]]}
+
+When the points are evenly spaced the timestamps are just start + i * step.
+Otherwise "step" is left out and "t_deltas" holds t[i] - t[i - 1] for every
+point, with t[-1] = start, like the binary format:
+
+    {"start": 1391047920, "t_deltas": [0, 60, 180], "series": [[2.0, 6.0, 1.5]]}
+
+An empty series has a start and step of null.
+"""
+from array import array
+import bisect
+import math
+import struct
+import sys
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+BINARY_CONTENT_TYPE = 'application/x-firefly-series'
+BINARY_MAGIC = 'FFTS'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<4sBBHIIq')
+
+NAN = float('nan')
+
+# Wire format name -> (content type, encoder)
+FORMATS = {
+    'json': ('application/json', lambda series: series.to_json()),
+    'binary': (BINARY_CONTENT_TYPE, lambda series: series.to_binary('d')),
+    'binary32': (BINARY_CONTENT_TYPE, lambda series: series.to_binary('f')),
+    'columnar': ('application/json', lambda series: series.to_columnar()),
+}
+
+
+class Series(object):
+    """A set of value columns sharing a timestamp column.
+
+    Timestamps are kept in an array of ints in ascending order and each
+    column in an array of doubles as long as the timestamps, with NaN
+    standing in for null values. Series are treated as immutable once built,
+    which lets them share columns and memoize their encodings.
+
+    missing holds the indexes of the columns the data source didn't get
+    the data for before the request's deadline (see firefly.deadlines); their
+    values are all null.
+    """
+
+    def __init__(self, timestamps, columns, encodings=None, missing=()):
+        self.timestamps = _as_array('l', timestamps)
+        self.columns = [_as_array('d', column) for column in columns]
+        # format -> encoded bytes, filled in by encode()
+        self._encodings = encodings or {}
+        self.missing = tuple(missing)
+
+    @classmethod
+    def from_rows(cls, rows, width=None):
+        """Builds a Series from a parsed list of {'t': ..., 'v': [...]} rows.
+
+        width is the number of columns to expect, for when there are no rows.
+        """
+        if width is None:
+            width = len(rows[0]['v']) if rows else 0
+        timestamps = [int(row['t']) for row in rows]
+        columns = [[row['v'][idx] for row in rows] for idx in xrange(width)]
+        return cls(timestamps, columns)
+
+    @classmethod
+    def from_result(cls, data, width=None):
+        """Builds a Series from what a data source's data() returned: a
+        Series, or its serialized result (see from_json)."""
+        if isinstance(data, Series):
+            return data
+        return cls.from_json(data, width)
+
+    @classmethod
+    def from_json(cls, data, width=None):
+        """Builds a Series from a data source's serialized result, keeping
+        the serialized form around as the Series' JSON encoding."""
+        series = cls.from_rows(json.loads(data), width)
+        series._encodings['json'] = data
+        return series
+
+    @classmethod
+    def from_json_chunks(cls, chunks, width):
+        """Builds a Series from a data source's serialized result, read in
+        chunks (e.g. off a socket) which are decoded as they come, so that
+        neither the whole of it nor its parsed rows are ever in memory at
+        once; see RowDecoder."""
+        decoder = RowDecoder(width)
+        for chunk in chunks:
+            decoder.feed(chunk)
+        return decoder.finish()
+
+    @classmethod
+    def from_binary(cls, data):
+        """Decodes a Series encoded with to_binary"""
+        if len(data) < BINARY_HEADER.size:
+            raise ValueError("Not a firefly series")
+        magic, version, value_size, _, n, m, first = BINARY_HEADER.unpack_from(data)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            raise ValueError("Not a firefly series")
+
+        offset = BINARY_HEADER.size
+        deltas = _array_from('i', data, offset, n)
+        offset += _padded(4 * n)
+        timestamps = []
+        t = first
+        for delta in deltas:
+            t += delta
+            timestamps.append(t)
+
+        columns = []
+        value_type = 'f' if value_size == 4 else 'd'
+        for _ in xrange(m):
+            columns.append(array('d', _array_from(value_type, data, offset, n)))
+            offset += _padded(value_size * n)
+        return cls(timestamps, columns)
+
+    @classmethod
+    def from_columnar(cls, data):
+        """Decodes a Series encoded with to_columnar"""
+        parsed = json.loads(data)
+        columns = parsed['series']
+        if parsed['start'] is None:
+            return cls([], columns)
+
+        if 'step' in parsed:
+            n = len(columns[0]) if columns else 1
+            timestamps = [parsed['start'] + idx * parsed['step'] for idx in xrange(n)]
+        else:
+            timestamps = []
+            t = parsed['start']
+            for delta in parsed['t_deltas']:
+                t += delta
+                timestamps.append(t)
+        return cls(timestamps, columns)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __eq__(self, other):
+        return (isinstance(other, Series) and
+            self.timestamps == other.timestamps and
+            len(self.columns) == len(other.columns) and
+            all(self.values(idx) == other.values(idx) for idx in xrange(len(self.columns))))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Series(%r, %r)' % (list(self.timestamps),
+            [self.values(idx) for idx in xrange(len(self.columns))])
+
+    def values(self, idx):
+        """Returns the column at idx as a list, with None for null values"""
+        return [None if v != v else v for v in self.columns[idx]]
+
+    def select(self, indexes):
+        """Returns a Series with just the columns at the given indexes"""
+        return Series(self.timestamps, [self.columns[idx] for idx in indexes],
+            missing=[pos for pos, idx in enumerate(indexes) if idx in self.missing])
+
+    def with_missing(self, missing):
+        """Returns this Series with the given columns flagged as missing"""
+        return Series(self.timestamps, self.columns, self._encodings, missing)
+
+    def since(self, t):
+        """Returns a Series with just the points at or after timestamp t"""
+        idx = bisect.bisect_left(self.timestamps, t)
+        if idx == 0:
+            return self
+        return Series(self.timestamps[idx:], [column[idx:] for column in self.columns], missing=self.missing)
+
+    def between(self, start, end):
+        """Returns a Series with just the points from timestamp start to
+        timestamp end, both included"""
+        lo = bisect.bisect_left(self.timestamps, start)
+        hi = bisect.bisect_right(self.timestamps, end)
+        if lo == 0 and hi == len(self.timestamps):
+            return self
+        return Series(self.timestamps[lo:hi], [column[lo:hi] for column in self.columns],
+            missing=self.missing)
+
+    def updated_with(self, update):
+        """Returns this Series with every point from the first timestamp of
+        update on replaced by the points of update, which must have the
+        same columns."""
+        if not len(update):
+            return self
+        idx = bisect.bisect_left(self.timestamps, update.timestamps[0])
+        return Series(self.timestamps[:idx] + update.timestamps,
+            [column[:idx] + update_column for column, update_column in zip(self.columns, update.columns)])
+
+    def nbytes(self):
+        """Approximate memory held by this Series, for sizing caches"""
+        return (self.timestamps.itemsize * len(self.timestamps) +
+            sum(column.itemsize * len(column) for column in self.columns) +
+            sum(len(encoded) for encoded in self._encodings.itervalues()))
+
+    def encode(self, fmt):
+        """Returns this Series encoded in the named wire format (see FORMATS),
+        memoizing the result."""
+        if fmt not in self._encodings:
+            self._encodings[fmt] = FORMATS[fmt][1](self)
+        return self._encodings[fmt]
+
+    def to_rows(self):
+        columns = [self.values(idx) for idx in xrange(len(self.columns))]
+        return [{'t': t, 'v': list(values)}
+            for t, values in zip(self.timestamps, zip(*columns) or [()] * len(self))]
+
+    def to_json(self):
+        """Serializes the Series in the data server's row-oriented format"""
+        rows = []
+        for idx, t in enumerate(self.timestamps):
+            values = ','.join(_json_float(column[idx]) for column in self.columns)
+            rows.append('{"t":%d,"v":[%s]}' % (t, values))
+        return '[%s]' % ','.join(rows)
+
+    def to_columnar(self):
+        """Serializes the Series in the columnar JSON format"""
+        series = ','.join('[%s]' % ','.join(_json_float(value) for value in column)
+            for column in self.columns)
+        if not self.timestamps:
+            return '{"start":null,"step":null,"series":[%s]}' % series
+
+        start = self.timestamps[0]
+        deltas = [0] + [t - previous for previous, t in zip(self.timestamps, self.timestamps[1:])]
+        if len(set(deltas[1:])) <= 1:
+            step = deltas[1] if len(deltas) > 1 else 0
+            return '{"start":%d,"step":%d,"series":[%s]}' % (start, step, series)
+        return '{"start":%d,"t_deltas":[%s],"series":[%s]}' % (
+            start, ','.join(str(delta) for delta in deltas), series)
+
+    def to_binary(self, value_type='d'):
+        """Serializes the Series in the binary columnar format, with float64
+        values for value_type 'd' and float32 values for 'f'."""
+        n = len(self.timestamps)
+        first = self.timestamps[0] if n else 0
+        deltas = array('i', [0] * n)
+        previous = first
+        for idx, t in enumerate(self.timestamps):
+            deltas[idx] = t - previous
+            previous = t
+
+        value_size = array(value_type).itemsize
+        parts = [
+            BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, value_size, 0, n, len(self.columns), first),
+            _padding(_little_endian(deltas).tostring()),
+        ]
+        for column in self.columns:
+            if value_type != column.typecode:
+                column = array(value_type, column)
+            parts.append(_padding(_little_endian(column).tostring()))
+        return ''.join(parts)
+
+
+class RowDecoder(object):
+    """Incrementally decodes the row-oriented JSON format into a Series of
+    `width` columns.
+
+    feed() takes the serialized rows a piece at a time, split anywhere, and
+    moves every complete row out of them into the columns; all that's kept
+    of the serialized form is the incomplete row at the end of the last
+    piece. A row is complete once its closing brace has been fed (rows hold
+    nothing but numbers, so it's the first one), and one which doesn't
+    decode then raises ValueError straight away. finish() returns the Series
+    once all of it has been fed.
+    """
+
+    def __init__(self, width):
+        self.timestamps = array('l')
+        self.columns = [array('d') for _ in xrange(width)]
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._started = False
+        self._ended = False
+
+    def feed(self, chunk):
+        buf = self._buffer + chunk
+        idx = _skip_space(buf, 0)
+        if not self._started and idx < len(buf):
+            if buf[idx] != '[':
+                raise ValueError("Expected a list of rows")
+            self._started = True
+            idx = _skip_space(buf, idx + 1)
+
+        timestamps, columns = self.timestamps, self.columns
+        while idx < len(buf) and not self._ended:
+            if buf[idx] == ']':
+                self._ended = True
+                idx += 1
+                break
+            if buf[idx] == ',':
+                idx = _skip_space(buf, idx + 1)
+                continue
+            if buf[idx] != '{':
+                raise ValueError("Expected a row at char %d" % idx)
+            if buf.find('}', idx) < 0:
+                # the rest of the row is in the next chunk
+                break
+            row, end = self._decoder.raw_decode(buf, idx)
+            if len(row['v']) != len(columns):
+                raise ValueError("Expected rows of %d values" % len(columns))
+            timestamps.append(int(row['t']))
+            for column, value in zip(columns, row['v']):
+                column.append(NAN if value is None else value)
+            idx = _skip_space(buf, end)
+
+        self._buffer = buf[idx:]
+
+    def finish(self):
+        if not self._ended or self._buffer.strip():
+            raise ValueError("Truncated or invalid rows")
+        return Series(self.timestamps, self.columns)
+
+
+def _skip_space(buf, idx):
+    while idx < len(buf) and buf[idx] in ' \t\r\n':
+        idx += 1
+    return idx
+
+
+def merge(width, parts):
+    """Merges several Series into one with `width` columns.
+
+    parts is a list of (positions, Series) pairs, the columns of each Series
+    going to the given positions of the merged Series. Its timestamps are
+    the union of the timestamps of the parts; columns get nulls at the
+    timestamps their part has no point at, and positions no part fills are
+    null throughout.
+
+    Merging works on whole columns rather than points: where every part has
+    the same timestamps (the usual case, data servers sharing a step) the
+    merged Series shares their columns, and otherwise the columns of each
+    part are copied into null-filled ones, in one slice wherever the part's
+    timestamps are a run of the merged ones.
+    """
+    timestamps = parts[0][1].timestamps if parts else array('l')
+    if any(part.timestamps != timestamps for _, part in parts):
+        timestamps = array('l', sorted(set().union(*[part.timestamps for _, part in parts])))
+    n = len(timestamps)
+    nulls = array('d', [NAN]) * n
+
+    columns = [nulls] * width
+    index = None
+    for positions, part in parts:
+        if part.timestamps == timestamps:
+            for pos, column in zip(positions, part.columns):
+                columns[pos] = column
+            continue
+
+        if index is None:
+            index = dict((t, idx) for idx, t in enumerate(timestamps))
+        placed = [index[t] for t in part.timestamps]
+        run = bool(placed) and placed == range(placed[0], placed[0] + len(placed))
+        for pos, column in zip(positions, part.columns):
+            merged = array('d', nulls)
+            if run:
+                merged[placed[0]:placed[-1] + 1] = column
+            else:
+                for idx, value in zip(placed, column):
+                    merged[idx] = value
+            columns[pos] = merged
+    return Series(timestamps, columns)
+
+
+def _as_array(typecode, values):
+    if isinstance(values, array) and values.typecode == typecode:
+        return values
+    if typecode == 'd':
+        return array('d', (NAN if v is None else v for v in values))
+    return array(typecode, values)
+
+
+def _array_from(typecode, data, offset, count):
+    values = array(typecode)
+    values.fromstring(data[offset:offset + values.itemsize * count])
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def _little_endian(values):
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+
+def _padded(size):
+    return size + (-size % 8)
+
+
+def _padding(data):
+    return data + '\0' * (-len(data) % 8)
+
+
+def _json_float(value):
+    # JSON has no infinities either, so they go out as null like NaN
+    if math.isnan(value) or math.isinf(value):
+        return 'null'
+    return repr(value)
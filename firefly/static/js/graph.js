@@ -259,6 +259,11 @@ firefly.Graph.prototype.setTitle = function(title) {
 	}
 };
 
+/** whether the graph has a title of its own, rather than its sources' */
+firefly.Graph.prototype.hasCustomTitle = function() {
+	return !!this._title;
+};
+
 firefly.Graph.prototype.updateTitle = function() {
 	if (!this._title) {
 		if (this.renderer) this.renderer.title(this.getSources());
@@ -1,4 +1,5 @@
 goog.provide("firefly.Renderer");
+goog.provide("firefly.GraphBatcher");
 
 goog.require('goog.debug.Logger');
 
@@ -28,8 +29,14 @@ firefly.Renderer = function(graph, makeURL, container, titleEl, legendEl, contai
 	// a web worker to do our background processing
 	this.worker = new Worker(this.makeURL_("static/js/renderer_worker.js"));
 	this.worker.onmessage = $.proxy(function(evt) {
+		if (evt.data.batch) {
+			firefly.Renderer.batcher_.add(this.worker, evt.data.batch);
+			return;
+		}
 		d3.select(this.container).style("opacity", 1.0);
 		this._redraw(evt.data);
+		this.lastTitles_ = {"sources": JSON.stringify(evt.data.sources), "titles": evt.data.titles};
+		this._showTitles(evt.data.titles);
 	}, this);
 	this.worker.onerror = $.proxy(function(evt) {
 		d3.select(this.container).style("opacity", 0.2);
@@ -43,10 +50,81 @@ firefly.Renderer = function(graph, makeURL, container, titleEl, legendEl, contai
 };
 
 
+/**
+ * Collects the /graph queries the workers of every graph make while the
+ * dashboard refreshes them, and sends them as one /data/batch request per
+ * data server, handing each worker its part of the response.
+ * @constructor
+ */
+firefly.GraphBatcher = function() {
+	this.pending_ = [];
+	this.timeoutID_ = null;
+};
+
+// how long to wait for the queries of the other graphs, in ms
+firefly.GraphBatcher.prototype.DELAY = 20;
+
+/**
+ * Queues a worker's query, {id, dataServer, token, query}, for the next batch.
+ */
+firefly.GraphBatcher.prototype.add = function(worker, request) {
+	this.pending_.push({"worker": worker, "request": request});
+	if (this.timeoutID_ === null) {
+		this.timeoutID_ = window.setTimeout($.proxy(this.flush_, this), this.DELAY);
+	}
+};
+
+firefly.GraphBatcher.prototype.flush_ = function() {
+	this.timeoutID_ = null;
+	var batches = {};
+	for (var i = 0; i < this.pending_.length; i++) {
+		var request = this.pending_[i].request;
+		var batchKey = request.dataServer + " " + request.token;
+		batches[batchKey] = batches[batchKey] || [];
+		batches[batchKey].push(this.pending_[i]);
+	}
+	this.pending_ = [];
+	for (var batchKey in batches) {
+		this.send_(batches[batchKey]);
+	}
+};
+
+firefly.GraphBatcher.prototype.send_ = function(batch) {
+	var first = batch[0].request;
+	var xhr = new XMLHttpRequest();
+	xhr.open("POST", first.dataServer + "/data/batch?format=columnar&token=" + first.token, true);
+	xhr.onreadystatechange = function() {
+		if (xhr.readyState !== 4) return;
+		var graphs = null;
+		var status = xhr.status;
+		if (status === 200) {
+			try {
+				graphs = JSON.parse(xhr.responseText);
+			} catch (err) {
+				status = 500;
+			}
+		}
+		for (var i = 0; i < batch.length; i++) {
+			batch[i].worker.postMessage({"batched": {
+				"id": batch[i].request.id,
+				"status": status,
+				"graph": graphs && graphs[i]
+			}});
+		}
+	};
+	// sent as text/plain, which spares us a CORS preflight
+	xhr.send(JSON.stringify(batch.map(function(entry) { return entry.request.query; })));
+};
+
+
 firefly.Renderer.prototype.longDateFormatter_ = d3.time.format("%a %Y-%m-%d %H:%M");
 firefly.Renderer.prototype.shortDateFormatter_ = d3.time.format("%H:%M");
 
 
+// shared by the renderers of every graph
+firefly.Renderer.batcher_ = new firefly.GraphBatcher();
+
+
 firefly.Renderer.prototype.cleanup = function() {
 	// this seems to be necessary to prevent chrome from
 	// getting its workers all messed up
@@ -636,6 +714,7 @@ firefly.Renderer.prototype.drawAnnotations = function(div, data){
 		.text(function(d){
 			var label = d.type;
 			if (data.options.short_annotations) label = label.substring(0,1);
+			if (d.count > 1) label += " \u00d7" + d.count;
 			return label;
 		})
 		.style('top', function(d) { return (renderer._pickAnnotationToolTipLocation(d, this, data)[1]) + 'px'; })
@@ -935,46 +1014,34 @@ firefly.Renderer.prototype._dsDescFromSourcerer = function(dataServerURL) {
 	return matchingSources[0].desc;
 };
 
-firefly.Renderer.prototype.sendTitleXHR = function(dataServer, sources) {
-	return $.ajax({
-		url: dataServer + '/title',
-		dataType: 'json',
-		data: {
-			'sources': JSON.stringify(sources),
-			'token'  : this.graph_.sourcerer.getToken()
-		},
-		context: this,
-		success: function(data) {
-			this.collectedTitles[dataServer] = data['title'];
-			if (Object.keys(this.titleXHRs).length !== Object.keys(this.collectedTitles).length) return;
-
-			var newTitle = $.map(this.collectedTitles, function(title, ds) { return [title]; });
-			newTitle = newTitle.reduce(this.arrayLongestCommonPrefix);
-
-			$(this.titleEl).html( newTitle.join(RIGHT_ARROW));
-			this.titleElements = newTitle;
-
-			// The graph title is linked to the legend, so we can only compute
-			// the legend when we have a title.
-			this.graph_.updateLegend();
-		}
-	});
-};
+/**
+ * Shows the title the data servers gave the graph's sources, which the worker
+ * gets along with the data, unless the graph has a title of its own.
+ */
+firefly.Renderer.prototype._showTitles = function(titles) {
+	if (!titles || this.graph_.hasCustomTitle()) return;
 
-firefly.Renderer.prototype.title = function(sources) {
-	if (this.titleXHRs) {
-		$.each(this.titleXHRs, function (idx, xhr) {
-			xhr.abort();
-		});
-	}
-	this.titleXHRs = {};
-	this.collectedTitles = {};
+	var newTitle = $.map(titles, function(title, ds) { return [title]; });
+	newTitle = newTitle.reduce(this.arrayLongestCommonPrefix);
+	var titleKey = JSON.stringify(newTitle);
+	if (titleKey === this.titleKey_) return;
+	this.titleKey_ = titleKey;
 
-	var dataServerToSources = this._buildDataServerToSourcesMap(sources);
-	var dataServer;
+	$(this.titleEl).html( newTitle.join(RIGHT_ARROW));
+	this.titleElements = newTitle;
 
-	for (dataServer in dataServerToSources) {
-		var requestSources = dataServerToSources[dataServer];
-		this.titleXHRs[dataServer] = this.sendTitleXHR(dataServer, requestSources);
+	// The graph title is linked to the legend, so we can only compute
+	// the legend when we have a title.
+	this.graph_.updateLegend();
+};
+
+/**
+ * Shows the data servers' title for sources again: now if the worker last
+ * sent it for the same sources, otherwise once it does.
+ */
+firefly.Renderer.prototype.title = function(sources) {
+	this.titleKey_ = null;
+	if (this.lastTitles_ && this.lastTitles_.sources === JSON.stringify(sources)) {
+		this._showTitles(this.lastTitles_.titles);
 	}
 };
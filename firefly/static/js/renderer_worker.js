@@ -6,9 +6,38 @@ var previousXHRs;
 var annotationsXHR;
 var sourcesPerDataServer;
 
+// The series we last got from each data server, so that refreshes only
+// have to ask for the points after the cursor that came with them.
+// "current"/"previous" -> data server -> {key, cursor, series}
+var cachedSeries = {"current": {}, "previous": {}};
+
+// Long-polls of /stream keeping cachedSeries.current up to date while the
+// graph shows a live window without an overlay.
+// data server -> {key, sourcesParam, xhr}
+var streams = {};
+var lastAnnotationsData = [];
+
+// The title each data server gave its sources in its last /graph response.
+// data server -> {sourcesParam, title}
+var titles = {};
+
+// /graph requests the renderer is making for us, as part of a /data/batch
+// request for every graph of the dashboard.
+// id -> BatchedRequest
+var batchedRequests = {};
+var nextBatchedRequestId = 0;
+
 var NO_DATA_FOR_TIMESTAMP = "nodata";
 
+// see firefly/series.py for the layout of the binary data format
+var BINARY_CONTENT_TYPE = "application/x-firefly-series";
+var BINARY_HEADER_SIZE = 24;
+
 self.onmessage = function(evt) {
+	if (evt.data.batched) {
+		onBatched(evt.data.batched);
+		return;
+	}
 	data = evt.data;
 	data.end = Math.floor(Date.now() / 1000);
 	data.start = data.end - data.zoom;
@@ -51,46 +80,159 @@ self.onmessage = function(evt) {
 		sourcesPerDataServer[dataServer][sourceIndex] = source;
 	}
 
-	for (dataServer in sourcesPerDataServer) {
-		var dataServerSources = [];
-		var sortedDataServerPosKeys = Object.keys(sourcesPerDataServer[dataServer]).sort();
-		for (var _posKey = 0; _posKey < sortedDataServerPosKeys.length; _posKey++) {
-			var posKey = sortedDataServerPosKeys[_posKey];
-			dataServerSources.push(sourcesPerDataServer[dataServer][posKey]);
+	for (dataServer in streams) {
+		if (!sourcesPerDataServer[dataServer] || data.options.overlay_previous_period) {
+			stopStream(dataServer);
 		}
+	}
+
+	for (dataServer in sourcesPerDataServer) {
+		var dataServerSources = sourcesFor(dataServer);
+		// a stream is already keeping our points for this graph up to date
+		if (isStreaming(dataServer, seriesKey(dataServerSources))) continue;
+		stopStream(dataServer);
+
 		// start our new request(s)
-		currentXHRs[dataServer] = fetchData(dataServer, dataServerSources, data.start, data.end);
+		currentXHRs[dataServer] = fetchData(dataServer, dataServerSources, data.start, data.end, "current");
 		if (data.options.overlay_previous_period) {
-			previousXHRs[dataServer] = fetchData(dataServer, dataServerSources, data.start - data.offset, data.end - data.offset);
+			previousXHRs[dataServer] = fetchData(dataServer, dataServerSources, data.start - data.offset, data.end - data.offset, "previous");
 		}
 	}
-	if (data.options.show_annotations) {
-		// TODO (fhats): Pull annotations from all the different data servers, not just one
-		// TODO (fhats): Annotations shouldn't require any knowledge of the sources.
+	// TODO (fhats): Pull annotations from all the different data servers, not just one
+	if (data.options.show_annotations && !currentXHRs[data.sources[0][0]]) {
+		// its data is streamed in, so there's no /graph response to get
+		// the annotations from
 		annotationsXHR = fetchAnnotations(data.sources[0][0], data.sources, data.start, data.end);
+	} else {
+		annotationsXHR = null;
+	}
+
+	if (!Object.keys(currentXHRs).length && !annotationsXHR) {
+		// everything we need is streamed in already
+		handleResponse();
 	}
 };
 
-function fetchData(dataServer, sources, start, end) {
+/**
+ * The graph's sources on dataServer, in order.
+ */
+function sourcesFor(dataServer) {
+	var sources = [];
+	var sortedDataServerPosKeys = Object.keys(sourcesPerDataServer[dataServer]).sort();
+	for (var _posKey = 0; _posKey < sortedDataServerPosKeys.length; _posKey++) {
+		var posKey = sortedDataServerPosKeys[_posKey];
+		sources.push(sourcesPerDataServer[dataServer][posKey]);
+	}
+	return sources;
+}
+
+function sourcesParamFor(sources) {
+	return JSON.stringify(sources.map(function (x){ return x.slice(1); }));
+}
+
+/**
+ * The graph we have cached points for has to match this one in everything
+ * but the (sliding) window for us to reuse them.
+ */
+function seriesKey(sources) {
+	return [sourcesParamFor(sources), data.zoom, data.width, data.offset].join("|");
+}
+
+/**
+ * Fetches the data for a period of the graph. The current period comes from
+ * a /graph query, along with the title and annotations, which the renderer
+ * batches with those of the other graphs of the dashboard (see
+ * BatchedRequest); the previous period only needs the data.
+ */
+function fetchData(dataServer, sources, start, end, period) {
+	var sourcesParam = sourcesParamFor(sources);
+	var graph = period === "current";
+	var key = seriesKey(sources);
+	var cached = cachedSeries[period][dataServer];
+	var cursor = null;
+	if (cached && cached.key === key && cached.cursor) {
+		cursor = cached.cursor;
+	} else {
+		delete cachedSeries[period][dataServer];
+	}
+	var cacheInfo = {"period": period, "key": key, "start": start - 60, "sourcesParam": sourcesParam, "graph": graph};
+
+	if (graph) {
+		var query = {
+			"sources": JSON.parse(sourcesParam),
+			"start":   start - 60, // buffer for one minute
+			"end":     end,
+			"width":   data.width,
+			"graph":   true
+		};
+		if (cursor) query.cursor = cursor;
+		return new BatchedRequest(dataServer, query, cacheInfo);
+	}
+
 	var xhr = new XMLHttpRequest();
 	var url = dataServer + "/data?" +
-		"sources=" + encodeURIComponent(JSON.stringify(sources.map(function (x){ return x.slice(1); }))) +
+		"sources=" + encodeURIComponent(sourcesParam) +
 		"&start="  + (start - 60) + // buffer for one minute
 		"&end="    + end +
 		"&width="  + data.width +
+		"&format=binary" +
 		"&token="  + data.token;
+	if (cursor) {
+		url += "&cursor=" + encodeURIComponent(cursor);
+	}
+	xhr.fireflyCache = cacheInfo;
 
 	xhr.open("GET", url, true);
+	xhr.responseType = "arraybuffer";
 	xhr.onreadystatechange = handleResponse;
 	xhr.send(null);
 	return xhr;
 }
 
+/**
+ * Stands in for the XHR of a /graph request: the query goes to the
+ * renderer, which sends it to the data server in a /data/batch request along
+ * with the other graphs' and hands us back our part of the response (see
+ * onBatched). Like an XHR, it's complete once its readyState is 4, and was
+ * aborted if its status is then 0.
+ */
+function BatchedRequest(dataServer, query, cacheInfo) {
+	this.id = nextBatchedRequestId++;
+	this.readyState = 1;
+	this.status = 0;
+	this.fireflyCache = cacheInfo;
+	batchedRequests[this.id] = this;
+	self.postMessage({"batch": {"id": this.id, "dataServer": dataServer, "token": data.token, "query": query}});
+}
+
+BatchedRequest.prototype.abort = function() {
+	if (this.readyState === 4) return;
+	delete batchedRequests[this.id];
+	this.readyState = 4;
+	this.status = 0;
+};
+
+/**
+ * Completes a BatchedRequest with what the renderer got for it: the status
+ * of the batch and, if that went well, the /graph object for our query.
+ */
+function onBatched(response) {
+	var request = batchedRequests[response.id];
+	// aborted by a newer render
+	if (!request) return;
+	delete batchedRequests[response.id];
+	request.status = response.status;
+	request.fireflyGraph = response.graph;
+	request.readyState = 4;
+	handleResponse();
+}
+
 function fetchAnnotations(dataServer, sources, start, end) {
 	var xhr = new XMLHttpRequest();
 	var url = dataServer + "/annotations?" +
 		"start="  + (start - 60) + // buffer for one minute
 		"&end="    + end +
+		"&width="  + data.width + // clustered to one per pixel
 		"&token="  + data.token;
 
 	xhr.open("GET", url, true);
@@ -159,18 +301,177 @@ function makeNoDataArray(size) {
 	return arr;
 }
 
-function dataObjFromXHRs(xhrs) {
+/**
+ * Wraps a binary data response in typed arrays, without copying the
+ * columns out of the response buffer.
+ */
+function seriesFromBinary(buffer) {
+	var header = new DataView(buffer, 0, BINARY_HEADER_SIZE);
+	var valueSize = header.getUint8(5);
+	var length = header.getUint32(8, true);
+	var columnCount = header.getUint32(12, true);
+	// int64; exact for any timestamp we'll ever see
+	var first = header.getUint32(16, true) + header.getInt32(20, true) * 4294967296;
+
+	var offset = BINARY_HEADER_SIZE;
+	var deltas = new Int32Array(buffer, offset, length);
+	offset += padded(4 * length);
+
+	var timestamps = new Array(length);
+	var t = first;
+	for (var i = 0; i < length; i++) {
+		t += deltas[i];
+		timestamps[i] = t;
+	}
+
+	var ValueArray = valueSize === 4 ? Float32Array : Float64Array;
+	var columns = [];
+	for (var c = 0; c < columnCount; c++) {
+		columns.push(new ValueArray(buffer, offset, length));
+		offset += padded(valueSize * length);
+	}
+	return {"timestamps": timestamps, "columns": columns};
+}
+
+function padded(size) {
+	return size + (8 - size % 8) % 8;
+}
+
+/**
+ * Reads a columnar format series (see firefly/series.py) into
+ * {timestamps, columns}.
+ */
+function seriesFromColumnar(columnar) {
+	var columns = columnar.series;
+	var length = columns.length ? columns[0].length : 0;
+	var timestamps = new Array(length);
+	var t = columnar.start;
+	for (var i = 0; i < length; i++) {
+		if (columnar.t_deltas) {
+			t += columnar.t_deltas[i];
+			timestamps[i] = t;
+		} else {
+			timestamps[i] = columnar.start + i * columnar.step;
+		}
+	}
+	return {"timestamps": timestamps, "columns": columns};
+}
+
+/**
+ * Parses (once) the JSON body of a /graph response.
+ */
+function graphFromXHR(xhr) {
+	if (!xhr.fireflyGraph) {
+		xhr.fireflyGraph = JSON.parse(new TextDecoder("utf-8").decode(new Uint8Array(xhr.response)));
+	}
+	return xhr.fireflyGraph;
+}
+
+/**
+ * Reads a data response into {timestamps, columns}, whether the data server
+ * sent a /graph response, the binary format or (if it predates it) JSON.
+ */
+function seriesFromXHR(xhr) {
+	if (xhr.fireflyCache.graph) {
+		return seriesFromColumnar(graphFromXHR(xhr).data);
+	}
+
+	var contentType = xhr.getResponseHeader("Content-Type") || "";
+	if (contentType.indexOf(BINARY_CONTENT_TYPE) === 0) {
+		return seriesFromBinary(xhr.response);
+	}
+
+	var response = JSON.parse(new TextDecoder("utf-8").decode(new Uint8Array(xhr.response)));
+	var series = {"timestamps": [], "columns": []};
+	for (var pointIdx = 0; pointIdx < response.length; pointIdx++) {
+		var point = response[pointIdx];
+		series.timestamps.push(point.t);
+		for (var c = 0; c < point.v.length; c++) {
+			series.columns[c] = series.columns[c] || [];
+			series.columns[c].push(point.v[c]);
+		}
+	}
+	return series;
+}
+
+/**
+ * Merges the points of an incremental response into the cached series: they
+ * replace every cached point from their first timestamp on, and points
+ * before start have slid out of the window.
+ */
+function mergeSeries(cached, update, start) {
+	var first = update.timestamps.length ? update.timestamps[0] : Infinity;
+	var keepFrom = 0;
+	while (keepFrom < cached.timestamps.length && cached.timestamps[keepFrom] < start) keepFrom++;
+	var keepTo = keepFrom;
+	while (keepTo < cached.timestamps.length && cached.timestamps[keepTo] < first) keepTo++;
+
+	var merged = {
+		"timestamps": cached.timestamps.slice(keepFrom, keepTo).concat(toArray(update.timestamps)),
+		"columns": []
+	};
+	for (var c = 0; c < cached.columns.length; c++) {
+		merged.columns.push(cached.columns[c].slice(keepFrom, keepTo).concat(toArray(update.columns[c] || [])));
+	}
+	return merged;
+}
+
+function toArray(values) {
+	return Array.prototype.slice.call(values);
+}
+
+/**
+ * Reads the series for a data XHR, merging incremental responses into what
+ * we already had, and caches the result for the next refresh.
+ */
+function cachedSeriesFromXHR(dataServer, xhr) {
+	var series = seriesFromXHR(xhr);
+	var info = xhr.fireflyCache;
+	var cached = cachedSeries[info.period][dataServer];
+	if (cached && cached.key === info.key) {
+		series = mergeSeries(cached.series, series, info.start);
+	} else {
+		series = {
+			"timestamps": toArray(series.timestamps),
+			"columns": series.columns.map(toArray)
+		};
+	}
+	var cursor = info.graph ? graphFromXHR(xhr).cursor : xhr.getResponseHeader("X-Firefly-Cursor");
+	cachedSeries[info.period][dataServer] = {
+		"key": info.key,
+		"cursor": cursor === null ? null : String(cursor),
+		"series": series
+	};
+	return series;
+}
+
+function dataObjFromXHRs(xhrs, period, start) {
+	for (var dataServer in xhrs) {
+		cachedSeriesFromXHR(dataServer, xhrs[dataServer]);
+	}
+	return dataObjFromCache(period, start);
+}
+
+/**
+ * Builds the data for the graph from the cached series of each data server,
+ * from start on.
+ */
+function dataObjFromCache(period, start) {
 	var dataServer;
-	var response;
+	var series;
 	var parsedData = {};
-	for (dataServer in xhrs) {
-		response = JSON.parse(xhrs[dataServer].responseText);
-		for (var pointIdx = 0; pointIdx < response.length; pointIdx++) {
-			var point = response[pointIdx];
-			parsedData[point.t] = parsedData[point.t] || makeNoDataArray(data.sources.length);
-			for (var posIdx = 0; posIdx < point.v.length; posIdx++) {
-				var originalPosition = Object.keys(sourcesPerDataServer[dataServer]).sort()[posIdx];
-				parsedData[point.t][originalPosition] = point.v[posIdx];
+	for (dataServer in sourcesPerDataServer) {
+		if (!cachedSeries[period][dataServer]) continue;
+		series = cachedSeries[period][dataServer].series;
+		var originalPositions = Object.keys(sourcesPerDataServer[dataServer]).sort();
+		for (var pointIdx = 0; pointIdx < series.timestamps.length; pointIdx++) {
+			var t = series.timestamps[pointIdx];
+			if (t < start) continue;
+			parsedData[t] = parsedData[t] || makeNoDataArray(data.sources.length);
+			for (var posIdx = 0; posIdx < series.columns.length; posIdx++) {
+				var value = series.columns[posIdx][pointIdx];
+				// nulls are sent as NaN in the binary format
+				parsedData[t][originalPositions[posIdx]] = value !== value ? null : value;
 			}
 		}
 	}
@@ -211,9 +512,9 @@ function handleResponse() {
 	var previousData = [];
 	var annotationsData = [];
 
-	currentData = dataObjFromXHRs(currentXHRs);
+	currentData = dataObjFromXHRs(currentXHRs, "current", data.start - 60);
 	if (data.options.overlay_previous_period) {
-		previousData = dataObjFromXHRs(previousXHRs);
+		previousData = dataObjFromXHRs(previousXHRs, "previous", data.start - data.offset - 60);
 	}
 	if (data.options.show_annotations && annotationsXHR) {
 		try {
@@ -224,9 +525,127 @@ function handleResponse() {
 			// Let's just assume there's nothing to show.
 			annotationsData = [];
 		}
+	} else if (data.options.show_annotations && currentXHRs[data.sources[0][0]]) {
+		annotationsData = graphFromXHR(currentXHRs[data.sources[0][0]]).annotations || [];
+	}
+	lastAnnotationsData = annotationsData;
+
+	for (var dataServer in currentXHRs) {
+		titles[dataServer] = {
+			"sourcesParam": currentXHRs[dataServer].fireflyCache.sourcesParam,
+			"title": graphFromXHR(currentXHRs[dataServer]).title
+		};
 	}
 
 	processData(currentData, previousData, annotationsData);
+
+	if (!data.options.overlay_previous_period) {
+		for (dataServer in currentXHRs) {
+			startStream(dataServer, currentXHRs[dataServer].fireflyCache);
+		}
+	}
+}
+
+function isStreaming(dataServer, key) {
+	var cached = cachedSeries.current[dataServer];
+	return !data.options.overlay_previous_period &&
+		streams[dataServer] && streams[dataServer].key === key &&
+		cached && cached.key === key;
+}
+
+function startStream(dataServer, cacheInfo) {
+	if (streams[dataServer] && streams[dataServer].key === cacheInfo.key) return;
+	stopStream(dataServer);
+	streams[dataServer] = {"key": cacheInfo.key, "sourcesParam": cacheInfo.sourcesParam, "xhr": null};
+	pollStream(dataServer);
+}
+
+function stopStream(dataServer) {
+	var stream = streams[dataServer];
+	if (!stream) return;
+	delete streams[dataServer];
+	stream.xhr && stream.xhr.abort();
+}
+
+/**
+ * Waits for the data server to have points after our cursor, merges them
+ * into the cached series, redraws and waits again. If anything goes wrong
+ * the stream just stops, and the next refresh fetches /data as usual.
+ */
+function pollStream(dataServer) {
+	var stream = streams[dataServer];
+	var cached = cachedSeries.current[dataServer];
+	var xhr = new XMLHttpRequest();
+	var url = dataServer + "/stream?" +
+		"sources=" + encodeURIComponent(stream.sourcesParam) +
+		"&zoom="   + (data.zoom + 60) + // same buffer as fetchData
+		"&width="  + data.width +
+		"&format=binary" +
+		"&token="  + data.token;
+	if (cached && cached.cursor) {
+		url += "&cursor=" + encodeURIComponent(cached.cursor);
+	}
+	xhr.fireflyCache = {
+		"period": "current",
+		"key": stream.key,
+		"start": Math.floor(Date.now() / 1000) - data.zoom - 60,
+		"sourcesParam": stream.sourcesParam
+	};
+
+	xhr.open("GET", url, true);
+	xhr.responseType = "arraybuffer";
+	xhr.onreadystatechange = function() {
+		if (xhr.readyState !== 4 || streams[dataServer] !== stream) return;
+		if (xhr.status !== 200) {
+			stopStream(dataServer);
+			return;
+		}
+		var previousCursor = cached && cached.cursor;
+		cachedSeriesFromXHR(dataServer, xhr);
+		if (cachedSeries.current[dataServer].cursor !== previousCursor) {
+			renderFromCache();
+		}
+		pollStream(dataServer);
+	};
+	stream.xhr = xhr;
+	xhr.send(null);
+}
+
+/**
+ * Redraws the live window from the cached series, unless a refresh is
+ * already on its way.
+ */
+function renderFromCache() {
+	if (!allXHRsComplete()) return;
+	data.end = Math.floor(Date.now() / 1000);
+	data.start = data.end - data.zoom;
+	processData(dataObjFromCache("current", data.start - 60), [], lastAnnotationsData);
+}
+
+/**
+ * Returns the title each data server gave the graph's sources, or null
+ * until we have all of them.
+ */
+function currentTitles() {
+	var result = {};
+	for (var dataServer in sourcesPerDataServer) {
+		var title = titles[dataServer];
+		if (!title || title.sourcesParam !== sourcesParamFor(sourcesFor(dataServer))) return null;
+		result[dataServer] = title.title;
+	}
+	return result;
+}
+
+/**
+ * Sums up a cluster of annotations, e.g. "12 annotations: 9 deploy, 3 push"
+ */
+function describeCluster(cluster) {
+	var types = Object.keys(cluster.counts).sort(function (a, b) {
+		return (cluster.counts[b] - cluster.counts[a]) || (a < b ? -1 : 1);
+	});
+	return cluster.count + " annotations: " + types.map(function (type) {
+		return cluster.counts[type] + " " + type;
+	}).join(", ");
 }
 
 function processData(currentData, previousData, annotationsData) {
@@ -282,11 +701,13 @@ function processData(currentData, previousData, annotationsData) {
 	// restructure annotations so we have the correct types for all the data
 	var annotations = [];
 	for(var idx in annotationsData){
+		var annotation = annotationsData[idx];
 		annotations.push({
-			id: parseInt(annotationsData[idx].id),
-			type: annotationsData[idx].type,
-			description: annotationsData[idx].description,
-			time: parseFloat(annotationsData[idx].time) * 1000
+			id: parseInt(annotation.id),
+			type: annotation.type,
+			description: annotation.count > 1 ? describeCluster(annotation) : annotation.description,
+			time: parseFloat(annotation.time) * 1000,
+			count: annotation.count || 1
 		});
 	}
 
@@ -300,6 +721,8 @@ function processData(currentData, previousData, annotationsData) {
 		"layerCount"     : layerCount,
 		"currentLayers"  : currentLayers,
 		"previousLayers" : previousLayers,
-		"annotations"    : annotations
+		"annotations"    : annotations,
+		"sources"        : data.sources,
+		"titles"         : currentTitles()
 	});
 }
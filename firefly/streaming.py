@@ -0,0 +1,223 @@
+"""Live streaming of new points to dashboards.
+
+Rather than re-requesting their whole window on a timer, live graphs can
+long-poll /stream with the cursor of the data they have (see DataHandler):
+the request is held open until there are points newer than the cursor, then
+answered with just those points and a new cursor.
+
+Clients streaming the same sources at the same resolution share a
+StreamGroup, which polls the data source once per step of the series (but
+no more often than `stream_min_interval`) for as long as anyone is
+listening, keeps the points of the window in memory and fans each update
+out to every waiting client. A client which falls behind simply gets
+everything after its cursor in one response when it comes back, so slow
+consumers never queue up updates on the server. The number of requests
+held open by a worker is capped at `stream_max_subscribers`, beyond which
+/stream answers 503.
+
+Each data server worker process runs its own groups.
+"""
+import functools
+import logging
+import time
+
+from tornado import stack_context
+
+from firefly import downsample
+from firefly import series
+
+log = logging.getLogger(__name__)
+
+DEFAULT_POLL_TIMEOUT = 30
+DEFAULT_MIN_INTERVAL = 5
+DEFAULT_IDLE_TIMEOUT = 60
+DEFAULT_MAX_SUBSCRIBERS = 1000
+
+
+class TooManySubscribers(Exception):
+    """Raised by StreamGroup.wait when the worker holds as many streaming
+    requests as it is allowed to."""
+
+
+class StreamHub(object):
+    """The stream groups of a data server worker, keyed by what they poll.
+
+    settings are the data server's Application settings, which provide the
+    executors used to call the data sources and the stream_* options.
+    """
+
+    def __init__(self, settings, revised_steps, clock=time.time):
+        self.settings = settings
+        self.revised_steps = revised_steps
+        self.clock = clock
+        self.groups = {}
+        self.subscribers = 0
+
+    @property
+    def max_subscribers(self):
+        return self.settings.get('stream_max_subscribers', DEFAULT_MAX_SUBSCRIBERS)
+
+    def group(self, data_source, sources, zoom, width, algorithm):
+        """Returns the group streaming the last `zoom` seconds of sources,
+        starting it if there isn't one yet."""
+        now = int(self.clock())
+        step = data_source.step(sources, now - zoom, now, width)
+        key = (data_source._FF_KEY, tuple(tuple(source) for source in sources), zoom, width, step, algorithm)
+        if key not in self.groups:
+            self.groups[key] = StreamGroup(self, key, data_source, sources, zoom, width, step, algorithm)
+        return self.groups[key]
+
+    def remove(self, group):
+        if self.groups.get(group.key) is group:
+            del self.groups[group.key]
+
+    def stats(self):
+        return {
+            'groups': len(self.groups),
+            'subscribers': self.subscribers,
+            'polls': sum(group.polls for group in self.groups.itervalues()),
+        }
+
+
+class StreamGroup(object):
+    """Polls a data source for one set of sources on behalf of every client
+    streaming them, keeping the last `zoom` seconds of points."""
+
+    def __init__(self, hub, key, data_source, sources, zoom, width, step, algorithm):
+        self.hub = hub
+        self.key = key
+        self.data_source = data_source
+        self.sources = sources
+        self.zoom = zoom
+        self.width = width
+        self.step = step
+        self.algorithm = algorithm
+        self.points = None
+        self.polls = 0
+        # cursor -> list of (callback, timeout) of the requests waiting for
+        # points after that cursor
+        self._waiters = {}
+        self._polling = False
+        self._last_waited = hub.clock()
+
+    @property
+    def executor(self):
+        return self.hub.settings['executors'][self.data_source._FF_KEY]
+
+    @property
+    def interval(self):
+        return max(self.step, self.hub.settings.get('stream_min_interval', DEFAULT_MIN_INTERVAL))
+
+    def wait(self, cursor, callback):
+        """Passes callback the points after cursor (a timestamp, or None for
+        the whole window), as soon as there are any, or raises
+        TooManySubscribers.
+
+        The last couple of points before the cursor are included in case
+        they have been revised. If nothing new turns up within the stream
+        poll timeout, callback gets an empty Series.
+        Returns a function which cancels the wait.
+        """
+        self._last_waited = self.hub.clock()
+        if self._has_points_after(cursor):
+            callback(self._points_after(cursor))
+            return lambda: None
+
+        if self.hub.subscribers >= self.hub.max_subscribers:
+            raise TooManySubscribers()
+
+        io_loop = self.executor.io_loop
+        callback = stack_context.wrap(callback)
+
+        def cancel(timed_out=False):
+            waiters = self._waiters.get(cursor, [])
+            for idx, (_, timeout) in enumerate(waiters):
+                if timeout is waiter_timeout:
+                    del waiters[idx]
+                    if not waiters:
+                        del self._waiters[cursor]
+                    if not timed_out:
+                        io_loop.remove_timeout(timeout)
+                    self.hub.subscribers -= 1
+                    return
+
+        def on_timeout():
+            cancel(timed_out=True)
+            callback(series.Series([], [[] for _ in self.sources]))
+
+        waiter_timeout = io_loop.add_timeout(
+            time.time() + self.hub.settings.get('stream_poll_timeout', DEFAULT_POLL_TIMEOUT), on_timeout)
+        self._waiters.setdefault(cursor, []).append((callback, waiter_timeout))
+        self.hub.subscribers += 1
+
+        if not self._polling:
+            self._polling = True
+            # polls outlive the request that started them
+            with stack_context.NullContext():
+                self._poll()
+        return cancel
+
+    def _has_points_after(self, cursor):
+        if self.points is None or not len(self.points):
+            return False
+        return cursor is None or self.points.timestamps[-1] > cursor
+
+    def _points_after(self, cursor):
+        if cursor is None:
+            return self.points
+        return self.points.since(cursor - self.hub.revised_steps * self.step)
+
+    def _poll(self):
+        now = int(self.hub.clock())
+        if self.points is not None and len(self.points):
+            start = self.points.timestamps[-1] - self.hub.revised_steps * self.step
+        else:
+            start = now - self.zoom
+        end = now
+        width = self.width
+        if width > 0:
+            # ask for the tail at the resolution of the whole window
+            width = max(1, (end - start) // self.step)
+
+        self.polls += 1
+        self.executor.submit('data', (self.sources, start, end, width), self._on_data,
+            self._on_error, transform=functools.partial(downsample.from_result,
+                sources=len(self.sources), width=width, algorithm=self.algorithm))
+
+    def _on_data(self, update):
+        try:
+            if self.points is None:
+                self.points = update
+            else:
+                self.points = self.points.updated_with(update)
+            self.points = self.points.since(int(self.hub.clock()) - self.zoom)
+            self._notify()
+        except Exception:
+            log.error("Streaming poll of %s failed", self.key, exc_info=True)
+        finally:
+            self._schedule()
+
+    def _on_error(self, exc_info):
+        log.error("Streaming poll of %s failed", self.key, exc_info=exc_info)
+        self._schedule()
+
+    def _notify(self):
+        for cursor in [cursor for cursor in self._waiters if self._has_points_after(cursor)]:
+            # everyone waiting on the same cursor shares the same Series, and
+            # so its encodings
+            points = self._points_after(cursor)
+            for callback, timeout in self._waiters.pop(cursor):
+                self.executor.io_loop.remove_timeout(timeout)
+                self.hub.subscribers -= 1
+                try:
+                    callback(points)
+                except Exception:
+                    log.exception("Error delivering streamed points")
+
+    def _schedule(self):
+        if not self._waiters and self.hub.clock() - self._last_waited > self.hub.settings.get(
+                'stream_idle_timeout', DEFAULT_IDLE_TIMEOUT):
+            self._polling = False
+            self.hub.remove(self)
+            return
+        self.executor.io_loop.add_timeout(time.time() + self.interval, self._poll)
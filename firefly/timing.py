@@ -0,0 +1,150 @@
+"""Per-phase timing of data server requests.
+
+Every data server response carries a Server-Timing header breaking down
+where the time went, e.g.
+
+    Server-Timing: auth;dur=0.04, parse;dur=0.11, queue;dur=0.32,
+        data;dur=3921.70, rrdtool;dur=3790.12, parse_xml;dur=130.81,
+        decode;dur=21.50, encode;dur=8.03, total;dur=3953.05
+
+Handlers time their own phases with RequestTiming.phase. Data source code
+runs on an executor, away from the request, so it times its phases (running
+rrdtool, parsing its output, calling another server, ...) with the
+module-level phase(); the executor collects those along with the duration of
+the call itself (named after the method) and the time the call spent queued,
+and hands them back to the request that asked for the call. Durations of
+phases which happen more than once in a request (e.g. one http call per
+data server an aggregating data source calls) are added up.
+
+Requests slower than the data server's `slow_request_threshold` (in
+seconds; 0 turns it off) are logged with this breakdown, and the sources and
+window they asked for, to the firefly.slow_requests logger.
+"""
+from __future__ import with_statement
+
+import contextlib
+import json
+import logging
+import threading
+import time
+
+slow_log = logging.getLogger('firefly.slow_requests')
+
+DEFAULT_SLOW_REQUEST_THRESHOLD = 2.0
+
+_local = threading.local()
+
+
+class RequestTiming(object):
+    """The durations of the phases of one request, in the order they first
+    happened."""
+
+    def __init__(self):
+        self.phases = []
+        self._durations = {}
+
+    def add(self, name, duration):
+        if name not in self._durations:
+            self.phases.append(name)
+            self._durations[name] = 0.0
+        self._durations[name] += duration
+
+    def duration(self, name):
+        return self._durations.get(name, 0.0)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - started)
+
+    def items(self):
+        return [(name, self._durations[name]) for name in self.phases]
+
+    def header(self, total=None):
+        """Formats the phases as the value of a Server-Timing header."""
+        items = self.items()
+        if total is not None:
+            items.append(('total', total))
+        return ', '.join('%s;dur=%.2f' % (name, duration * 1000) for name, duration in items)
+
+
+def of(request):
+    """Returns the RequestTiming of a request, which ServerTimingTransform
+    normally sets up."""
+    if getattr(request, 'timing', None) is None:
+        request.timing = RequestTiming()
+    return request.timing
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Times a phase of the data source call running in this thread.
+
+    Outside of collect() this does nothing, so data sources can use it
+    whoever calls them.
+    """
+    started = time.time()
+    try:
+        yield
+    finally:
+        phases = getattr(_local, 'phases', None)
+        if phases is not None:
+            phases.append((name, time.time() - started))
+
+
+@contextlib.contextmanager
+def collect(into=None):
+    """Collects the phases timed with phase() in this thread into the list
+    it yields: into, if given (e.g. the list of the thread which started
+    this one, see current), or a new one."""
+    outer = getattr(_local, 'phases', None)
+    _local.phases = phases = into if into is not None else []
+    try:
+        yield phases
+    finally:
+        _local.phases = outer
+
+
+def current():
+    """Returns the list phases are being collected into in this thread, or
+    None"""
+    return getattr(_local, 'phases', None)
+
+
+class ServerTimingTransform(object):
+    """Output transform which gives each request a RequestTiming and sends
+    it as the Server-Timing header of the response."""
+
+    def __init__(self, request):
+        self.request = request
+        of(request)
+
+    def transform_first_chunk(self, headers, chunk, finishing):
+        headers['Server-Timing'] = self.request.timing.header(self.request.request_time())
+        # lets browsers show the timings of cross-origin requests
+        headers['Timing-Allow-Origin'] = '*'
+        return headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        return chunk
+
+
+def log_slow_request(handler, threshold):
+    """Logs handler's request to the slow request log if it took at least
+    threshold seconds."""
+    request_time = handler.request.request_time()
+    if not threshold or request_time < threshold:
+        return
+
+    details = []
+    params = getattr(handler, 'params', None)
+    if params and params.get('data_source') is not None:
+        details.append('data_source=%s' % type(params['data_source']).__name__)
+        details.append('sources=%s' % json.dumps(params['sources']))
+        details.append('start=%s end=%s width=%s' % (params['start'], params['end'], params['width']))
+    details.append(of(handler.request).header(request_time))
+    slow_log.warning("Slow request %d %s %.2fms: %s", handler.get_status(),
+        handler._request_summary(), 1000.0 * request_time, ' '.join(details))
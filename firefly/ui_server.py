@@ -17,6 +17,7 @@ import tornado.ioloop
 import tornado.httpserver
 
 import util
+from firefly import compression
 
 log = logging.getLogger('firefly_ui_server')
 
@@ -152,6 +153,32 @@ class DashboardListHandler(tornado.web.RequestHandler):
         self.render("templates/list_dashboards.html", **env)
 
 
+def make_application(config):
+    """Builds the UI server application for the given UI server config"""
+    config['transforms'] = compression.transforms(config)
+
+    # tornado.web.Application routes static_url_prefix to its own
+    # StaticFileHandler whenever static_path is set, which would shadow ours,
+    # so static_path is only put into the settings once the routes are built
+    settings = dict(config)
+    static_path = settings.pop('static_path')
+    static_options = {"path": static_path}
+    application = tornado.web.Application([
+        (re.escape(settings['static_url_prefix']) + r"(.*)", compression.PrecompressedStaticFileHandler, static_options),
+        (r"/", IndexHandler),
+        (r"/token", TokenHandler),
+        (r"/shorten", ShortenHandler),
+        (r"/expand/(.*)", ExpandHandler),
+        (r"/redirect/(.*)", RedirectHandler),
+        (r"/named/(.*)", NameHandler),
+        (r"/dashboards", DashboardListHandler),
+        (r"/static/(.*)", compression.PrecompressedStaticFileHandler, static_options),
+        (r"/(favicon\.ico)", compression.PrecompressedStaticFileHandler, static_options),
+    ], **settings)
+    application.settings['static_path'] = static_path
+    return application
+
+
 def initialize_ui_server(config_global, secret_key=None):
     config = config_global["ui_server"]
 
@@ -169,16 +196,7 @@ def initialize_ui_server(config_global, secret_key=None):
     config['autoescape'] = None
 
     # init the application instance
-    application = tornado.web.Application([
-        (r"/", IndexHandler),
-        (r"/token", TokenHandler),
-        (r"/shorten", ShortenHandler),
-        (r"/expand/(.*)", ExpandHandler),
-        (r"/redirect/(.*)", RedirectHandler),
-        (r"/named/(.*)", NameHandler),
-        (r"/dashboards", DashboardListHandler),
-        (r"/static/(.*)", tornado.web.StaticFileHandler, {"path": config['static_path']}),
-    ], **config)
+    application = make_application(config)
 
     # start the main server
     http_server = tornado.httpserver.HTTPServer(application)
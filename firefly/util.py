@@ -51,6 +51,10 @@ def verify_access_token(token, key):
     false if it either failed to validate or has expired.
 
     A token is a combination of a unix timestamp and a signature"""
+    # Tornado hands us unicode arguments, which hmac.compare_digest refuses
+    # to compare against the hexdigest str
+    if isinstance(token, unicode):
+        token = token.encode('utf-8')
     t = token[:15]
     signature = token[15:]
     expected_signature = hmac.new(key, msg=t, digestmod=hashlib.sha1).hexdigest()
@@ -34,7 +34,7 @@ setup(
     provides=['firefly'],
     author='Yelp',
     description='A multi-datacenter graphing tool',
-    packages=find_packages(exclude=['tests']),
+    packages=find_packages(exclude=['tests', 'benchmarks']),
     long_description="""Firefly provides graphing of performance metrics from multiple data centers and sources.
     Firefly works with both the Ganglia and Statmonster data sources.
     """,
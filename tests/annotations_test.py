@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""Contains tests for the in-memory annotation index and /annotations."""
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import testify as T
+
+from firefly import annotations
+from tests.testing import DataServerTestCase
+
+
+def insert(db_conn, rows):
+    db_conn.executemany("INSERT INTO annotations (type, description, time) VALUES (?,?,?)", rows)
+
+
+class AnnotationIndexTest(T.TestCase):
+
+    @T.setup
+    def make_db(self):
+        self.db_conn = annotations.connect(':memory:')
+        insert(self.db_conn, [('deploy', 'b', 20.0), ('deploy', 'a', 10.0), ('outage', 'c', 30.0)])
+        self.index = annotations.AnnotationIndex(self.db_conn)
+
+    def descriptions(self, start, end, **kwargs):
+        # enough bins for every annotation to get its own
+        return [row['description'] for row in self.index.cluster(start, end, 1000, **kwargs)]
+
+    def test_window(self):
+        rows = self.index.cluster(10, 20, 1000)
+        T.assert_equal([row['description'] for row in rows], ['b', 'a'])
+        T.assert_equal(rows[0], {'type': 'deploy', 'description': 'b', 'time': 20.0, 'id': 1, 'count': 1})
+        T.assert_equal(self.descriptions(11, 19), [])
+        T.assert_equal(len(self.descriptions(0, 100)), 3)
+
+    def test_added_rows_are_picked_up(self):
+        insert(self.db_conn, [('deploy', 'late', 40.0), ('deploy', 'backfilled', 15.0)])
+        # not until the index is told
+        T.assert_equal(len(self.index), 3)
+        self.index.added()
+        T.assert_equal(self.descriptions(0, 100), ['late', 'c', 'b', 'backfilled', 'a'])
+
+    def test_types(self):
+        T.assert_equal(self.descriptions(0, 100, types=['outage', 'nope']), ['c'])
+
+
+class ClusterTest(T.TestCase):
+
+    @T.setup
+    def make_db(self):
+        self.db_conn = annotations.connect(':memory:')
+        insert(self.db_conn, [
+            ('deploy', 'alone', 5.0),
+            ('deploy', 'd1', 31.0),
+            ('push', 'p1', 33.0),
+            ('deploy', 'd2', 39.5),
+            ('push', 'edge', 100.0),
+        ])
+        self.index = annotations.AnnotationIndex(self.db_conn)
+
+    def test_bins(self):
+        # bins of 10 seconds
+        clusters = self.index.cluster(0, 100, 10)
+        T.assert_equal([cluster['count'] for cluster in clusters], [1, 3, 1])
+
+        edge, busy, alone = clusters
+        T.assert_equal(alone, {'type': 'deploy', 'description': 'alone', 'time': 5.0, 'id': 1, 'count': 1})
+        # the end of the window belongs to the last bin
+        T.assert_equal(edge['description'], 'edge')
+        T.assert_equal(busy, {
+            'type': 'deploy',
+            'time': 39.5,
+            'id': 4,
+            'start': 31.0,
+            'count': 3,
+            'counts': {'deploy': 2, 'push': 1},
+        })
+
+    def test_types(self):
+        clusters = self.index.cluster(0, 100, 10, types=['push'])
+        T.assert_equal([cluster['description'] for cluster in clusters], ['edge', 'p1'])
+
+    def test_nothing_is_dropped(self):
+        insert(self.db_conn, [('deploy', 'x', float(t)) for t in xrange(1000, 2000)])
+        self.index.added()
+        clusters = self.index.cluster(1000, 1999, 7)
+        T.assert_equal(len(clusters), 7)
+        T.assert_equal(sum(cluster['count'] for cluster in clusters), 1000)
+        T.assert_equal(self.index.cluster(0, 2000, 1)[0]['count'], 1005)
+
+
+class SiblingWorkerTest(T.TestCase):
+    """Workers forked from one index see each other's writes"""
+
+    @T.setup
+    def make_db(self):
+        self.directory = tempfile.mkdtemp()
+        db_file = os.path.join(self.directory, 'annotations.sqlite')
+        self.index = annotations.AnnotationIndex(annotations.connect(db_file))
+        self.sibling_db_conn = annotations.connect(db_file)
+
+    @T.teardown
+    def remove_db(self):
+        shutil.rmtree(self.directory)
+
+    def test_wal(self):
+        T.assert_equal(self.sibling_db_conn.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+
+    def test_sibling_writes(self):
+        T.assert_equal(self.index.cluster(0, 100, 100), [])
+        pid = os.fork()
+        if not pid:
+            try:
+                insert(self.sibling_db_conn, [('deploy', 'from a sibling', 50.0)])
+                self.index.added()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        T.assert_equal([row['description'] for row in self.index.cluster(0, 100, 100)], ['from a sibling'])
+
+
+class AnnotationsHandlerTest(DataServerTestCase):
+
+    def make_config(self):
+        return {'db': annotations.connect(':memory:')}
+
+    def add(self, an_type, description, an_time):
+        return self.fetch(self.url('/add_annotation'), method='POST', body='type=%s&description=%s&time=%s&token=%s' % (
+            an_type, description, an_time, self.token()))
+
+    def test_add_and_query(self):
+        T.assert_equal(self.add('deploy', 'first', 100).code, 200)
+        T.assert_equal(self.add('deploy', 'second', 200).code, 200)
+        rows = json.loads(self.fetch(self.url('/annotations', start=0, end=150)).body)
+        T.assert_equal([row['description'] for row in rows], ['first'])
+        rows = json.loads(self.fetch(self.url('/annotations', start=0, end=300)).body)
+        T.assert_equal([row['description'] for row in rows], ['second', 'first'])
+
+    def test_clustered_to_width(self):
+        for idx in xrange(4):
+            self.add('deploy', 'deploy', 100 + idx)
+        self.add('push', 'push', 250)
+        rows = json.loads(self.fetch(self.url('/annotations', start=0, end=300, width=3)).body)
+        T.assert_equal([row['count'] for row in rows], [1, 4])
+        T.assert_equal(rows[1]['counts'], {'deploy': 4})
+
+        url = self.url('/annotations', start=0, end=300, width=3) + '&type=push'
+        T.assert_equal([row['type'] for row in json.loads(self.fetch(url).body)], ['push'])
+
+
+class BulkAnnotationsTest(DataServerTestCase):
+
+    def make_config(self):
+        return {
+            'db': annotations.connect(':memory:'),
+            'annotations_flush_rows': 5,
+            'annotations_flush_interval': 0.2,
+        }
+
+    def post(self, body, content_type='application/json'):
+        return self.fetch(self.url('/add_annotations'), method='POST', body=body,
+            headers={'Content-Type': content_type})
+
+    def query(self):
+        return json.loads(self.fetch(self.url('/annotations', start=0, end=1000, width=1000)).body)
+
+    def count(self):
+        return sum(row['count'] for row in self.query())
+
+    def test_json(self):
+        response = self.post(json.dumps([
+            {'type': 'deploy', 'description': 'one', 'time': 100},
+            {'type': 'deploy', 'description': 'two', 'time': 200.5},
+        ]))
+        T.assert_equal(response.code, 200)
+        T.assert_equal(json.loads(response.body), {'status': 'ok', 'added': 2})
+        T.assert_equal([row['description'] for row in self.query()], ['two', 'one'])
+
+    def test_ndjson(self):
+        body = '\n'.join(json.dumps({'type': 'push', 'description': 'row %d' % idx, 'time': idx})
+            for idx in xrange(3)) + '\n'
+        response = self.post(body, 'application/x-ndjson')
+        T.assert_equal(json.loads(response.body)['added'], 3)
+        T.assert_equal(self.count(), 3)
+
+    def test_invalid_rows_reject_the_batch(self):
+        for annotation in [
+                {'type': 'bad type', 'description': 'x', 'time': 1},
+                {'type': 'deploy', 'description': 'semicolons;', 'time': 1},
+                {'type': 'deploy', 'description': 'x', 'time': 'noon'},
+                {'type': 'deploy', 'description': 'x'},
+                'not an object']:
+            response = self.post(json.dumps([{'type': 'deploy', 'description': 'fine', 'time': 1}, annotation]))
+            T.assert_equal(response.code, 400)
+        T.assert_equal(self.post('[{').code, 400)
+        T.assert_equal(self.query(), [])
+
+    def test_flushes_on_size(self):
+        started = time.time()
+        self.post(json.dumps([{'type': 'deploy', 'description': 'x', 'time': idx} for idx in xrange(5)]))
+        T.assert_lt(time.time() - started, 0.2)
+
+    def test_concurrent_requests_share_a_flush(self):
+        body = json.dumps([{'type': 'deploy', 'description': 'x', 'time': 1}])
+        started = time.time()
+        responses = self.fetch_all([self.url('/add_annotations')] * 3, method='POST', body=body)
+        # too few rows to fill a batch, so they waited for the interval
+        T.assert_gte(time.time() - started, 0.2)
+        T.assert_equal([response.code for response in responses], [200] * 3)
+        T.assert_equal(self.count(), 3)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""Contains tests for the data server's result cache."""
+import os
+import shutil
+import tempfile
+
+import testify as T
+
+from firefly import cache
+from firefly import series
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class ResultCacheTest(T.TestCase):
+
+    @T.setup
+    def setup_cache(self):
+        self.clock = FakeClock()
+        self.cache = cache.ResultCache(max_bytes=100, clock=self.clock)
+
+    def test_get_put(self):
+        T.assert_equal(self.cache.get('a'), None)
+        self.cache.put('a', 'value', 5, ttl=10)
+        T.assert_equal(self.cache.get('a'), 'value')
+        T.assert_equal(self.cache.stats()['hits'], 1)
+        T.assert_equal(self.cache.stats()['misses'], 1)
+
+    def test_ttl(self):
+        self.cache.put('a', 'value', 5, ttl=10)
+        self.clock.now += 11
+        T.assert_equal(self.cache.get('a'), None)
+        T.assert_equal(self.cache.bytes, 0)
+        T.assert_equal(self.cache.expirations, 1)
+
+    def test_evicts_least_recently_used_by_bytes(self):
+        self.cache.put('a', 'A', 40, ttl=10)
+        self.cache.put('b', 'B', 40, ttl=10)
+        self.cache.get('a')
+        self.cache.put('c', 'C', 40, ttl=10)
+
+        T.assert_equal(self.cache.get('b'), None)
+        T.assert_equal(self.cache.get('a'), 'A')
+        T.assert_equal(self.cache.get('c'), 'C')
+        T.assert_equal(self.cache.bytes, 80)
+        T.assert_equal(self.cache.evictions, 1)
+
+    def test_replace_and_oversized(self):
+        self.cache.put('a', 'A', 40, ttl=10)
+        self.cache.put('a', 'AA', 50, ttl=10)
+        self.cache.put('huge', 'H', 101, ttl=10)
+        T.assert_equal(self.cache.bytes, 50)
+        T.assert_equal(len(self.cache), 1)
+
+
+class SharedCacheTest(T.TestCase):
+
+    @T.setup
+    def setup_cache(self):
+        self.clock = FakeClock()
+        self.directory = tempfile.mkdtemp()
+        self.cache = cache.SharedCache(self.directory, max_bytes=1000, sweep_every=1, clock=self.clock)
+
+    @T.teardown
+    def remove_directory(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_put(self):
+        T.assert_equal(self.cache.get(('legend', 'ds0', (('a', 'b'),))), None)
+        self.cache.put(('legend', 'ds0', (('a', 'b'),)), [[['a', 'b'], '#ff0000']], ttl=10)
+        T.assert_equal(self.cache.get(('legend', 'ds0', (('a', 'b'),))), [[['a', 'b'], '#ff0000']])
+
+        data = series.Series([100, 110], [[1.0, 2.0], [3.0, 4.0]])
+        self.cache.put(('data', 'ds0'), data, ttl=10)
+        T.assert_equal(self.cache.get(('data', 'ds0')).to_rows(), data.to_rows())
+        T.assert_equal(self.cache.stats()['hits'], 2)
+        T.assert_equal(self.cache.stats()['misses'], 1)
+
+    def test_ttl(self):
+        self.cache.put('a', 'value', ttl=10)
+        self.clock.now += 4
+        T.assert_equal(self.cache.get_with_ttl('a'), ('value', 6))
+        self.clock.now += 7
+        T.assert_equal(self.cache.get('a'), None)
+        T.assert_equal(self.cache.stats()['entries'], 0)
+
+    def test_evicts_least_recently_used_by_bytes(self):
+        for key in ('a', 'b'):
+            self.cache.put(key, 'x' * 400, ttl=10)
+            # mtimes only have a second's precision on some filesystems
+            os.utime(self.cache._path(key), (0, 0) if key == 'a' else (1, 1))
+        self.cache.get('a')
+        self.cache.put('c', 'x' * 400, ttl=10)
+
+        T.assert_equal(self.cache.get('b'), None)
+        T.assert_not_equal(self.cache.get('a'), None)
+        T.assert_not_equal(self.cache.get('c'), None)
+        T.assert_equal(self.cache.stats()['evictions'], 1)
+
+    def test_shared_by_forked_processes(self):
+        pid = os.fork()
+        if not pid:
+            try:
+                self.cache.put('a', 'from a sibling', ttl=10)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        T.assert_equal(self.cache.get('a'), 'from a sibling')
+
+    def test_clear_only_removes_entries(self):
+        self.cache.put('a', 'value', ttl=10)
+        open(self.cache._path('b') + '.123.tmp', 'w').close()
+        open(os.path.join(self.directory, 'unrelated'), 'w').close()
+        self.cache.clear()
+        T.assert_equal(os.listdir(self.directory), ['unrelated'])
+
+    def test_default_directory(self):
+        # the same for every run of a server, so that it's reused rather
+        # than leaked on every restart
+        T.assert_equal(cache.default_shared_directory(8890), cache.default_shared_directory(8890))
+        T.assert_not_equal(cache.default_shared_directory(8890), cache.default_shared_directory(8891))
+
+
+class KeyTest(T.TestCase):
+
+    def test_align_window(self):
+        T.assert_equal(cache.align_window(1005, 1994, 10), (1000, 2000))
+        T.assert_equal(cache.align_window(1000, 2000, 10), (1000, 2000))
+        T.assert_equal(cache.align_window(1005, 1994, 1), (1005, 1994))
+
+    def test_window_ttl(self):
+        T.assert_equal(cache.window_ttl(995, 10, 5, 500, now=1000), 5)
+        T.assert_equal(cache.window_ttl(900, 10, 5, 500, now=1000), 500)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Contains tests for response compression."""
+import gzip
+import os
+import shutil
+import socket
+import StringIO
+import tempfile
+import zlib
+
+import testify as T
+import tornado.httpserver
+import tornado.ioloop
+import tornado.simple_httpclient
+import tornado.web
+
+from firefly import compression
+from tests.testing import DataServerTestCase
+
+
+class AcceptedEncodingTest(T.TestCase):
+
+    def test_accepted_encoding(self):
+        T.assert_equal(compression.accepted_encoding(''), None)
+        T.assert_equal(compression.accepted_encoding('identity'), None)
+        T.assert_equal(compression.accepted_encoding('gzip, deflate'), 'gzip')
+        T.assert_equal(compression.accepted_encoding('deflate'), 'deflate')
+        T.assert_equal(compression.accepted_encoding('gzip;q=0.5, deflate'), 'deflate')
+        T.assert_equal(compression.accepted_encoding('GZIP;q=0'), None)
+
+
+class DataServerCompressionTest(DataServerTestCase):
+
+    def make_config(self):
+        return {'compression_min_bytes': 1024}
+
+    @T.setup
+    def use_simple_http_client(self):
+        # curl decompresses responses itself whatever we ask for
+        self.http_client = tornado.simple_httpclient.SimpleAsyncHTTPClient(self.io_loop)
+
+    def fetch_encoded(self, url, accept_encoding):
+        return self.fetch(url, use_gzip=False, headers={'Accept-Encoding': accept_encoding})
+
+    def test_gzip(self):
+        url = self.data_url([['stat0']], 1000, 3000, width=0)
+        plain = self.fetch_encoded(url, 'identity')
+        gzipped = self.fetch_encoded(url, 'gzip')
+
+        T.assert_equal(plain.headers.get('Content-Encoding'), None)
+        T.assert_equal(gzipped.headers['Content-Encoding'], 'gzip')
+        T.assert_equal(gzipped.headers['Vary'], 'Accept, Accept-Encoding')
+        T.assert_lt(len(gzipped.body), len(plain.body))
+        T.assert_equal(gzip.GzipFile(fileobj=StringIO.StringIO(gzipped.body)).read(), plain.body)
+
+    def test_deflate(self):
+        url = self.data_url([['stat0']], 1000, 3000, width=0, format='binary')
+        plain = self.fetch_encoded(url, 'identity')
+        deflated = self.fetch_encoded(url, 'deflate')
+
+        T.assert_equal(deflated.headers['Content-Encoding'], 'deflate')
+        T.assert_equal(zlib.decompress(deflated.body), plain.body)
+
+    def test_small_responses_are_not_compressed(self):
+        response = self.fetch_encoded(self.data_url([['stat0']], 100, 120), 'gzip')
+        T.assert_equal(response.headers.get('Content-Encoding'), None)
+        T.assert_lt(len(response.body), 1024)
+
+
+class DisabledCompressionTest(DataServerTestCase):
+
+    def make_config(self):
+        return {'compression_level': 0}
+
+    @T.setup
+    def use_simple_http_client(self):
+        self.http_client = tornado.simple_httpclient.SimpleAsyncHTTPClient(self.io_loop)
+
+    def test_not_compressed(self):
+        url = self.data_url([['stat0']], 1000, 3000, width=0)
+        response = self.fetch(url, use_gzip=False, headers={'Accept-Encoding': 'gzip'})
+        T.assert_equal(response.headers.get('Content-Encoding'), None)
+
+
+class PrecompressedStaticFileHandlerTest(T.TestCase):
+
+    @T.setup
+    def make_static_dir(self):
+        self.static_path = tempfile.mkdtemp()
+        with open(os.path.join(self.static_path, 'app.js'), 'w') as f:
+            f.write('var x = 1;\n' * 500)
+        with open(os.path.join(self.static_path, 'logo.png'), 'w') as f:
+            f.write('not really a png')
+
+    @T.teardown
+    def remove_static_dir(self):
+        shutil.rmtree(self.static_path)
+
+    def fetch(self, path, accept_encoding):
+        io_loop = tornado.ioloop.IOLoop()
+        application = tornado.web.Application([
+            (r"/static/(.*)", compression.PrecompressedStaticFileHandler, {'path': self.static_path}),
+        ], transforms=compression.transforms({}))
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        server = tornado.httpserver.HTTPServer(application, io_loop=io_loop)
+        server.listen(port, '127.0.0.1')
+
+        responses = []
+        def on_response(response):
+            responses.append(response)
+            io_loop.stop()
+        tornado.simple_httpclient.SimpleAsyncHTTPClient(io_loop).fetch(
+            'http://127.0.0.1:%d/static/%s' % (port, path), on_response,
+            use_gzip=False, headers={'Accept-Encoding': accept_encoding})
+        io_loop.start()
+        server.stop()
+        return responses[0]
+
+    def test_precompress_static(self):
+        T.assert_equal(compression.precompress_static(self.static_path), 1)
+        T.assert_equal(os.path.exists(os.path.join(self.static_path, 'logo.png.gz')), False)
+        # up to date copies aren't rewritten
+        T.assert_equal(compression.precompress_static(self.static_path), 0)
+
+    def test_serves_precompressed_copy(self):
+        compression.precompress_static(self.static_path)
+        with open(os.path.join(self.static_path, 'app.js.gz'), 'rb') as f:
+            precompressed = f.read()
+
+        response = self.fetch('app.js', 'gzip')
+        T.assert_equal(response.headers['Content-Encoding'], 'gzip')
+        T.assert_equal(response.body, precompressed)
+
+        response = self.fetch('app.js', 'identity')
+        T.assert_equal(response.headers.get('Content-Encoding'), None)
+        T.assert_equal(response.body, 'var x = 1;\n' * 500)
+
+    def test_stale_copy_is_ignored(self):
+        compression.precompress_static(self.static_path)
+        gzpath = os.path.join(self.static_path, 'app.js.gz')
+        os.utime(gzpath, (0, 0))
+
+        response = self.fetch('app.js', 'gzip')
+        # compressed on the fly instead
+        T.assert_equal(response.headers['Content-Encoding'], 'gzip')
+        T.assert_equal(gzip.GzipFile(fileobj=StringIO.StringIO(response.body)).read(), 'var x = 1;\n' * 500)
@@ -0,0 +1,579 @@
+# -*- coding: utf-8 -*-
+"""Contains tests for the data server's request handlers."""
+import functools
+import json
+import time
+
+import testify as T
+
+from firefly import annotations
+from firefly import cache
+from firefly import deadlines
+from firefly import series
+from firefly.data_sources.test_data import TestData
+from tests.testing import DataServerTestCase
+from tests.testing import FakeDataSource
+
+
+class DataHandlerTest(DataServerTestCase):
+
+    def test_data(self):
+        response = self.fetch(self.data_url([['stat0'], ['stat1']], 100, 120))
+        T.assert_equal(response.code, 200)
+        T.assert_equal(json.loads(response.body), [
+            {'t': 100, 'v': [0.0, 1.0]},
+            {'t': 110, 'v': [10.0, 11.0]},
+            {'t': 120, 'v': [20.0, 21.0]}])
+
+    def test_binary_format(self):
+        response = self.fetch(self.data_url([['stat0'], ['stat1']], 100, 120, format='binary'))
+        T.assert_equal(response.code, 200)
+        T.assert_equal(response.headers['Content-Type'], series.BINARY_CONTENT_TYPE)
+        T.assert_equal(series.Series.from_binary(response.body).to_rows(), [
+            {'t': 100, 'v': [0.0, 1.0]},
+            {'t': 110, 'v': [10.0, 11.0]},
+            {'t': 120, 'v': [20.0, 21.0]}])
+
+    def test_format_from_accept_header(self):
+        url = self.data_url([['stat0']], 100, 120)
+        binary = self.fetch(url, headers={'Accept': series.BINARY_CONTENT_TYPE})
+        plain = self.fetch(url, headers={'Accept': 'application/json'})
+        T.assert_equal(binary.headers['Content-Type'], series.BINARY_CONTENT_TYPE)
+        T.assert_equal(len(series.Series.from_binary(binary.body)), 3)
+        T.assert_equal(plain.headers['Content-Type'], 'application/json')
+        T.assert_in('Accept', plain.headers['Vary'])
+
+    def test_columnar_format(self):
+        response = self.fetch(self.data_url([['stat0'], ['stat1']], 100, 120, format='columnar'))
+        T.assert_equal(response.headers['Content-Type'], 'application/json')
+        T.assert_equal(json.loads(response.body), {
+            'start': 100,
+            'step': 10,
+            'series': [[0.0, 10.0, 20.0], [1.0, 11.0, 21.0]]})
+
+    def test_unknown_format(self):
+        response = self.fetch(self.data_url([['stat0']], 100, 120, format='xml'))
+        T.assert_equal(response.code, 400)
+
+    def test_bad_token(self):
+        response = self.fetch(self.data_url([['stat0']], 100, 120, token='nope' * 20))
+        T.assert_equal(response.code, 403)
+
+    def test_data_source_error(self):
+        self.data_sources[0].data = lambda *args: 1 / 0
+        response = self.fetch(self.data_url([['stat0']], 100, 120))
+        T.assert_equal(response.code, 500)
+
+    def test_legend_title_and_sources(self):
+        legend, title, sources = self.fetch_all([
+            self.url('/legend', sources=json.dumps([['ds0', 'stat0']])),
+            self.url('/title', sources=json.dumps([['ds0', 'stat0']])),
+            self.url('/sources', path=json.dumps(['ds0']))])
+        T.assert_equal(json.loads(legend.body), {'legend': [[['stat0'], '#ff0000']]})
+        T.assert_equal(json.loads(title.body), {'title': ['fake']})
+        T.assert_equal(len(json.loads(sources.body)), 3)
+
+
+class MetaHandlerTest(DataServerTestCase):
+
+    def meta_url(self, sources):
+        return self.url('/meta', sources=json.dumps([['ds0'] + source for source in sources]))
+
+    def test_legend_and_title(self):
+        response = self.fetch(self.meta_url([['a', 'b'], ['a', 'c']]))
+        T.assert_equal(response.code, 200)
+        T.assert_equal(json.loads(response.body), {
+            'legend': [[['b'], '#ff0000'], [['c'], '#00ffff']],
+            'title': ['fake'],
+        })
+
+    def test_computed_once_per_sources(self):
+        calls = []
+        meta = self.data_sources[0].meta
+        self.data_sources[0].meta = lambda sources: (calls.append(sources), meta(sources))[1]
+
+        first, second = self.fetch_all([self.meta_url([['stat0']]), self.meta_url([['stat0']])])
+        third = self.fetch(self.meta_url([['stat0']]))
+        T.assert_equal(first.body, third.body)
+        T.assert_equal(second.body, third.body)
+        self.fetch(self.meta_url([['stat1']]))
+        T.assert_equal(calls, [[['stat0']], [['stat1']]])
+
+    def test_not_modified(self):
+        first = self.fetch(self.meta_url([['stat0']]))
+        etag = first.headers['Etag']
+        second = self.fetch(self.meta_url([['stat0']]), headers={'If-None-Match': etag})
+        T.assert_equal(second.code, 304)
+        T.assert_equal(second.body, '')
+        other = self.fetch(self.meta_url([['stat1']]), headers={'If-None-Match': etag})
+        T.assert_equal(other.code, 200)
+
+
+class GraphHandlerTest(DataServerTestCase):
+
+    def make_config(self):
+        return {'db': annotations.connect(':memory:')}
+
+    def test_graph(self):
+        self.application.settings['db'].execute(
+            "INSERT INTO annotations (type, description, time) VALUES ('deploy', 'x', 110)")
+        self.application.settings['annotations'].added()
+
+        response = self.fetch(self.url('/graph', sources=json.dumps([['ds0', 'stat0']]), start=100, end=120,
+            width=100))
+        T.assert_equal(response.code, 200)
+        T.assert_equal(json.loads(response.body), {
+            'data': [{'t': 100, 'v': [0.0]}, {'t': 110, 'v': [10.0]}, {'t': 120, 'v': [20.0]}],
+            'cursor': 120,
+            'missing': [],
+            'legend': [[['stat0'], '#ff0000']],
+            'title': ['fake'],
+            'annotations': [{'type': 'deploy', 'description': 'x', 'time': 110.0, 'id': 1, 'count': 1}],
+        })
+
+    def test_columnar(self):
+        response = self.fetch(self.url('/graph', sources=json.dumps([['ds0', 'stat0']]), start=100, end=120,
+            format='columnar'))
+        T.assert_equal(json.loads(response.body)['data'], {'start': 100, 'step': 10, 'series': [[0.0, 10.0, 20.0]]})
+        response = self.fetch(self.url('/graph', sources=json.dumps([['ds0', 'stat0']]), start=100, end=120,
+            format='binary'))
+        T.assert_equal(response.code, 400)
+
+    def test_cursor(self):
+        # how the renderer refreshes a graph
+        full = json.loads(self.fetch(self.url('/graph', sources=json.dumps([['ds0', 'stat0']]), start=1000,
+            end=2000, width=100, downsample='none', format='columnar')).body)
+        update = json.loads(self.fetch(self.url('/graph', sources=json.dumps([['ds0', 'stat0']]), start=1060,
+            end=2060, width=100, downsample='none', format='columnar', cursor=full['cursor'])).body)
+        T.assert_equal(update['cursor'], 2060)
+        T.assert_equal(update['data']['start'], 1980)
+        T.assert_equal(update['title'], ['fake'])
+
+    def test_concurrent(self):
+        def slow(method, *args):
+            time.sleep(0.2)
+            return method(*args)
+        data_source = self.data_sources[0]
+        data_source.data = functools.partial(slow, data_source.data)
+        data_source.meta = functools.partial(slow, data_source.meta)
+
+        started = time.time()
+        response = self.fetch(self.url('/graph', sources=json.dumps([['ds0', 'stat0']]), start=100, end=120))
+        T.assert_equal(response.code, 200)
+        T.assert_lt(time.time() - started, 0.35)
+
+
+class DownsampledDataTest(DataServerTestCase):
+
+    def test_downsampled_to_width(self):
+        # the fake data source returns a point every 10s whatever the width
+        url = self.data_url([['stat0'], ['stat1']], 1000, 3000, width=50)
+        average, lttb, raw = self.fetch_all(
+            [url, url + '&downsample=lttb', url + '&downsample=none'])
+        T.assert_equal(len(json.loads(raw.body)), 201)
+        T.assert_equal(len(json.loads(average.body)), 50)
+        T.assert_equal(json.loads(average.body)[0], {'t': 1000, 'v': [15.0, 16.0]})
+        T.assert_equal(len(json.loads(lttb.body)), 50)
+        # all from one data source call, downsampled separately
+        T.assert_equal(len(self.data_sources[0].data_calls), 3)
+
+    def test_default_algorithm(self):
+        self.application.settings['downsample'] = 'minmax'
+        response = self.fetch(self.data_url([['stat0']], 1000, 3000, width=50))
+        T.assert_equal(json.loads(response.body)[:2], [
+            {'t': 1000, 'v': [0.0]}, {'t': 1070, 'v': [70.0]}])
+
+    def test_unknown_algorithm(self):
+        response = self.fetch(self.data_url([['stat0']], 1000, 3000, width=50, downsample='nope'))
+        T.assert_equal(response.code, 400)
+
+
+class IncrementalDataTest(DataServerTestCase):
+
+    def test_since(self):
+        full = self.fetch(self.data_url([['stat0']], 1000, 2000, width=100, downsample='none'))
+        T.assert_equal(full.headers['X-Firefly-Cursor'], '2000')
+        T.assert_equal(self.data_sources[0].data_calls, [([['stat0']], 1000, 2000, 100)])
+
+        # a minute later, only the last couple of known points and the new
+        # ones come back, fetched at the same 10s resolution
+        update = self.fetch(self.data_url([['stat0']], 1060, 2060, width=100, downsample='none',
+            cursor=full.headers['X-Firefly-Cursor']))
+        T.assert_equal([row['t'] for row in json.loads(update.body)], range(1980, 2061, 10))
+        T.assert_equal(update.headers['X-Firefly-Cursor'], '2060')
+        T.assert_equal(self.data_sources[0].data_calls[1], ([['stat0']], 1980, 2060, 8))
+
+    def test_since_before_window(self):
+        response = self.fetch(self.data_url([['stat0']], 1000, 1100, width=0, since=500))
+        T.assert_equal(len(json.loads(response.body)), 11)
+
+    def test_nothing_new(self):
+        response = self.fetch(self.data_url([['stat0']], 1000, 1100, width=0, since=5000))
+        T.assert_equal(json.loads(response.body), [])
+        T.assert_equal(response.headers['X-Firefly-Cursor'], '5000')
+
+    def test_bad_cursor(self):
+        response = self.fetch(self.data_url([['stat0']], 1000, 1100, cursor='nope'))
+        T.assert_equal(response.code, 400)
+
+
+class DataFormatsTest(DataServerTestCase):
+    """Every wire format is available whatever the data source."""
+
+    def make_data_sources(self):
+        return [TestData()]
+
+    def test_formats_agree(self):
+        url = self.data_url([['test-data-plain'], ['test-data-scatter']], 1000, 1010)
+        plain, binary, columnar = self.fetch_all(
+            [url, url + '&format=binary', url + '&format=columnar'])
+        expected = series.Series.from_json(plain.body)
+        T.assert_equal(len(expected), 10)
+        T.assert_equal(series.Series.from_binary(binary.body), expected)
+        T.assert_equal(series.Series.from_columnar(columnar.body), expected)
+
+
+class NonBlockingDataHandlerTest(DataServerTestCase):
+    """Slow data source calls must not hold up other requests."""
+
+    def make_data_sources(self):
+        return [FakeDataSource(delay=0.5, executor_workers=2)]
+
+    def test_ping_while_data_in_flight(self):
+        finished = {}
+
+        def timed(url):
+            def on_response(response):
+                finished[url] = time.time()
+            return on_response
+
+        data_urls = [self.data_url([['stat0']], 100, 120), self.data_url([['stat1']], 100, 120)]
+        ping_url = self.url('/ping')
+        start = time.time()
+        for data_url in data_urls:
+            self.http_client.fetch(data_url, timed(data_url))
+        ping = self.fetch(ping_url)
+        ping_time = time.time() - start
+        # wait for the data requests too
+        while len(finished) < 2:
+            self.io_loop.add_timeout(time.time() + 0.05, self.io_loop.stop)
+            self.io_loop.start()
+
+        T.assert_equal(ping.body, 'pong\n')
+        T.assert_lt(ping_time, 0.4)
+        T.assert_equal(len(self.data_sources[0].data_calls), 2)
+
+
+class BulkheadTest(DataServerTestCase):
+    """A saturated data source sheds load without holding up the others."""
+
+    def make_data_sources(self):
+        return [
+            FakeDataSource(delay=0.3, executor_workers=1, executor_queue=1, executor_retry_after=7),
+            FakeDataSource(),
+        ]
+
+    def test_saturated_data_source(self):
+        urls = [self.data_url([['stat%d' % idx]], 100, 120) for idx in xrange(4)]
+        urls.append(self.data_url([['stat0']], 100, 120, data_source_idx=1))
+        responses = self.fetch_all(urls)
+
+        T.assert_equal(sorted(response.code for response in responses[:4]), [200, 200, 503, 503])
+        for response in responses[:4]:
+            if response.code == 503:
+                T.assert_equal(response.headers['Retry-After'], '7')
+        T.assert_equal(responses[4].code, 200)
+        T.assert_lt(responses[4].request_time, 0.3)
+
+        # and once the queue drains, calls are taken again
+        T.assert_equal(self.fetch(self.data_url([['stat9']], 100, 120)).code, 200)
+
+
+class PartialDataSource(FakeDataSource):
+    """Data source which only gets the data of sources named 'slow' once its
+    deadline has passed, or after 0.3 seconds if it has none."""
+
+    def data(self, sources, start, end, width):
+        with self._lock:
+            self.data_calls.append((sources, start, end, width))
+        rows = []
+        for t in xrange(start - start % self.interval, end + 1, self.interval):
+            rows.append({'t': t, 'v': [float(t % 100)] * len(sources)})
+        for idx, source in enumerate(sources):
+            if source == ['slow']:
+                if deadlines.current() is None:
+                    time.sleep(0.3)
+                    continue
+                while not deadlines.expired():
+                    time.sleep(0.01)
+                deadlines.mark_missing([idx])
+                for row in rows:
+                    row['v'][idx] = None
+        return json.dumps(rows)
+
+
+class DeadlineTest(DataServerTestCase):
+
+    def make_data_sources(self):
+        return [PartialDataSource(), FakeDataSource(delay=0.5)]
+
+    def test_missing_sources(self):
+        started = time.time()
+        response = self.fetch(self.data_url([['fast'], ['slow']], 100, 120, deadline=0.3))
+        T.assert_lt(time.time() - started, 0.5)
+        T.assert_equal(response.code, 200)
+        T.assert_equal(response.headers['X-Firefly-Missing'], '1')
+        T.assert_equal(json.loads(response.body)[0], {'t': 100, 'v': [0.0, None]})
+
+        # partial results aren't cached
+        self.fetch(self.data_url([['fast'], ['slow']], 100, 120, deadline=0.3))
+        T.assert_equal(len(self.data_sources[0].data_calls), 2)
+
+        response = self.fetch(self.data_url([['fast']], 100, 120, deadline=0.3))
+        T.assert_not_in('X-Firefly-Missing', response.headers)
+
+    def test_requests_without_deadline_get_whole_results(self):
+        sources = [['fast'], ['slow']]
+        # the request with a deadline starts the fetch, which it cuts short
+        partial, whole = self.fetch_all([self.data_url(sources, 100, 120, deadline=0.2),
+            self.data_url(sources, 100, 120)], stagger=0.05)
+        T.assert_equal(partial.headers['X-Firefly-Missing'], '1')
+        # not handed the partial result of the fetch in flight
+        T.assert_not_in('X-Firefly-Missing', whole.headers)
+        T.assert_equal(json.loads(whole.body)[0], {'t': 100, 'v': [0.0, 0.0]})
+        T.assert_equal(len(self.data_sources[0].data_calls), 2)
+
+    def test_different_deadlines_share_fetch(self):
+        url = self.data_url([['a']], 100, 120, data_source_idx=1)
+        responses = self.fetch_all([url + '&deadline=2', url + '&deadline=3'])
+        T.assert_equal([response.code for response in responses], [200, 200])
+        T.assert_equal([response.headers.get('X-Firefly-Missing') for response in responses],
+            [None, None])
+        T.assert_equal(len(self.data_sources[1].data_calls), 1)
+
+    def test_call_still_running(self):
+        started = time.time()
+        response = self.fetch(self.data_url([['a'], ['b']], 100, 120, data_source_idx=1, deadline=0.2))
+        T.assert_lt(time.time() - started, 0.4)
+        T.assert_equal(response.code, 200)
+        T.assert_equal(response.headers['X-Firefly-Missing'], '0,1')
+        T.assert_equal(json.loads(response.body), [])
+
+    def test_invalid_deadline(self):
+        T.assert_equal(self.fetch(self.data_url([['a']], 100, 120, deadline='soon')).code, 400)
+
+
+class DefaultDeadlineTest(DataServerTestCase):
+
+    def make_data_sources(self):
+        return [PartialDataSource()]
+
+    def make_config(self):
+        return {'request_deadline': 0.2}
+
+    def test_default_deadline(self):
+        response = self.fetch(self.data_url([['slow']], 100, 120))
+        T.assert_equal(response.headers['X-Firefly-Missing'], '0')
+        T.assert_lt(response.request_time, 0.3)
+        # which requests can override
+        response = self.fetch(self.data_url([['slow']], 100, 120, deadline=0.5))
+        T.assert_gte(response.request_time, 0.35)
+
+
+class DataCacheTest(DataServerTestCase):
+
+    def test_repeated_requests_hit_cache(self):
+        first = self.fetch(self.data_url([['stat0']], 1003, 1996, width=100))
+        second = self.fetch(self.data_url([['stat0']], 1005, 1998, width=100))
+        T.assert_equal(first.body, second.body)
+        # both windows align to [999, 1998] at a 9s step
+        T.assert_equal(self.data_sources[0].data_calls, [([['stat0']], 999, 1998, 100)])
+
+        stats = json.loads(self.fetch(self.url('/cache_stats')).body)
+        T.assert_equal(stats['hits'], 1)
+        T.assert_equal(stats['misses'], 1)
+        T.assert_equal(stats['entries'], 1)
+        T.assert_gt(stats['bytes'], 0)
+
+
+    def test_hits_are_trimmed_to_the_window(self):
+        # both align to [999, 1998], and share its points
+        wide = json.loads(self.fetch(self.data_url([['stat0']], 1000, 1996, width=100)).body)
+        narrow = json.loads(self.fetch(self.data_url([['stat0']], 1003, 1990, width=100)).body)
+        T.assert_equal(len(self.data_sources[0].data_calls), 1)
+
+        T.assert_equal(wide[0]['t'], 1000)
+        T.assert_equal(narrow[0]['t'], 1010)
+        T.assert_equal(narrow, [row for row in wide if 1003 <= row['t'] <= 1990])
+
+
+class SharedCacheTest(DataServerTestCase):
+    """Results cached by one worker are hits for the others"""
+
+    def other_worker(self):
+        # as far as the caches go, another worker is one with an empty cache
+        # of its own
+        self.application.settings['data_cache'] = cache.ResultCache()
+
+    def test_data(self):
+        first = self.fetch(self.data_url([['stat0']], 1000, 2000))
+        self.other_worker()
+        second = self.fetch(self.data_url([['stat0']], 1000, 2000))
+        T.assert_equal(first.body, second.body)
+        T.assert_equal(len(self.data_sources[0].data_calls), 1)
+
+        stats = json.loads(self.fetch(self.url('/cache_stats')).body)
+        T.assert_equal(stats['shared']['hits'], 1)
+        T.assert_equal(stats['shared']['entries'], 1)
+        # and it is now in this worker's cache too
+        T.assert_equal(stats['entries'], 1)
+
+    def test_sources_legend_and_title(self):
+        calls = []
+        data_source = self.data_sources[0]
+
+        def counted(method):
+            def call(*args):
+                calls.append(method.__name__)
+                return method(*args)
+            return call
+
+        for name in ('list_path', 'legend', 'title'):
+            setattr(data_source, name, counted(getattr(data_source, name)))
+
+        urls = [
+            self.url('/sources', path=json.dumps(['ds0'])),
+            self.url('/legend', sources=json.dumps([['ds0', 'stat0']])),
+            self.url('/title', sources=json.dumps([['ds0', 'stat0']])),
+        ]
+        first = [response.body for response in self.fetch_all(urls)]
+        self.other_worker()
+        second = [response.body for response in self.fetch_all(urls)]
+        T.assert_equal(first, second)
+        T.assert_equal(sorted(calls), ['legend', 'list_path', 'title'])
+
+
+class SharedCacheDisabledTest(DataServerTestCase):
+
+    def make_config(self):
+        return {'shared_cache_max_bytes': 0}
+
+    def test_data(self):
+        self.fetch(self.data_url([['stat0']], 1000, 2000))
+        self.application.settings['data_cache'] = cache.ResultCache()
+        self.fetch(self.data_url([['stat0']], 1000, 2000))
+        T.assert_equal(len(self.data_sources[0].data_calls), 2)
+
+
+class DataCoalescingTest(DataServerTestCase):
+
+    def make_data_sources(self):
+        return [FakeDataSource(delay=0.2)]
+
+    def test_concurrent_identical_requests_share_fetch(self):
+        url = self.data_url([['stat0']], 1000, 2000)
+        responses = self.fetch_all([url, url, url])
+
+        T.assert_equal(len(self.data_sources[0].data_calls), 1)
+        T.assert_equal([response.code for response in responses], [200] * 3)
+        T.assert_equal(len(set(response.body for response in responses)), 1)
+
+        stats = json.loads(self.fetch(self.url('/cache_stats')).body)
+        T.assert_equal(stats['fetches'], 1)
+        T.assert_equal(stats['coalesced'], 2)
+
+    def test_errors_reach_every_waiter(self):
+        def broken_data(*args):
+            time.sleep(0.2)
+            raise ValueError("backend exploded")
+        self.data_sources[0].data = broken_data
+
+        url = self.data_url([['stat0']], 1000, 2000)
+        responses = self.fetch_all([url, url])
+        T.assert_equal([response.code for response in responses], [500, 500])
+        T.assert_equal(len(self.application.settings['data_in_flight']), 0)
+
+    def test_undecodable_results_reach_every_waiter(self):
+        data_source = self.data_sources[0]
+        real_data = data_source.data
+        results = iter(['not json'])
+        def data(*args):
+            time.sleep(0.2)
+            return next(results, None) or real_data(*args)
+        data_source.data = data
+
+        url = self.data_url([['stat0']], 1000, 2000)
+        responses = self.fetch_all([url, url])
+        T.assert_equal([response.code for response in responses], [500, 500])
+        T.assert_equal(len(self.application.settings['data_in_flight']), 0)
+        # and the next identical request isn't left waiting on the broken fetch
+        T.assert_equal(self.fetch(url).code, 200)
+
+
+class DataBatchTest(DataServerTestCase):
+
+    def batch(self, queries, **params):
+        response = self.fetch(self.url('/data/batch', **params), method='POST', body=json.dumps(queries))
+        T.assert_equal(response.code, 200)
+        return json.loads(response.body)
+
+    def test_batch_groups_queries_by_window(self):
+        queries = [
+            {'sources': [['ds0', 'stat0']], 'start': 1000, 'end': 1020, 'width': 0},
+            {'sources': [['ds0', 'stat1'], ['ds0', 'stat0']], 'start': 1000, 'end': 1020, 'width': 0},
+            {'sources': [['ds0', 'stat2']], 'start': 2000, 'end': 2010, 'width': 0},
+        ]
+        results = self.batch(queries)
+
+        T.assert_equal(results, [
+            [{'t': 1000, 'v': [0.0]}, {'t': 1010, 'v': [10.0]}, {'t': 1020, 'v': [20.0]}],
+            [{'t': 1000, 'v': [1.0, 0.0]}, {'t': 1010, 'v': [11.0, 10.0]}, {'t': 1020, 'v': [21.0, 20.0]}],
+            [{'t': 2000, 'v': [0.0]}, {'t': 2010, 'v': [10.0]}],
+        ])
+        T.assert_equal(sorted(self.data_sources[0].data_calls), [
+            ([['stat0'], ['stat1']], 1000, 1020, 0),
+            ([['stat2']], 2000, 2010, 0),
+        ])
+
+        # the individual graphs were cached for /data too
+        response = self.fetch(self.data_url([['stat1'], ['stat0']], 1000, 1020, width=0))
+        T.assert_equal(json.loads(response.body), results[1])
+        T.assert_equal(len(self.data_sources[0].data_calls), 2)
+
+    def test_empty_and_invalid_batches(self):
+        T.assert_equal(self.batch([]), [])
+        for body in ['nope', '{}', '7', '[7]', '[{}]', '[{"sources": []}]', '[{"sources": "ds0"}]',
+                '[{"sources": [["nope", "stat0"]]}]', '[{"sources": [["ds0", "stat0"]], "start": "noon"}]',
+                '[{"sources": [["ds0", "stat0"]], "cursor": []}]',
+                '[{"sources": [["ds0", "stat0"]], "downsample": []}]']:
+            response = self.fetch(self.url('/data/batch'), method='POST', body=body)
+            T.assert_equal(response.code, 400, body)
+        T.assert_equal(self.data_sources[0].data_calls, [])
+
+    def test_columnar_batch(self):
+        queries = [{'sources': [['ds0', 'stat0']], 'start': 1000, 'end': 1020, 'width': 0}]
+        T.assert_equal(self.batch(queries, format='columnar'), [
+            {'start': 1000, 'step': 10, 'series': [[0.0, 10.0, 20.0]]}])
+
+        response = self.fetch(self.url('/data/batch', format='binary'), method='POST', body=json.dumps(queries))
+        T.assert_equal(response.code, 400)
+
+    def test_graphs(self):
+        queries = [
+            {'sources': [['ds0', 'stat0']], 'start': 1000, 'end': 1020, 'width': 0, 'graph': True},
+            {'sources': [['ds0', 'stat1']], 'start': 1000, 'end': 1020, 'width': 0, 'graph': True,
+                'cursor': 1020},
+            {'sources': [['ds0', 'stat2']], 'start': 1000, 'end': 1020, 'width': 0},
+        ]
+        whole, since_cursor, data = self.batch(queries, format='columnar')
+
+        graph = json.loads(self.fetch(self.url('/graph', sources=json.dumps([['ds0', 'stat0']]),
+            start=1000, end=1020, format='columnar')).body)
+        T.assert_equal(whole, graph)
+        T.assert_equal(whole['cursor'], 1020)
+        T.assert_equal(since_cursor['title'], graph['title'])
+        T.assert_lt(len(since_cursor['data']['series'][0]), 3)
+        # fetched along with stat0, as the second source of the call
+        T.assert_equal(data, {'start': 1000, 'step': 10, 'series': [[1.0, 11.0, 21.0]]})
+        T.assert_equal(len(self.data_sources[0].data_calls), 2)
+
@@ -4,13 +4,19 @@ from contextlib import contextmanager
 from cStringIO import StringIO
 import json
 import mock
+import threading
+import time
 import urllib2
 import urlparse
 
 import testify as T
 
+from firefly import deadlines
 from firefly.data_sources.aggregating_data_source import AggregatingDataSource
+from firefly.data_sources.aggregating_data_source import RoutingTable
+from firefly.series import Series
 from firefly import util
+from tests.testing import StandInServer
 
 
 class AggregatingDataSourceTest(T.TestCase):
@@ -81,7 +87,7 @@ class AggregatingDataSourceTest(T.TestCase):
 		} for i in xrange(len(self.data_source.data_sources))]
 
 		with self._mock_ds_method('_request_paths_from_ds') as mock_request_paths:
-			mock_request_paths.side_effect = [[path] for path in expected_paths]
+			mock_request_paths.side_effect = self._by_data_source([[path] for path in expected_paths])
 
 			actual_paths = self.data_source.list_path(test_path)
 
@@ -93,12 +99,11 @@ class AggregatingDataSourceTest(T.TestCase):
 		T.assert_equal(expected_paths, actual_paths)
 
 		for expected_path, expected_data_source in zip(expected_paths, self.data_source.data_sources):
-			T.assert_in(expected_path['name'], self.data_source.key_mapping_cache)
-			T.assert_equal(self.data_source.key_mapping_cache[expected_path['name']], expected_data_source)
+			T.assert_equal(self.data_source.routing_table.lookup(expected_path['name']), [expected_data_source])
 
 	def test_list_path_no_path_duplicates(self):
 		"""Tests that when no path is specified the correct results are returned
-		and the repeat key is not cached with the wrong data source.
+		and the repeat key is routed to the first data source serving it.
 		"""
 		test_path = None
 
@@ -113,7 +118,7 @@ class AggregatingDataSourceTest(T.TestCase):
 				'name': 'src.MajorSource1',
 				'type': 'dir'
 			})
-			mock_request_paths.side_effect = mock_request_path_list
+			mock_request_paths.side_effect = self._by_data_source(mock_request_path_list)
 
 			actual_paths = self.data_source.list_path(test_path)
 
@@ -125,8 +130,8 @@ class AggregatingDataSourceTest(T.TestCase):
 		T.assert_equal(expected_paths, actual_paths)
 
 		for expected_path, expected_data_source in zip(expected_paths, self.data_source.data_sources):
-			T.assert_in(expected_path['name'], self.data_source.key_mapping_cache)
-			T.assert_equal(self.data_source.key_mapping_cache[expected_path['name']], expected_data_source)
+			T.assert_equal(self.data_source._data_source_for_stat_key(expected_path['name']), expected_data_source)
+		T.assert_equal(self.data_source.routing_table.lookup('src.MajorSource1'), self.data_source.data_sources[1:])
 
 	def test_list_path(self):
 		"""Tests the behavior of list_path when a path is specified."""
@@ -176,14 +181,14 @@ class AggregatingDataSourceTest(T.TestCase):
 		with self._mock_ds_method('_data_source_for_stat_key') as mock_ds_for_stat_key:
 			with self._mock_ds_method('_request_data_from_ds') as mock_request_data:
 				mock_ds_for_stat_key.return_value = test_data_source
-				mock_request_data.return_value = dummy_data
+				mock_request_data.return_value = Series.from_rows(dummy_data)
 
 				actual_data = self.data_source.data(test_stat, test_start, test_end, test_width)
 
 				mock_ds_for_stat_key.assert_called_once_with(test_stat[0][0])
 				mock_request_data.assert_called_once_with(test_data_source, test_stat, test_start, test_end, test_width)
 
-		T.assert_equal(expected_data, actual_data)
+		T.assert_equal(actual_data.to_rows(), json.loads(expected_data))
 
 	def test_data_multiple_from_single_source(self):
 		"""Tests the behavior of data when asking for multiple stats from a
@@ -217,7 +222,7 @@ class AggregatingDataSourceTest(T.TestCase):
 		with self._mock_ds_method('_data_source_for_stat_key') as mock_ds_for_stat_key:
 			with self._mock_ds_method('_request_data_from_ds') as mock_request_data:
 				mock_ds_for_stat_key.side_effect = [test_data_source, test_data_source]
-				mock_request_data.return_value = dummy_data
+				mock_request_data.return_value = Series.from_rows(dummy_data)
 
 				actual_data = self.data_source.data(test_stats, test_start, test_end, test_width)
 
@@ -227,7 +232,7 @@ class AggregatingDataSourceTest(T.TestCase):
 
 				mock_request_data.assert_called_once_with(test_data_source, test_stats, test_start, test_end, test_width)
 
-		T.assert_equal(expected_data, actual_data)
+		T.assert_equal(actual_data.to_rows(), json.loads(expected_data))
 
 	def test_data_multiple_from_multiple_sources(self):
 		"""Tests the behavior of data when asking for multiple stats from
@@ -244,7 +249,7 @@ class AggregatingDataSourceTest(T.TestCase):
 		test_end = 200
 		test_width = 500
 
-		# Lists data in the order of the data sources that will be asked
+		# Lists data in the order of self.data_source.data_sources
 		dummy_data_list = [
 			[
 				{
@@ -338,7 +343,7 @@ class AggregatingDataSourceTest(T.TestCase):
 					self.data_source.data_sources[0],
 					self.data_source.data_sources[2],
 				]
-				mock_request_data.side_effect = dummy_data_list
+				mock_request_data.side_effect = self._by_data_source(map(Series.from_rows, dummy_data_list))
 
 				actual_data = self.data_source.data(test_stats, test_start, test_end, test_width)
 
@@ -354,22 +359,72 @@ class AggregatingDataSourceTest(T.TestCase):
 				mock_request_data.assert_any_call(self.data_source.data_sources[2],
 					[test_stats[3]], test_start, test_end, test_width)
 
-		T.assert_equal(expected_data, actual_data)
+		T.assert_equal(actual_data.to_rows(), json.loads(expected_data))
+
+	def test_data_deadline(self):
+		"""Data sources not heard from by the deadline have their sources
+		marked missing, at their positions in the request."""
+		test_stats = [['src.A', 'a'], ['src.B', 'b'], ['src.A', 'c']]
+		data_sources = self.data_source.data_sources
+		deadline = deadlines.Deadline(time.time() + 10)
+
+		def request_data(data_source, sources, start, end, width):
+			if data_source is data_sources[0]:
+				# the first data server answers without the second of its
+				# sources
+				deadlines.mark_missing([1])
+				return Series.from_rows([{'t': 500, 'v': [1, None]}])
+			else:
+				# the second one isn't heard from in time
+				deadlines.mark_missing([0])
+				return Series([], [[]])
 
-	def test_int_dict_to_list(self):
-		"""Just a quick test for the positive path of _int_dict_to_list."""
-		test_dict = {
-			1: 'a',
-			2: 'b',
-			3: ['c', {'a': 'i'}],
-			4: 0,
-			11: 'cya'
-		}
+		with self._mock_ds_method('_data_source_for_stat_key') as mock_ds_for_stat_key:
+			with self._mock_ds_method('_request_data_from_ds') as mock_request_data:
+				mock_ds_for_stat_key.side_effect = [data_sources[0], data_sources[1], data_sources[0]]
+				mock_request_data.side_effect = request_data
+				with deadlines.running(deadline):
+					actual_data = self.data_source.data(test_stats, 100, 200, 30)
+
+				T.assert_equal(mock_request_data.call_count, 2)
+
+		T.assert_equal(actual_data.to_rows(), [{'t': 500, 'v': [1, None, None]}])
+		T.assert_equal(deadline.missing, set([1, 2]))
+
+	def test_data_deadline_expired(self):
+		"""No data source is asked once the deadline has passed."""
+		test_stats = [['src.A', 'a'], ['src.B', 'b']]
+		deadline = deadlines.Deadline(time.time() - 1)
 
-		expected_list = ['a', 'b', ['c', {'a': 'i'}], 0, 'cya']
-		actual_list = self.data_source._int_dict_to_list(test_dict)
+		with self._mock_ds_method('_data_source_for_stat_key') as mock_ds_for_stat_key:
+			with self._mock_ds_method('_request_data_from_ds') as mock_request_data:
+				mock_ds_for_stat_key.side_effect = self.data_source.data_sources[:2]
+				with deadlines.running(deadline):
+					actual_data = self.data_source.data(test_stats, 100, 200, 30)
+
+				T.assert_equal(mock_request_data.call_count, 0)
+
+		T.assert_equal(actual_data.to_rows(), [])
+		T.assert_equal(len(actual_data.columns), 2)
+		T.assert_equal(deadline.missing, set([0, 1]))
 
-		T.assert_equal(expected_list, actual_list)
+	def test_request_data_from_ds_deadline(self):
+		test_data_source = self.data_source.data_sources[0]
+		deadline = deadlines.Deadline(time.time() + 10)
+
+		with self._patch_urlopen() as mock_urlopen:
+			response = mock.Mock()
+			response.read.side_effect = [json.dumps([{'t': 150, 'v': [5, None]}]), '']
+			response.info.return_value.getheader.return_value = '1'
+			mock_urlopen.return_value = response
+			with deadlines.running(deadline):
+				self.data_source._request_data_from_ds(test_data_source, [['a'], ['b']], 100, 200, 30)
+
+			# the data server is given the time that's left
+			T.assert_lte(mock_urlopen.call_args[1]['timeout'], 10)
+			query_params = urlparse.parse_qs(urlparse.urlparse(mock_urlopen.call_args[0][0]).query)
+			T.assert_lte(float(query_params['deadline'][0]), 10)
+		T.assert_equal(deadline.missing, set([1]))
 
 	def test_request_paths_from_ds(self):
 		"""Tests the behavior of _request_paths_from_ds when a path is
@@ -513,7 +568,7 @@ class AggregatingDataSourceTest(T.TestCase):
 				test_end,
 				test_width)
 			T.assert_equal(mock_urlopen.call_count, 1)
-			T.assert_equal(mock_data, returned_data)  # 'cause why not?
+			T.assert_equal(mock_data, returned_data.to_rows())  # 'cause why not?
 			T.assert_equal(len(mock_urlopen.call_args[0]), 1)
 
 			submitted_url = mock_urlopen.call_args[0][0]
@@ -539,9 +594,15 @@ class AggregatingDataSourceTest(T.TestCase):
 		test_start = 100
 		test_end = 200
 		test_width = 30
+		# no other data source to fall back on
+		self.data_source.routing_table.update([
+			[{'name': 'src.EndpointTIming'}, {'name': 'src.ErrorCount'}],
+			[{'name': 'src.ErrorCount'}],
+			[],
+		])
 
 		with self._patch_urlopen() as mock_urlopen:
-                        mock_urlopen.side_effect = urllib2.URLError('fake URLError')
+			mock_urlopen.side_effect = urllib2.URLError('fake URLError')
 
 			returned_data = self.data_source._request_data_from_ds(test_data_source,
 				test_sources,
@@ -551,83 +612,60 @@ class AggregatingDataSourceTest(T.TestCase):
 
 			T.assert_equal(mock_urlopen.call_count, 1)
 			T.assert_equal(len(mock_urlopen.call_args[0]), 1)
-			T.assert_equal(returned_data, [])
-
-	def test_data_source_for_stat_key_in_cache(self):
-		"""Tests that _data_source_for_stat_key uses the key_mapping_cache if
-		it can.
-		"""
-		expected_data_source = self.data_source.data_sources[2]
-
-		stat_key = 'src.test_stat_key'
-
-		self.data_source.key_mapping_cache[stat_key] = expected_data_source
-
-		with self._mock_ds_method('_find_data_source_for_stat_key') as mock_find_ds_for_stat:
-			actual_ds = self.data_source._data_source_for_stat_key(stat_key)
+			T.assert_equal(returned_data.to_rows(), [])
 
-			T.assert_equal(mock_find_ds_for_stat.call_count, 0)
-
-		T.assert_equal(actual_ds, expected_data_source)
-
-	def test_data_source_for_stat_key_not_cached(self):
-		"""Tests that _data_source_for_stat_key asks _find_data_source_for_stat_key
-		if the stat key isn't cached in the key_mapping_cache.
+	def test_data_source_for_stat_key(self):
+		"""Tests that _data_source_for_stat_key answers with the first data
+		source the routing table has for the key.
 		"""
-		expected_data_source = self.data_source.data_sources[2]
-
+		data_sources = self.data_source.data_sources
 		stat_key = 'src.test_stat_key'
 
-		with self._mock_ds_method('_find_data_source_for_stat_key') as mock_find_ds_for_stat:
-			mock_find_ds_for_stat.return_value = expected_data_source
-			actual_ds = self.data_source._data_source_for_stat_key(stat_key)
-
-			mock_find_ds_for_stat.assert_called_once_with(stat_key)
-
-		T.assert_equal(actual_ds, expected_data_source)
-
-	def test_find_data_source_for_stat_key(self):
-		"""Tests _find_data_source_for_stat_key when it's provided by one of
-		the configured data sources.
-		"""
-
-		expected_data_source = {
-			'data_server_url': "http://b.com",
-			'data_source_hash': util.generate_ds_key("another.data.source"),
-			'secret_key': "TEST_SECRET_TWO"
-		}
-
-		test_key = 'src.our_key'
-
-		def fake_paths_from_ds(data_source, path):
-			if data_source == expected_data_source:
-				return [{"name": test_key},]
-			else:
-				return [{"name": "src.not_our_key"},]
-
-		with mock.patch.object(self.data_source, '_request_paths_from_ds', fake_paths_from_ds):
-			actual_ds = self.data_source._find_data_source_for_stat_key(test_key)
+		self.data_source.routing_table.update([
+			[{'name': 'src.other_key'}],
+			[{'name': stat_key}],
+			[{'name': stat_key}],
+		])
 
-		T.assert_equal(expected_data_source, actual_ds)
-		T.assert_in(test_key, self.data_source.key_mapping_cache)
-		T.assert_equal(expected_data_source, self.data_source.key_mapping_cache[test_key])
+		T.assert_equal(self.data_source._data_source_for_stat_key(stat_key), data_sources[1])
 
-	def test_find_data_source_for_stat_key_not_found(self):
-		"""Tests _find_data_source_for_stat_key's behavior when the stat_key
+	def test_data_source_for_stat_key_not_found(self):
+		"""Tests _data_source_for_stat_key's behavior when the stat_key
 		isn't made available by any data sources.
 		"""
-
-		expected_data_source = None
 		test_key = 'src.some_test_stat'
 
 		with self._mock_ds_method('_request_paths_from_ds') as mock_request_paths:
 			mock_request_paths.return_value = [{"name": "a"}, {"name": "b"}, {"name": "c"}]
-			actual_ds = self.data_source._find_data_source_for_stat_key(test_key)
+			actual_ds = self.data_source._data_source_for_stat_key(test_key)
 			T.assert_equal(mock_request_paths.call_count, len(self.test_data_sources))
 			for ds in self.data_source.data_sources:
 				mock_request_paths.assert_any_call(ds, None)
 
-		T.assert_equal(expected_data_source, actual_ds)
+		T.assert_equal(actual_ds, None)
+
+	def test_data_without_a_data_source(self):
+		"""Sources of stat keys no data source serves are left empty."""
+		test_stats = [['src.A', 'a'], ['src.nope', 'b']]
+
+		with self._mock_ds_method('_data_source_for_stat_key') as mock_ds_for_stat_key:
+			with self._mock_ds_method('_request_data_from_ds') as mock_request_data:
+				mock_ds_for_stat_key.side_effect = [self.data_source.data_sources[0], None]
+				mock_request_data.return_value = Series.from_rows([{'t': 500, 'v': [1]}])
+				actual_data = self.data_source.data(test_stats, 100, 200, 30)
+
+				mock_request_data.assert_called_once_with(self.data_source.data_sources[0],
+					[test_stats[0]], 100, 200, 30)
+
+		T.assert_equal(actual_data.to_rows(), [{'t': 500, 'v': [1, None]}])
+
+	def _by_data_source(self, results):
+		"""Returns a side effect answering for each data source with the
+		entry of results in the same position, whatever order they're
+		asked in."""
+		def side_effect(data_source, *args):
+			return results[self.data_source.data_sources.index(data_source)]
+		return side_effect
 
 	@contextmanager
 	def _patch_urlopen(self):
@@ -638,3 +676,198 @@ class AggregatingDataSourceTest(T.TestCase):
 	def _mock_ds_method(self, method):
 		with mock.patch.object(self.data_source, method) as mock_thing:
 			yield mock_thing
+
+
+class RoutingTableTest(T.TestCase):
+
+	@T.setup
+	def make_table(self):
+		self.now = 1000.0
+		self.listings = [['src.A', 'src.B'], ['src.B']]
+		self.list_calls = 0
+		self.table = RoutingTable(['ds0', 'ds1'], self.list_roots, refresh_interval=60,
+			clock=lambda: self.now)
+
+	def list_roots(self):
+		self.list_calls += 1
+		return [[{'name': name, 'type': 'dir'} for name in names] for names in self.listings]
+
+	def test_built_on_first_lookup(self):
+		T.assert_equal(self.table.lookup('src.A'), ['ds0'])
+		T.assert_equal(self.table.lookup('src.B'), ['ds0', 'ds1'])
+		T.assert_equal(self.list_calls, 1)
+
+	def test_misses_refresh(self):
+		T.assert_equal(self.table.lookup('src.C'), [])
+		T.assert_equal(self.list_calls, 1)
+
+		# too soon after the last refresh
+		self.listings[1].append('src.C')
+		T.assert_equal(self.table.lookup('src.C'), [])
+		T.assert_equal(self.list_calls, 1)
+
+		self.now += RoutingTable.miss_refresh_interval
+		T.assert_equal(self.table.lookup('src.C'), ['ds1'])
+		T.assert_equal(self.list_calls, 2)
+
+	def test_stale_tables_refresh_in_the_background(self):
+		self.table.lookup('src.A')
+		self.listings[0] = ['src.B']
+		self.listings[1] = ['src.A']
+		self.now += 60
+		# answered from the stale table
+		T.assert_equal(self.table.lookup('src.A'), ['ds0'])
+		self.table.refresh()
+		T.assert_equal(self.list_calls, 2)
+		T.assert_equal(self.table.lookup('src.A'), ['ds1'])
+
+	def test_concurrent_misses_share_a_refresh(self):
+		self.table.lookup('src.A')
+		self.now += RoutingTable.miss_refresh_interval
+		listed = threading.Event()
+		def list_roots():
+			listed.wait()
+			return self.list_roots()
+		self.table._list_roots = list_roots
+		self.listings[1].append('src.C')
+
+		results = []
+		threads = [threading.Thread(target=lambda: results.append(self.table.lookup('src.C')))
+			for _ in xrange(3)]
+		for thread in threads:
+			thread.start()
+		time.sleep(0.1)
+		listed.set()
+		for thread in threads:
+			thread.join()
+
+		T.assert_equal(results, [['ds1']] * 3)
+		T.assert_equal(self.list_calls, 2)
+
+	def test_empty_listings_keep_their_keys(self):
+		self.table.lookup('src.A')
+		self.table.update([[], [{'name': 'src.C'}]])
+		T.assert_equal(self.table.lookup('src.A'), ['ds0'])
+		T.assert_equal(self.table.lookup('src.B'), ['ds0'])
+		T.assert_equal(self.table.lookup('src.C'), ['ds1'])
+
+
+class AggregatingFanOutTest(T.TestCase):
+	"""Talks to stand-in data servers which take a while to answer."""
+
+	delay = 0.3
+
+	@T.setup
+	def start_upstreams(self):
+		self.upstreams = [StandInServer(['src.%s' % name], delay=self.delay) for name in 'AB']
+		self.data_source = AggregatingDataSource(data_sources=[{
+			'data_server_url': upstream.url,
+			'data_source_name': 'some.data.source',
+			'secret_key': "TEST_SECRET",
+		} for upstream in self.upstreams])
+
+	@T.teardown
+	def stop_upstreams(self):
+		for upstream in self.upstreams:
+			upstream.stop()
+
+	def test_data_takes_as_long_as_the_slowest(self):
+		# prime the routing of the keys
+		self.data_source.list_path(None)
+		started = time.time()
+		data = self.data_source.data([['src.A', 'a'], ['src.B', 'b'], ['src.A', 'c']], 100, 200, 30)
+		T.assert_lt(time.time() - started, 2 * self.delay)
+		T.assert_equal(data.to_rows(), [{'t': 100, 'v': [0, 0, 1]}])
+
+	def test_list_path_takes_as_long_as_the_slowest(self):
+		started = time.time()
+		paths = self.data_source.list_path(None)
+		T.assert_lt(time.time() - started, 2 * self.delay)
+		T.assert_equal([path['name'] for path in paths], ['src.A', 'src.B'])
+
+	def test_connections_are_kept_alive(self):
+		self.data_source.list_path(None)
+		for _ in xrange(3):
+			self.data_source.data([['src.A', 'a'], ['src.B', 'b']], 100, 200, 30)
+		T.assert_equal([len(upstream.requests) for upstream in self.upstreams], [4, 4])
+		T.assert_equal([upstream.connections for upstream in self.upstreams], [1, 1])
+
+
+class AggregatingReplicasTest(T.TestCase):
+	"""Talks to a stand-in data server and its replica."""
+
+	@T.setup
+	def start_upstreams(self):
+		self.primary = StandInServer(['src.A'])
+		self.replica = StandInServer(['src.A'])
+		self.data_source = AggregatingDataSource(data_sources=[{
+			'data_server_url': self.primary.url,
+			'replicas': [self.replica.url],
+			'data_source_name': 'some.data.source',
+			'secret_key': "TEST_SECRET",
+		}], hedge_delay=0.1)
+		self.group = self.data_source.replica_groups[self.primary.url]
+		self.data_source.routing_table.update([[{'name': 'src.A'}]])
+
+	@T.teardown
+	def stop_upstreams(self):
+		self.primary.stop()
+		self.replica.stop()
+
+	def fetch(self):
+		return self.data_source.data([['src.A', 'a']], 100, 200, 30).to_rows()
+
+	def test_slow_requests_are_hedged(self):
+		self.primary.delay = 0.5
+		started = time.time()
+		T.assert_equal(self.fetch(), [{'t': 100, 'v': [0]}])
+		T.assert_lt(time.time() - started, 0.4)
+		T.assert_equal(len(self.primary.requests), 1)
+		T.assert_equal(len(self.replica.requests), 1)
+
+		# having answered faster, the replica is asked first from then on
+		time.sleep(0.5)
+		T.assert_equal(self.group.ranked()[0].url, self.replica.url)
+		self.fetch()
+		T.assert_equal(len(self.primary.requests), 1)
+		T.assert_equal(len(self.replica.requests), 2)
+
+	def test_failed_requests_fall_back(self):
+		self.primary.stop()
+		for _ in xrange(3):
+			T.assert_equal(self.fetch(), [{'t': 100, 'v': [0]}])
+		T.assert_equal(len(self.replica.requests), 3)
+		primary = self.group.replicas[0]
+		T.assert_gt(primary.error_rate, 0)
+
+
+class AggregatingFallbackTest(T.TestCase):
+	"""Talks to two stand-in data servers serving the same stat key."""
+
+	@T.setup
+	def start_upstreams(self):
+		self.upstreams = [StandInServer(['src.A']), StandInServer(['src.A', 'src.B'])]
+		self.data_source = AggregatingDataSource(data_sources=[{
+			'data_server_url': upstream.url,
+			'data_source_name': 'some.data.source',
+			'secret_key': "TEST_SECRET",
+		} for upstream in self.upstreams])
+		self.data_source.list_path(None)
+
+	@T.teardown
+	def stop_upstreams(self):
+		for upstream in self.upstreams:
+			upstream.stop()
+
+	def test_first_data_source_is_asked_first(self):
+		T.assert_equal(self.data_source.data([['src.A', 'a']], 100, 200, 30).to_rows(), [{'t': 100, 'v': [0]}])
+		T.assert_equal([len(upstream.requests) for upstream in self.upstreams], [2, 1])
+
+	def test_failed_data_sources_fall_back(self):
+		self.upstreams[0].stop()
+		data = self.data_source.data([['src.A', 'a'], ['src.B', 'b']], 100, 200, 30)
+		T.assert_equal(data.to_rows(), [{'t': 100, 'v': [0, 0]}])
+		T.assert_equal([path for path, _ in self.upstreams[1].requests], ['/sources', '/data', '/data'])
+
+		self.data_source.list_path(['src.A'])
+		T.assert_equal(self.upstreams[1].requests[-1][0], '/sources')
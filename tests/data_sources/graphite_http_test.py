@@ -2,6 +2,8 @@
 from contextlib import contextmanager
 from cStringIO import StringIO
 import json
+import socket
+import time
 import hamcrest
 import mock
 import urllib2
@@ -10,6 +12,7 @@ from mock import Mock
 
 import testify as T
 
+from firefly import deadlines
 from firefly.data_sources.graphite_http import GraphiteHTTP
 from firefly import util
 
@@ -203,4 +206,36 @@ class GraphiteHTTPTest(T.TestCase):
             for i,expected_result in enumerate(expected_results):
                 T.assert_dicts_equal(expected_result, result_list[i])
 
-            T.assert_equal(2, mock_urlopen.call_count)
\ No newline at end of file
+            T.assert_equal(2, mock_urlopen.call_count)
+
+    def test_data_deadline(self):
+        sources = [
+            ['servers', 'admin1', 'loadavg', '01'],
+            ['servers', 'admin2', 'loadavg', '01'],
+            ['servers', 'admin3', 'loadavg', '01'],
+        ]
+        start = 1391047920
+        end = 1391048100
+        deadline = deadlines.Deadline(time.time() + 10)
+
+        def render(url, timeout):
+            T.assert_lte(timeout, 10)
+            if 'admin1' in url:
+                response = Mock()
+                response.read.return_value = json.dumps([{'datapoints': [
+                    [2.0, 1391047920], [6.0, 1391047980], [9.0, 1391048040], [None, 1391048100]]}])
+                return response
+            # admin2 times out, which uses up the time admin3 would have had
+            deadline.at = 0
+            raise socket.timeout()
+
+        with patch_urlopen() as mock_urlopen:
+            mock_urlopen.side_effect = render
+            with deadlines.running(deadline):
+                result = json.loads(self.ds.data(sources, start, end, width=100))
+
+            T.assert_equal(mock_urlopen.call_count, 2)
+
+        T.assert_equal(result[0], {'t': 1391047920, 'v': [2.0, None, None]})
+        T.assert_equal(len(result), 4)
+        T.assert_equal(deadline.missing, set([1, 2]))
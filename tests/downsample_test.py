@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""Contains tests for downsampling data source results."""
+import testify as T
+
+from firefly import downsample
+from firefly.series import Series
+
+
+class DownsampleTest(T.TestCase):
+
+    series = Series(range(0, 100, 10), [
+        [1.0, 3.0, 2.0, None, None, 5.0, 9.0, 0.0, 4.0, 4.0],
+        [0.0, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0, 9.0],
+    ])
+
+    def test_short_series_are_untouched(self):
+        for algorithm in downsample.ALGORITHMS:
+            T.assert_is(downsample.downsample(self.series, 10, algorithm), self.series)
+        T.assert_is(downsample.downsample(self.series, 0), self.series)
+
+    def test_average(self):
+        result = downsample.downsample(self.series, 4, 'average')
+        # buckets [0, 2), [2, 5), [5, 7), [7, 10)
+        T.assert_equal(list(result.timestamps), [0, 20, 50, 70])
+        T.assert_equal(result.values(0), [2.0, 2.0, 7.0, 8.0 / 3])
+        T.assert_equal(result.values(1), [0.5, 3.0, 5.5, 8.0])
+
+    def test_average_of_nulls_is_null(self):
+        result = downsample.downsample(Series(range(4), [[None, None, 1.0, 1.0]]), 2, 'average')
+        T.assert_equal(result.values(0), [None, 1.0])
+
+    def test_min_max(self):
+        result = downsample.downsample(self.series, 4, 'minmax')
+        # buckets [0, 5) and [5, 10), keeping the order extremes occurred in
+        T.assert_equal(list(result.timestamps), [0, 40, 50, 90])
+        T.assert_equal(result.values(0), [1.0, 3.0, 9.0, 0.0])
+        T.assert_equal(result.values(1), [0.0, 4.0, 5.0, 9.0])
+
+    def test_min_max_never_exceeds_width(self):
+        for width in (1, 2, 3):
+            T.assert_lte(len(downsample.downsample(self.series, width, 'minmax')), width)
+        # a single point can't hold both extremes, so it's the average
+        T.assert_equal(downsample.downsample(self.series, 1, 'minmax'),
+            downsample.downsample(self.series, 1, 'average'))
+        result = downsample.downsample(self.series, 2, 'minmax')
+        T.assert_equal(list(result.timestamps), [0, 90])
+        T.assert_equal(result.values(0), [9.0, 0.0])
+
+    def test_lttb_keeps_spikes(self):
+        values = [1.0] * 100
+        values[37] = 50.0
+        values[80] = -20.0
+        result = downsample.downsample(Series(range(100), [values]), 10, 'lttb')
+        T.assert_equal(len(result), 10)
+        T.assert_equal(result.timestamps[0], 0)
+        T.assert_equal(result.timestamps[-1], 99)
+        T.assert_in(37, result.timestamps)
+        T.assert_in(80, result.timestamps)
+
+        # the average smooths them away
+        averaged = downsample.downsample(Series(range(100), [values]), 10, 'average')
+        T.assert_lt(max(averaged.values(0)), 50.0)
+
+    def test_lttb_shares_timestamps(self):
+        result = downsample.downsample(self.series, 5, 'lttb')
+        T.assert_equal(len(result), 5)
+        T.assert_equal(len(result.columns), 2)
+        for t, row in zip(result.timestamps, result.to_rows()):
+            T.assert_equal(row['v'], self.series.to_rows()[t // 10]['v'])
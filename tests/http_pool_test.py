@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Contains tests for the keep-alive connection pool."""
+import json
+import socket
+import threading
+import time
+import urllib2
+
+import testify as T
+
+from firefly import http_pool
+from tests.testing import StandInServer
+
+
+class HTTPPoolTest(T.TestCase):
+
+    @T.setup
+    def start_server(self):
+        self.server = StandInServer(['src.A'])
+        self.pool = http_pool.HTTPPool(max_per_host=2)
+
+    @T.teardown
+    def stop_server(self):
+        self.server.stop()
+
+    def get(self, path='/sources', **kwargs):
+        return self.pool.urlopen(self.server.url + path, **kwargs)
+
+    def test_response(self):
+        response = self.get()
+        T.assert_equal(response.getcode(), 200)
+        T.assert_equal(response.info().getheader('Content-Type'), 'application/json')
+        T.assert_equal(json.loads(response.read()), [{'type': 'dir', 'name': 'src.A'}])
+        T.assert_equal(response.read(), '')
+
+    def test_connections_are_reused(self):
+        for _ in xrange(3):
+            self.get().read()
+        T.assert_equal(self.server.connections, 1)
+        T.assert_equal(self.pool.connections_opened, 1)
+
+    def test_unread_responses_are_not_reused(self):
+        self.get().close()
+        self.get().read()
+        T.assert_equal(self.pool.connections_opened, 2)
+
+    def test_partial_reads(self):
+        response = self.get()
+        body = ''
+        while True:
+            chunk = response.read(5)
+            if not chunk:
+                break
+            body += chunk
+        T.assert_equal(json.loads(body), [{'type': 'dir', 'name': 'src.A'}])
+        self.get().read()
+        T.assert_equal(self.pool.connections_opened, 1)
+
+    def test_max_per_host(self):
+        self.server.delay = 0.2
+        started = time.time()
+        threads = [threading.Thread(target=lambda: self.get().read()) for _ in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # two at a time
+        T.assert_gte(time.time() - started, 0.4)
+        T.assert_equal(self.pool.connections_opened, 2)
+        T.assert_equal(len(self.server.requests), 4)
+
+    def test_timeout(self):
+        self.server.delay = 0.5
+        with T.assert_raises(urllib2.URLError):
+            self.get(timeout=0.1)
+        # the connection wasn't left in use
+        self.server.delay = 0
+        self.get().read()
+        self.get().read()
+
+    def test_timeout_on_reused_connection(self):
+        self.get().read()
+        self.server.delay = 0.5
+        started = time.time()
+        with T.assert_raises(urllib2.URLError):
+            self.get(timeout=0.3)
+        # given up on once, not sent again on a new connection
+        T.assert_lt(time.time() - started, 0.5)
+        T.assert_equal(len(self.server.requests), 2)
+        T.assert_equal(self.pool.connections_opened, 1)
+
+    def test_http_error(self):
+        try:
+            self.get('/nope')
+        except urllib2.HTTPError, e:
+            T.assert_equal(e.code, 404)
+        else:
+            raise AssertionError("no HTTPError raised")
+
+    def test_url_error(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        with T.assert_raises(urllib2.URLError):
+            self.pool.urlopen('http://127.0.0.1:%d/sources' % port)
+
+    def test_closed_idle_connections_are_replaced(self):
+        self.get().read()
+        # the server goes away along with the connection
+        for conn in self.pool._idle.values()[0]:
+            conn.sock.shutdown(socket.SHUT_RDWR)
+        T.assert_equal(json.loads(self.get().read()), [{'type': 'dir', 'name': 'src.A'}])
+        T.assert_equal(self.pool.connections_opened, 2)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""Contains tests for the /metrics endpoint and the metrics registry."""
+import os
+import shutil
+import tempfile
+
+import testify as T
+
+from firefly import metrics
+from tests.testing import DataServerTestCase
+from tests.testing import FakeDataSource
+
+
+class RegistryTest(T.TestCase):
+
+    @T.setup
+    def make_registry(self):
+        self.directory = tempfile.mkdtemp()
+        self.registry = metrics.Registry()
+        self.registry.set_directory(self.directory)
+        self.counter = metrics.Counter(self.registry, 'test_total', 'A counter.', ('kind',))
+        self.histogram = metrics.Histogram(self.registry, 'test_seconds', 'A histogram.',
+            ('kind',), buckets=(1, 5))
+
+    @T.teardown
+    def remove_directory(self):
+        shutil.rmtree(self.directory)
+
+    def test_counter(self):
+        self.counter.inc(kind='a')
+        self.counter.inc(2, kind='a')
+        self.counter.inc(kind='b')
+        exposition = self.registry.exposition()
+        T.assert_in('# TYPE test_total counter\n', exposition)
+        T.assert_in('test_total{kind="a"} 3\n', exposition)
+        T.assert_in('test_total{kind="b"} 1\n', exposition)
+
+    def test_histogram_buckets_are_cumulative(self):
+        for value in (0.5, 3, 3, 100):
+            self.histogram.observe(value, kind='a')
+        exposition = self.registry.exposition()
+        T.assert_in('test_seconds_bucket{kind="a",le="1"} 1\n', exposition)
+        T.assert_in('test_seconds_bucket{kind="a",le="5"} 3\n', exposition)
+        T.assert_in('test_seconds_bucket{kind="a",le="+Inf"} 4\n', exposition)
+        T.assert_in('test_seconds_count{kind="a"} 4\n', exposition)
+        T.assert_in('test_seconds_sum{kind="a"} 106.5\n', exposition)
+
+    def test_labels_must_match(self):
+        T.assert_raises(ValueError, self.counter.inc, other='a')
+
+    def test_processes_are_summed(self):
+        self.counter.inc(kind='a')
+        pids = []
+        for _ in xrange(3):
+            pid = os.fork()
+            if not pid:
+                try:
+                    self.counter.inc(kind='a')
+                    self.counter.inc(kind='forked')
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+
+        totals = self.registry.exposition()
+        T.assert_in('test_total{kind="a"} 4\n', totals)
+        T.assert_in('test_total{kind="forked"} 3\n', totals)
+        T.assert_equal(len(os.listdir(self.directory)), 4)
+
+    def test_files_grow(self):
+        for idx in xrange(5000):
+            self.counter.inc(kind='kind%d' % idx)
+        T.assert_in('test_total{kind="kind4999"} 1\n', self.registry.exposition())
+
+    def test_restarts_reuse_the_directory(self):
+        self.counter.inc(kind='a')
+        restarted = metrics.Registry()
+        restarted.set_directory(self.directory)
+        # the earlier run's values are gone, and so are its files
+        T.assert_equal(restarted.collect(), {})
+        T.assert_equal(os.listdir(self.directory), [])
+        T.assert_equal(metrics.default_directory(8890), metrics.default_directory(8890))
+
+
+class MetricsHandlerTest(DataServerTestCase):
+
+    def make_data_sources(self):
+        return [FakeDataSource()]
+
+    def test_requests_and_data_source_calls(self):
+        T.assert_equal(self.fetch(self.data_url([['stat0']], 1000, 2000)).code, 200)
+        T.assert_equal(self.fetch(self.url('/ping')).code, 200)
+
+        response = self.fetch(self.url('/metrics'))
+        T.assert_equal(response.code, 200)
+        T.assert_equal(response.headers['Content-Type'], metrics.CONTENT_TYPE)
+        T.assert_in('firefly_http_requests_total{handler="DataHandler",method="GET",code="200"} 1\n',
+            response.body)
+        T.assert_in('firefly_http_requests_total{handler="PingHandler",method="GET",code="200"} 1\n',
+            response.body)
+        T.assert_in('firefly_http_request_duration_seconds_count{handler="DataHandler"} 1\n',
+            response.body)
+        T.assert_in('firefly_data_source_call_duration_seconds_count{data_source="FakeDataSource",method="data"} 1\n',
+            response.body)
+        T.assert_in('firefly_http_response_bytes_bucket{handler="PingHandler",le="256"} 1\n',
+            response.body)
+
+    def test_errors_are_counted(self):
+        T.assert_equal(self.fetch(self.url('/sources', path='["ds0", "nope"]')).code, 200)
+        self.data_sources[0].list_path = lambda path: 1 / 0
+        T.assert_equal(self.fetch(self.url('/sources', path='["ds0"]')).code, 500)
+
+        body = self.fetch(self.url('/metrics')).body
+        T.assert_in('firefly_data_source_call_errors_total{data_source="FakeDataSource",method="list_path"} 1\n', body)
+        T.assert_in('firefly_http_requests_total{handler="SourcesHandler",method="GET",code="500"} 1\n', body)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""Contains tests for the bookkeeping of replicated data servers."""
+import testify as T
+
+from firefly import replicas
+
+
+class ReplicaGroupTest(T.TestCase):
+
+    @T.setup
+    def make_group(self):
+        self.now = 1000.0
+        self.group = replicas.ReplicaGroup(['a', 'b', 'c'], hedge_percentile=90, hedge_delay=0.5,
+            clock=lambda: self.now)
+        self.a, self.b, self.c = self.group.replicas
+
+    def test_untried_replicas_come_first(self):
+        T.assert_equal(self.group.ranked(), [self.a, self.b, self.c])
+        self.group.succeeded(self.a, 0.2)
+        T.assert_equal(self.group.ranked(), [self.b, self.c, self.a])
+
+    def test_fastest_first(self):
+        for replica, latency in [(self.a, 0.3), (self.b, 0.1), (self.c, 0.2)]:
+            self.group.succeeded(replica, latency)
+        T.assert_equal(self.group.ranked(), [self.b, self.c, self.a])
+
+        # one slow answer moves the average, but not all the way
+        self.group.succeeded(self.b, 0.8)
+        T.assert_almost_equal(self.b.latency, 0.24, 6)
+        T.assert_equal(self.group.ranked(), [self.c, self.b, self.a])
+
+    def test_failing_replicas_come_last(self):
+        for replica in self.group.replicas:
+            self.group.succeeded(replica, 0.1)
+        for _ in xrange(4):
+            self.group.failed(self.a)
+        T.assert_gte(self.a.error_rate, self.group.max_error_rate)
+        T.assert_equal(self.group.ranked(), [self.b, self.c, self.a])
+
+        # until they get another chance
+        self.now += self.group.retry_interval
+        T.assert_equal(self.group.healthy(self.a), True)
+        self.group.failed(self.a)
+        T.assert_equal(self.group.ranked()[-1], self.a)
+
+        # and recover by answering
+        self.now += self.group.retry_interval
+        for _ in xrange(5):
+            self.group.succeeded(self.a, 0.05)
+        self.now -= 2 * self.group.retry_interval
+        T.assert_equal(self.group.ranked()[0], self.a)
+
+    def test_hedge_after(self):
+        # not enough answers to go by yet
+        T.assert_equal(self.group.hedge_after(self.a), 0.5)
+        for latency in xrange(1, 21):
+            self.group.succeeded(self.a, latency / 100.0)
+        T.assert_equal(self.group.hedge_after(self.a), 0.19)
+
+    def test_no_hedging(self):
+        T.assert_equal(replicas.ReplicaGroup(['a']).hedge_after(self.a), None)
+        T.assert_equal(replicas.ReplicaGroup(['a', 'b'], hedge_percentile=0).hedge_after(self.a), None)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""Contains tests for the columnar Series representation."""
+import json
+import math
+
+import testify as T
+
+from firefly.series import BINARY_HEADER
+from firefly.series import RowDecoder
+from firefly.series import Series
+from firefly.series import merge
+
+
+class SeriesTest(T.TestCase):
+
+    rows = [
+        {'t': 10, 'v': [1.0, None]},
+        {'t': 20, 'v': [2.0, 5.5]},
+    ]
+
+    def test_round_trip(self):
+        series = Series.from_json(json.dumps(self.rows))
+        T.assert_equal(list(series.timestamps), [10, 20])
+        T.assert_equal(series.values(0), [1.0, 2.0])
+        T.assert_equal(series.values(1), [None, 5.5])
+        T.assert_equal(json.loads(series.to_json()), self.rows)
+
+    def test_select(self):
+        series = Series.from_rows(self.rows).select([1, 1, 0])
+        T.assert_equal(series.to_rows(), [
+            {'t': 10, 'v': [None, None, 1.0]},
+            {'t': 20, 'v': [5.5, 5.5, 2.0]}])
+
+    def test_empty(self):
+        series = Series.from_json('[]', width=2)
+        T.assert_equal(len(series), 0)
+        T.assert_equal(len(series.columns), 2)
+        T.assert_equal(series.to_json(), '[]')
+        T.assert_equal(Series.from_binary(series.to_binary()), series)
+
+    def test_json_encoding_is_reused(self):
+        data = json.dumps(self.rows)
+        T.assert_equal(Series.from_json(data).encode('json'), data)
+        T.assert_equal(json.loads(Series.from_rows(self.rows).encode('json')), self.rows)
+
+    def test_binary_round_trip(self):
+        series = Series([1000, 1060, 1180], [[1.0, None, 3.25], [0.5, 2.0, None]])
+        data = series.to_binary()
+        # header, 3 int32 deltas padded to 16 bytes, 2 columns of 3 doubles
+        T.assert_equal(len(data), BINARY_HEADER.size + 16 + 2 * 24)
+        T.assert_equal(Series.from_binary(data), series)
+
+    def test_binary32(self):
+        series = Series([10, 20], [[0.1, None]])
+        data = series.encode('binary32')
+        T.assert_equal(len(data), BINARY_HEADER.size + 8 + 8)
+        decoded = Series.from_binary(data)
+        T.assert_equal(list(decoded.timestamps), [10, 20])
+        T.assert_lt(abs(decoded.values(0)[0] - 0.1), 1e-7)
+        T.assert_equal(decoded.values(0)[1], None)
+        T.assert_equal(math.isnan(decoded.columns[0][1]), True)
+
+    def test_not_binary(self):
+        with T.assert_raises(ValueError):
+            Series.from_binary('[{"t": 10, "v": [1.0], "x": 1}]')
+
+    def test_columnar_regular(self):
+        series = Series.from_rows(self.rows)
+        T.assert_equal(json.loads(series.encode('columnar')), {
+            'start': 10, 'step': 10, 'series': [[1.0, 2.0], [None, 5.5]]})
+        T.assert_equal(Series.from_columnar(series.to_columnar()), series)
+
+    def test_columnar_irregular(self):
+        series = Series([10, 20, 50], [[1.0, 2.0, None]])
+        T.assert_equal(json.loads(series.to_columnar()), {
+            'start': 10, 't_deltas': [0, 10, 30], 'series': [[1.0, 2.0, None]]})
+        T.assert_equal(Series.from_columnar(series.to_columnar()), series)
+
+    def test_columnar_short(self):
+        single = Series([10], [[1.0]])
+        T.assert_equal(json.loads(single.to_columnar()), {'start': 10, 'step': 0, 'series': [[1.0]]})
+        T.assert_equal(Series.from_columnar(single.to_columnar()), single)
+
+        empty = Series([], [[]])
+        T.assert_equal(json.loads(empty.to_columnar()), {'start': None, 'step': None, 'series': [[]]})
+        T.assert_equal(Series.from_columnar(empty.to_columnar()), empty)
+
+    def test_non_finite_values_encode_as_null(self):
+        series = Series([10, 20, 30], [[float('inf'), 1.0, float('-inf')]])
+        for encoded in (series.to_json(), series.to_columnar()):
+            T.assert_not_in('inf', encoded)
+        T.assert_equal([row['v'] for row in json.loads(series.to_json())], [[None], [1.0], [None]])
+        T.assert_equal(json.loads(series.to_columnar())['series'], [[None, 1.0, None]])
+
+    def test_since(self):
+        series = Series([10, 20, 30], [[1.0, 2.0, 3.0]])
+        T.assert_equal(series.since(20), Series([20, 30], [[2.0, 3.0]]))
+        T.assert_equal(series.since(15), Series([20, 30], [[2.0, 3.0]]))
+        T.assert_is(series.since(0), series)
+        T.assert_equal(len(series.since(40)), 0)
+
+    def test_between(self):
+        series = Series([10, 20, 30], [[1.0, 2.0, 3.0]], missing=[0])
+        T.assert_equal(series.between(15, 30), Series([20, 30], [[2.0, 3.0]]))
+        T.assert_equal(series.between(10, 25), Series([10, 20], [[1.0, 2.0]]))
+        T.assert_equal(series.between(11, 19).missing, (0,))
+        T.assert_is(series.between(0, 40), series)
+
+    def test_updated_with(self):
+        series = Series([10, 20, 30], [[1.0, 2.0, 3.0]])
+        T.assert_equal(series.updated_with(Series([30, 40], [[3.5, 4.0]])),
+            Series([10, 20, 30, 40], [[1.0, 2.0, 3.5, 4.0]]))
+        T.assert_equal(series.updated_with(Series([0], [[0.0]])), Series([0], [[0.0]]))
+        T.assert_is(series.updated_with(Series([], [[]])), series)
+
+    def test_from_result(self):
+        series = Series.from_rows(self.rows)
+        T.assert_is(Series.from_result(series), series)
+        T.assert_equal(Series.from_result(json.dumps(self.rows)), series)
+
+
+class MergeTest(T.TestCase):
+
+    def test_shared_timestamps(self):
+        first = Series([10, 20], [[1.0, 2.0], [3.0, 4.0]])
+        second = Series([10, 20], [[5.0, 6.0]])
+        merged = merge(4, [([0, 2], first), ([1], second)])
+        T.assert_equal(merged, Series([10, 20], [[1.0, 2.0], [5.0, 6.0], [3.0, 4.0], [None, None]]))
+        # the columns are shared rather than copied
+        T.assert_is(merged.columns[0], first.columns[0])
+
+    def test_timestamp_union(self):
+        merged = merge(3, [
+            ([0], Series([20, 30, 40], [[2.0, 3.0, 4.0]])),
+            ([2], Series([10, 30], [[1.0, 3.5]])),
+            ([1], Series([10, 20, 30, 40, 50], [[0.0, 0.5, 1.0, 1.5, 2.0]])),
+        ])
+        T.assert_equal(merged.to_rows(), [
+            {'t': 10, 'v': [None, 0.0, 1.0]},
+            {'t': 20, 'v': [2.0, 0.5, None]},
+            {'t': 30, 'v': [3.0, 1.0, 3.5]},
+            {'t': 40, 'v': [4.0, 1.5, None]},
+            {'t': 50, 'v': [None, 2.0, None]},
+        ])
+
+    def test_empty(self):
+        T.assert_equal(merge(2, []), Series([], [[], []]))
+        merged = merge(2, [([0], Series([], [[]])), ([1], Series([10], [[1.0]]))])
+        T.assert_equal(merged, Series([10], [[None], [1.0]]))
+
+
+class RowDecoderTest(T.TestCase):
+
+    rows = [
+        {'t': 10, 'v': [1.0, None]},
+        {'t': 20, 'v': [2.0, 5.5]},
+        {'t': 30, 'v': [None, -3e-05]},
+    ]
+
+    def test_any_split(self):
+        data = json.dumps(self.rows, indent=1)
+        expected = Series.from_json(data)
+        for split in xrange(len(data) + 1):
+            T.assert_equal(Series.from_json_chunks([data[:split], data[split:]], 2), expected)
+        T.assert_equal(Series.from_json_chunks(list(data), 2), expected)
+        T.assert_equal(Series.from_json_chunks([expected.to_json()], 2), expected)
+
+    def test_only_the_incomplete_row_is_kept(self):
+        decoder = RowDecoder(2)
+        data = json.dumps(self.rows)
+        decoder.feed(data[:-10])
+        T.assert_equal(list(decoder.timestamps), [10, 20])
+        T.assert_lt(len(decoder._buffer), len(json.dumps(self.rows[-1])))
+        decoder.feed(data[-10:])
+        T.assert_equal(decoder.finish(), Series.from_rows(self.rows))
+
+    def test_empty(self):
+        T.assert_equal(Series.from_json_chunks(['[', ' ]'], 2), Series([], [[], []]))
+
+    def test_invalid(self):
+        for chunks in [[], ['[{"t": 10, "v": [1.0, 2.0]}'], ['{}'], ['[{"t": 10, "v": [1.0]}]'],
+                ['[{"t": 10, "v": [1.0, 2.0]}] trailing'], ['[{"t": 10, "v": [1.0, 2.0]}, nope]']]:
+            T.assert_raises(ValueError, Series.from_json_chunks, chunks, 2)
+
+    def test_invalid_rows_raise_once_fed(self):
+        # rather than waiting for the rest of the body at finish()
+        decoder = RowDecoder(2)
+        decoder.feed('[{"t": 10, "v": [1.0, 2.0]}, {"t": 20, "v": [1.0 ')
+        T.assert_raises(ValueError, decoder.feed, '2.0]}, {"t": 30, ')
+        T.assert_raises(ValueError, RowDecoder(2).feed, '[{"t": 10, "v": [1.0, 2.0]}, nope')
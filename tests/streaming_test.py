@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Contains tests for live streaming over /stream."""
+import json
+import time
+
+import testify as T
+
+from tests.testing import DataServerTestCase
+from tests.testing import FakeDataSource
+
+
+class StreamTest(DataServerTestCase):
+
+    def make_data_sources(self):
+        return [FakeDataSource(interval=1)]
+
+    def make_config(self):
+        return {
+            'stream_min_interval': 0.2,
+            'stream_poll_timeout': 3,
+        }
+
+    def stream_url(self, **params):
+        params.setdefault('sources', json.dumps([['ds0', 'stat0']]))
+        params.setdefault('zoom', 30)
+        params.setdefault('width', 0)
+        return self.url('/stream', **params)
+
+    def test_first_request_gets_the_window(self):
+        response = self.fetch(self.stream_url())
+        T.assert_equal(response.code, 200)
+        rows = json.loads(response.body)
+        T.assert_gte(len(rows), 30)
+        T.assert_equal(response.headers['X-Firefly-Cursor'], str(rows[-1]['t']))
+
+    def test_waits_for_new_points(self):
+        first = self.fetch(self.stream_url())
+        cursor = int(first.headers['X-Firefly-Cursor'])
+
+        started = time.time()
+        update = self.fetch(self.stream_url(cursor=cursor))
+        rows = json.loads(update.body)
+        # held until the next point showed up, about a second later
+        T.assert_gt(time.time() - started, 0.1)
+        T.assert_gt(int(update.headers['X-Firefly-Cursor']), cursor)
+        # along with the revised points before the cursor
+        T.assert_equal(rows[0]['t'], cursor - 2)
+
+    def test_fan_out(self):
+        cursor = int(self.fetch(self.stream_url()).headers['X-Firefly-Cursor'])
+        calls_before = len(self.data_sources[0].data_calls)
+
+        responses = self.fetch_all([self.stream_url(cursor=cursor, x=idx) for idx in xrange(5)])
+        T.assert_equal(len(set(response.body for response in responses)), 1)
+        T.assert_equal(len(set(response.headers['X-Firefly-Cursor'] for response in responses)), 1)
+        # the five clients shared the group's polls
+        T.assert_lte(len(self.data_sources[0].data_calls) - calls_before, 10)
+        T.assert_equal(len(self.application.settings['streams'].groups), 1)
+
+    def test_timeout(self):
+        self.application.settings['stream_poll_timeout'] = 0.3
+        future = int(time.time()) + 3600
+        response = self.fetch(self.stream_url(cursor=future))
+        T.assert_equal(json.loads(response.body), [])
+        T.assert_equal(response.headers['X-Firefly-Cursor'], str(future))
+
+    def test_too_many_subscribers(self):
+        self.application.settings['stream_max_subscribers'] = 1
+        self.application.settings['stream_poll_timeout'] = 0.5
+        future = int(time.time()) + 3600
+        waiting, rejected = self.fetch_all([
+            self.stream_url(cursor=future),
+            self.stream_url(cursor=future, x=1)])
+        T.assert_equal(sorted([waiting.code, rejected.code]), [200, 503])
+        T.assert_in('Retry-After', [waiting, rejected][[waiting.code, rejected.code].index(503)].headers)
+
+    def test_keeps_polling_after_a_bad_result(self):
+        data_source = self.data_sources[0]
+        real_data = data_source.data
+        results = iter(['not json'])
+        data_source.data = lambda *args: next(results, None) or real_data(*args)
+        self.application.settings['stream_poll_timeout'] = 2
+
+        response = self.fetch(self.stream_url())
+        T.assert_equal(response.code, 200)
+        T.assert_gte(len(json.loads(response.body)), 30)
+        T.assert_gte(len(data_source.data_calls), 1)
+
+    def test_bad_requests(self):
+        T.assert_equal(self.fetch(self.stream_url(zoom=0)).code, 400)
+        T.assert_equal(self.fetch(self.stream_url(downsample='nope')).code, 400)
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""Helpers for tests which talk to a real data server over HTTP."""
+import BaseHTTPServer
+import functools
+import json
+import socket
+import SocketServer
+import threading
+import time
+from urllib import urlencode
+import urlparse
+
+import testify as T
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+
+from firefly import data_server
+from firefly import util
+import firefly.data_source
+
+
+SECRET_KEY = "TEST_SECRET"
+
+
+class FakeDataSource(firefly.data_source.DataSource):
+    """Data source which serves one point per `interval` seconds, sleeping for
+    `delay` seconds on every data call and counting the calls it gets."""
+
+    DESC = "Fake"
+
+    def __init__(self, *args, **kwargs):
+        super(FakeDataSource, self).__init__(*args, **kwargs)
+        self.delay = kwargs.get('delay', 0)
+        self.interval = kwargs.get('interval', 10)
+        self.data_calls = []
+        self._lock = threading.Lock()
+
+    def list_path(self, path):
+        return [{'type': 'file', 'name': 'stat%d' % i} for i in xrange(3)]
+
+    def data(self, sources, start, end, width):
+        with self._lock:
+            self.data_calls.append((sources, start, end, width))
+        if self.delay:
+            time.sleep(self.delay)
+        rows = []
+        for t in xrange(start - start % self.interval, end + 1, self.interval):
+            rows.append({'t': t, 'v': [float(t % 100 + idx) for idx, _ in enumerate(sources)]})
+        return json.dumps(rows)
+
+    def title(self, sources):
+        return ["fake"]
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A stand-in for a data server, for data sources which call data
+    servers, running on a thread of its own until stop() is called.
+
+    /sources lists `names`, and /data serves one point at t=100 with each
+    source's position in the request as its value; both take `delay`
+    seconds to answer. Connections are kept alive, and counted in
+    `connections`.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, names=(), delay=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _StandInHandler)
+        self.names = list(names)
+        self.delay = delay
+        self.connections = 0
+        self.requests = []
+        self.stopped = False
+        self._sockets = []
+        self._lock = threading.Lock()
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def stop(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        self.shutdown()
+        self.server_close()
+        # let the threads serving kept-alive connections finish
+        for sock in self._sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def get_request(self):
+        request = BaseHTTPServer.HTTPServer.get_request(self)
+        with self._lock:
+            self.connections += 1
+            self._sockets.append(request[0])
+        return request
+
+    def handle_error(self, request, client_address):
+        # clients going away mid-request, which some tests do on purpose
+        pass
+
+
+class _StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        with self.server._lock:
+            self.server.requests.append((url.path, params))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+
+        if url.path == '/sources':
+            body = json.dumps([{'type': 'dir', 'name': name} for name in self.server.names])
+        elif url.path == '/data':
+            sources = json.loads(params['sources'])
+            body = json.dumps([{'t': 100, 'v': range(len(sources))}])
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DataServerTestCase(T.TestCase):
+    """Runs a data server on its own IOLoop for the duration of each test.
+
+    Subclasses can override make_data_sources and make_config to change what
+    the server serves.
+    """
+
+    def make_data_sources(self):
+        return [FakeDataSource()]
+
+    def make_config(self):
+        return {}
+
+    @T.setup
+    def start_data_server(self):
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.data_sources = self.make_data_sources()
+        data_sources_by_key = {}
+        for idx, ds in enumerate(self.data_sources):
+            ds._FF_KEY = 'ds%d' % idx
+            data_sources_by_key[ds._FF_KEY] = ds
+
+        config = {
+            'data_sources': self.data_sources,
+            'data_sources_by_key': data_sources_by_key,
+            'secret_key': SECRET_KEY,
+        }
+        config.update(self.make_config())
+        self.application = data_server.make_application(config)
+        self.application.settings['executors'] = data_server.start_executors(
+            data_sources_by_key, io_loop=self.io_loop)
+        if 'annotation_writer' in self.application.settings:
+            self.application.settings['annotation_writer'].io_loop = self.io_loop
+
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+
+        self.http_server = tornado.httpserver.HTTPServer(self.application, io_loop=self.io_loop)
+        self.http_server.listen(self.port, '127.0.0.1')
+        self.http_client = tornado.httpclient.AsyncHTTPClient(self.io_loop)
+
+    @T.teardown
+    def stop_data_server(self):
+        self.http_server.stop()
+        for data_source_executor in self.application.settings['executors'].itervalues():
+            data_source_executor.shutdown()
+
+    def token(self):
+        return util.generate_access_token(SECRET_KEY)
+
+    def url(self, handler_path, **params):
+        params.setdefault('token', self.token())
+        return "http://127.0.0.1:%d%s?%s" % (self.port, handler_path, urlencode(params))
+
+    def fetch_all(self, urls, stagger=0, **kwargs):
+        """Fetches all of the given urls concurrently, returning the
+        responses in the same order. Each request is sent `stagger` seconds
+        after the one before it."""
+        responses = [None] * len(urls)
+        pending = [len(urls)]
+
+        def on_response(idx, response):
+            responses[idx] = response
+            pending[0] -= 1
+            if not pending[0]:
+                self.io_loop.stop()
+
+        for idx, url in enumerate(urls):
+            send = functools.partial(self.http_client.fetch, url,
+                lambda response, idx=idx: on_response(idx, response), **kwargs)
+            if stagger and idx:
+                self.io_loop.add_timeout(time.time() + stagger * idx, send)
+            else:
+                send()
+        def on_timeout():
+            self.io_loop.stop()
+            raise AssertionError("Timed out waiting for %d responses" % pending[0])
+
+        timeout = self.io_loop.add_timeout(time.time() + 10, on_timeout)
+        self.io_loop.start()
+        if not pending[0]:
+            self.io_loop.remove_timeout(timeout)
+        return responses
+
+    def fetch(self, url, **kwargs):
+        return self.fetch_all([url], **kwargs)[0]
+
+    def data_url(self, sources, start, end, width=100, data_source_idx=0, **params):
+        ds_key = self.data_sources[data_source_idx]._FF_KEY
+        params.update({
+            'sources': json.dumps([[ds_key] + source for source in sources]),
+            'start': start,
+            'end': end,
+            'width': width,
+        })
+        return self.url('/data', **params)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""Contains tests for Server-Timing headers and the slow request log."""
+import json
+import time
+
+import mock
+import testify as T
+
+from firefly import timing
+from tests.testing import DataServerTestCase
+from tests.testing import FakeDataSource
+
+
+class TimedDataSource(FakeDataSource):
+
+    def data(self, sources, start, end, width):
+        with timing.phase('backend'):
+            time.sleep(0.05)
+        return super(TimedDataSource, self).data(sources, start, end, width)
+
+
+def parse_server_timing(header):
+    durations = {}
+    for entry in header.split(','):
+        name, duration = entry.strip().split(';dur=')
+        durations[name] = float(duration)
+    return durations
+
+
+class RequestTimingTest(T.TestCase):
+
+    def test_repeated_phases_add_up(self):
+        request_timing = timing.RequestTiming()
+        request_timing.add('auth', 0.001)
+        request_timing.add('data', 0.5)
+        request_timing.add('auth', 0.002)
+        T.assert_equal(request_timing.header(1.0), 'auth;dur=3.00, data;dur=500.00, total;dur=1000.00')
+
+    def test_phases_outside_collect_are_dropped(self):
+        with timing.phase('nothing'):
+            pass
+        with timing.collect() as phases:
+            with timing.phase('something'):
+                pass
+        T.assert_equal([name for name, _ in phases], ['something'])
+
+
+class ServerTimingTest(DataServerTestCase):
+
+    def make_data_sources(self):
+        return [TimedDataSource()]
+
+    def make_config(self):
+        return {'slow_request_threshold': 0.04}
+
+    def test_data_phases(self):
+        response = self.fetch(self.data_url([['stat0']], 1000, 2000))
+        T.assert_equal(response.code, 200)
+        T.assert_equal(response.headers['Timing-Allow-Origin'], '*')
+        durations = parse_server_timing(response.headers['Server-Timing'])
+        for name in ('auth', 'parse', 'cache', 'queue', 'data', 'backend', 'decode', 'downsample', 'encode', 'total'):
+            T.assert_in(name, durations)
+        T.assert_gte(durations['backend'], 50)
+        T.assert_gte(durations['data'], durations['backend'])
+        T.assert_gte(durations['total'], durations['data'])
+
+    def test_errors_are_timed(self):
+        response = self.fetch(self.url('/data', sources=json.dumps([['ds0', 'stat0']]), token='nope'))
+        T.assert_equal(response.code, 403)
+        T.assert_in('auth', parse_server_timing(response.headers['Server-Timing']))
+
+    def test_slow_request_log(self):
+        with mock.patch.object(timing.slow_log, 'warning') as warning:
+            self.fetch(self.url('/ping'))
+            T.assert_equal(warning.call_count, 0)
+
+            self.fetch(self.data_url([['stat0']], 1000, 2000))
+            T.assert_equal(warning.call_count, 1)
+            message = warning.call_args[0][0] % warning.call_args[0][1:]
+            T.assert_in('/data', message)
+            T.assert_in('sources=[["stat0"]]', message)
+            T.assert_in('start=1000 end=2000 width=100', message)
+            T.assert_in('backend;dur=', message)